@@ -1 +1,8 @@
-from .helpers import call_concurrently, make_concurrent_calls  # pylint: disable=F401
+from .helpers import (  # pylint: disable=F401
+    call_concurrently,
+    hunt_race,
+    iter_concurrent_calls,
+    make_concurrent_calls,
+)
+from .interleavings import explore_interleavings  # pylint: disable=F401
+from .load import run_load  # pylint: disable=F401
@@ -0,0 +1,185 @@
+"""
+asyncio versions of the helpers (Python 3.5+).
+
+The calls are the same `supervisor.Job`s as for the synchronous helpers,
+with any execution mode, but their fds and deadlines are watched by the
+running event loop instead of a blocking `poll`. So any number of batches
+can be in flight from one event loop, without a thread per batch (as
+with `run_in_executor`) or per call.
+
+Cancelling the awaiting task terminates the calls still running.
+"""
+import asyncio
+
+from .helpers import (
+    _check_require_overlap,
+    _get_deadline,
+    _overlap_error,
+    _overlapped_enough,
+    _pop_options,
+    _prepare,
+    REQUIRE_OVERLAP_ATTEMPTS,
+)
+from .supervisor import READ, Supervisor, WRITE
+
+
+class AsyncSupervisor(Supervisor):
+    """
+    `Supervisor` driven by the current asyncio event loop.
+    """
+
+    def __init__(self, max_running=None, **kwargs):
+        super(AsyncSupervisor, self).__init__(max_running, **kwargs)
+        self._loop = asyncio.get_event_loop()
+        self._changed = asyncio.Event()
+        self._timer = None
+
+    def _register(self, fd, events):
+        if events & READ:
+            self._loop.add_reader(fd, self._on_event, fd, READ)
+        if events & WRITE:
+            self._loop.add_writer(fd, self._on_event, fd, WRITE)
+
+    def _modify(self, fd, events):
+        self._unregister(fd)
+        self._register(fd, events)
+
+    def _unregister(self, fd):
+        self._loop.remove_reader(fd)
+        self._loop.remove_writer(fd)
+
+    def _on_event(self, fd, events):
+        self._handle(fd, events)
+        self._on_change()
+
+    def _on_timer(self):
+        self._timer = None
+        self._check_deadlines()
+        self._on_change()
+
+    def _on_change(self):
+        if self._finished:
+            self._changed.set()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        timeout = self._next_timeout()
+        if timeout is not None and self._running:
+            self._timer = self._loop.call_later(timeout, self._on_timer)
+
+    def end(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        super(AsyncSupervisor, self).end()
+
+    async def run(self, batches, on_finished):
+        """
+        Start `batches` of jobs and supervise them until all are finished.
+
+        Args:
+            batches (Iterable[Batch])
+            on_finished (Callable[[Job], None]): called with each job as
+                soon as it has finished
+        """
+        try:
+            self.begin(batches)
+            self._on_change()
+            while self.busy:
+                while self._finished:
+                    on_finished(self._finished.popleft())
+                self._start_pending()
+                self._on_change()
+                if self._running:
+                    await self._changed.wait()
+                    self._changed.clear()
+        finally:
+            self.end()
+
+
+async def _arun(calls, options):
+    """
+    Returns:
+        List[SubprocessRun]: for each of `calls`, in the same order
+    """
+    runs = [None] * len(calls)
+    if not calls:
+        return runs
+    jobs, batches = _prepare(calls, options)
+    indexes = dict((job, index) for index, job in enumerate(jobs))
+    # (with `require_overlap` we only know which attempt counts at the end)
+    on_result = None if options.require_overlap else options.on_result
+
+    def on_finished(job):
+        index = indexes[job]
+        runs[index] = job.get_run()
+        if on_result is not None:
+            on_result(index, runs[index].result)
+
+    supervisor = AsyncSupervisor(
+        max_running=options.max_workers,
+        deadline=_get_deadline(options),
+    )
+    await supervisor.run(batches, on_finished)
+    return runs
+
+
+async def _arun_overlapping(calls, options):
+    """
+    Awaitable version of `helpers._run_overlapping`.
+    """
+    _check_require_overlap(calls, options)
+    for _ in range(REQUIRE_OVERLAP_ATTEMPTS):
+        runs = await _arun(calls, options)
+        if _overlapped_enough(runs, options):
+            if options.on_result is not None:
+                for index, run in enumerate(runs):
+                    options.on_result(index, run.result)
+            return runs
+    raise _overlap_error(options)
+
+
+async def amake_concurrent_calls(*calls, **options):
+    """
+    Awaitable version of `helpers.make_concurrent_calls`.
+
+    Args:
+        *calls (Iterable[Union[function, str], dict]) - list of
+            (func or func path, kwargs) tuples to call concurrently
+
+    Kwargs:
+        see `helpers.make_concurrent_calls`, except for `switch_interval`
+
+    Returns:
+        List[Any] - return values from each call in `calls`
+            (results are returned in same order as supplied)
+    """
+    options = _pop_options(options)
+    if options.switch_interval is not None:
+        # it's for the whole process, i.e. every other task on the loop
+        # too, while we're waiting for the calls
+        raise ValueError('switch_interval is not supported by the asyncio helpers')
+    if options.require_overlap:
+        runs = await _arun_overlapping(calls, options)
+    else:
+        runs = await _arun(calls, options)
+    if options.return_runs:
+        return runs
+    return [run.result for run in runs]
+
+
+async def acall_concurrently(concurrency, function, **kwargs):
+    """
+    Awaitable version of `helpers.call_concurrently`.
+
+    Args:
+        concurrency (int): how many calls to make in parallel
+        function (Union[function, str]): the function to call, or
+            the 'dotted module.path.to:function' as a string
+        **kwargs: kwargs to pass to `function`
+
+    Returns:
+        List[Any]: return values from each run `function`
+    """
+    return await amake_concurrent_calls(
+        *[(function, kwargs) for i in range(concurrency)]
+    )
@@ -0,0 +1,134 @@
+"""
+Start barrier for concurrent calls.
+
+Without it each call enters the function under test whenever its process
+happens to finish booting, so the window in which the calls actually overlap
+is small and random. With it every call completes its setup (imports, kwargs
+deserialization, db connections) and then waits for the parent, which
+releases all of them together once every call is ready.
+"""
+import os
+import select
+import time
+
+from .supervisor import set_cloexec
+from .utils import SUBPROCESS_TIMEOUT
+
+
+class StartBarrier(object):
+    """
+    Parent side of the barrier.
+
+    Subprocesses inherit `child_fds` and call `wait_for_start` with them,
+    the parent releases them all at once by closing the write end of the
+    'go' pipe (every waiting child sees EOF in the same instant).
+
+    Workers that talk to the parent over their own channel instead are
+    represented in the parent by their `supervisor.Job`, which `arrive`s
+    when its worker is ready and tells the worker to go once released.
+
+    A party which fails before it reaches the barrier must `leave` it, so
+    that the others aren't kept waiting.
+
+    Normally the `supervisor.Supervisor` of the batch watches `fileno()`
+    for arrivals, `collect`s them and releases the barrier, `wait` does
+    the same for use on its own.
+    """
+
+    def __init__(self, parties, timeout=SUBPROCESS_TIMEOUT):
+        """
+        Kwargs:
+            parties (int): number of calls to wait for
+            timeout (Float): release anyway after this many seconds
+        """
+        self.parties = parties
+        self.timeout = timeout
+        self._ready_r, self._ready_w = os.pipe()
+        self._go_r, self._go_w = os.pipe()
+        # only `child_fds` are for the children: if one of them held on to
+        # the write end of the 'go' pipe, closing ours wouldn't release
+        # anybody
+        for fd in (self._ready_r, self._go_w):
+            set_cloexec(fd)
+        self._released = False
+        self._arrived = 0
+
+    @property
+    def child_fds(self):
+        """
+        Returns:
+            Tuple[int, int]: (ready fd, go fd) to pass to `wait_for_start`
+        """
+        return self._ready_w, self._go_r
+
+    @property
+    def released(self):
+        return self._released
+
+    def fileno(self):
+        """
+        Returns:
+            int: fd which becomes readable as parties arrive
+        """
+        return self._ready_r
+
+    def arrive(self):
+        os.write(self._ready_w, b'.')
+
+    # a party that leaves counts the same as one that arrived
+    leave = arrive
+
+    def collect(self):
+        """
+        Count the parties which arrived, call once `fileno()` is readable.
+
+        Returns:
+            bool: whether all parties have arrived
+        """
+        self._arrived += len(os.read(self._ready_r, self.parties))
+        return self._arrived >= self.parties
+
+    def wait(self):
+        """
+        Block until all parties have arrived (or `timeout` elapsed), then
+        release them.
+
+        Returns:
+            bool: whether all parties arrived
+        """
+        deadline = time.time() + self.timeout
+        arrived = self._arrived >= self.parties
+        while not arrived:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([self._ready_r], [], [], remaining)
+            if readable:
+                arrived = self.collect()
+        self.release()
+        return arrived
+
+    def release(self):
+        if not self._released:
+            os.close(self._go_w)
+            self._released = True
+
+    def close(self):
+        """
+        Release any remaining waiters and free our fds, once no more
+        parties will be started.
+        """
+        self.release()
+        for fd in (self._ready_r, self._ready_w, self._go_r):
+            os.close(fd)
+
+
+def wait_for_start(ready_fd, go_fd):
+    """
+    Child side of the barrier: signal we're ready and block until the
+    parent releases us.
+    """
+    os.write(ready_fd, b'.')
+    # nothing is ever written to the 'go' pipe, we're released by EOF
+    while os.read(go_fd, 1):
+        pass
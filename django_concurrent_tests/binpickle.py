@@ -0,0 +1,35 @@
+import pickle
+
+from .b64pickle import PickleLoadsError
+
+
+__all__ = ('dumps', 'loads')
+
+
+"""
+binary counterpart of `b64pickle`, for use over binary-safe channels (see
+`transport`): highest pickle protocol and no base64 step, so payloads are
+much smaller and faster to encode/decode
+
+`b64pickle` remains the serializer wherever we need ascii
+"""
+
+
+def dumps(obj):
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def loads(val):
+    try:
+        return pickle.loads(val)
+    except Exception as e:
+        # we can still recover some useful information from the still-pickled
+        # value... (see `b64pickle.loads`)
+        truncate_to = 300
+        summary = '{truncated}{ellipsis}'.format(
+            truncated=repr(val[:truncate_to]),
+            ellipsis='...' if len(val) > truncate_to else ''
+        )
+        error = PickleLoadsError(e, summary)
+        error.pickled_value = val
+        raise error
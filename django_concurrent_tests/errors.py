@@ -12,6 +12,28 @@ class TerminatedProcessError(Exception):
     pass
 
 
+class DeadlineExceededError(TerminatedProcessError):
+    """
+    The overall deadline of a batch of calls passed before this call could
+    even be started.
+    """
+
+
+class InsufficientOverlapError(Exception):
+    """
+    The calls didn't overlap as much as required (see the `require_overlap`
+    option of `helpers.make_concurrent_calls`), however many times we
+    tried.
+    """
+
+
+class WorkerDiedError(Exception):
+    """
+    A long-lived worker process exited, or stopped accepting calls,
+    before returning a result.
+    """
+
+
 class WrappedError(Exception):
     """
     Pickleable, captures original traceback.
@@ -38,7 +60,7 @@ class WrappedError(Exception):
         super(WrappedError, self).__init__(repr(error))
 
     def reraise(self):
-        six.reraise(self.error, None, self.traceback)
+        six.reraise(type(self.error), self.error, self.traceback)
 
     def print_tb(self):
         traceback.print_tb(self.traceback)
@@ -0,0 +1,320 @@
+"""
+Fork-server execution mode (Django 1.8+).
+
+A single server process (`manage.py concurrent_forkserver`) initialises
+Django and switches to the test dbs, closes its db connections and then
+forks a child process for each call. Forking from an already warmed-up
+process makes per-call start-up a matter of milliseconds, and the children
+share the server's memory copy-on-write.
+
+(On Django < 1.8 forked processes can't safely use the db, see README)
+"""
+import atexit
+import os
+import select
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing import reduction
+
+import django
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import binpickle, errors, payload, transport
+from .output import OutputLogger
+from .pool import WorkerProcess
+from .supervisor import (
+    FramedJob,
+    READ,
+    read_available,
+    run_job,
+    set_cloexec,
+    set_nonblocking,
+    signal_group,
+)
+from .utils import (
+    get_function_path,
+    get_session_key,
+    get_test_databases_env,
+    SUBPROCESS_TIMEOUT,
+)
+
+
+class ForkedProcess(FramedJob):
+    """
+    A child forked by the server to make a single call.
+
+    We connect to the server, which forks a child to handle the connection,
+    and send it a pipe for its stderr (so that its output is logged, and
+    capped, as its own) and the job. The child tells us its pid, sets up for the call and
+    says 'ready', once released by the start barrier we say 'go' and the
+    child replies with the metrics and the result of the call.
+    """
+
+    def __init__(self, server, f, kwargs, timeout=SUBPROCESS_TIMEOUT):
+        """
+        Kwargs:
+            server (ForkServer): to fork the child
+            f (Union[function, str]): the function to call
+            kwargs (dict): kwargs to pass to `function`
+            timeout (Float): how long to wait for the result
+        """
+        super(ForkedProcess, self).__init__(timeout)
+        self.server = server
+        self.function_path = get_function_path(f)
+        self.kwargs = kwargs
+        self.pid = None
+        self.terminated = False  # whether child was terminated by timeout
+        self._sock = None
+        self._stderr_fd = None
+        self._output = None  # `output.OutputLogger` of the child's stderr
+        self._got_metrics = False
+        self._result = None
+
+    @property
+    def name(self):
+        return 'forked process {pid}'.format(pid=self.pid)
+
+    def start(self, supervisor):
+        super(ForkedProcess, self).start(supervisor)
+        # (anything the server itself writes)
+        supervisor.drain(self.server.stderr_fd, self.server.log_stderr)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        set_cloexec(self._sock.fileno())
+        self._sock.settimeout(self.timeout)
+        self._sock.connect(self.server.address)
+        self._output = OutputLogger(None, self.call_index)
+        self._stderr_fd, child_stderr_fd = os.pipe()
+        try:
+            set_cloexec(self._stderr_fd)
+            set_nonblocking(self._stderr_fd)
+            reduction.send_handle(self._sock, child_stderr_fd, self.server.pid)
+        finally:
+            os.close(child_stderr_fd)
+        self.watch(self._stderr_fd, READ, self._on_stderr)
+        self._sock.setblocking(False)
+        fd = self._sock.fileno()
+        self.open_channel(fd, fd)
+        self.send(payload.dumps(
+            binpickle.dumps((self.function_path, self.kwargs)), in_file=False,
+            metrics=self.metrics, name='kwargs',
+        ))
+
+    def _read_stderr(self):
+        chunk = read_available(self._stderr_fd)
+        if chunk:
+            self._output.feed(chunk)
+        return chunk
+
+    def _on_stderr(self, events):
+        if self._read_stderr() == b'':
+            self.unwatch(self._stderr_fd)
+
+    def on_frame(self, frame):
+        if self.pid is None:
+            self.pid = self._output.pid = int(frame)
+            self.metrics.spawn = time.time() - self.started_at
+        elif not self.arrived:
+            self.arrive()  # 'ready'
+        elif not self._got_metrics:
+            self._got_metrics = True
+            self.metrics.update(binpickle.loads(frame))
+        else:
+            self._result = payload.claim(frame)
+            self.finish()
+
+    def on_released(self):
+        self.send(b'go')
+
+    def on_eof(self):
+        if self.timed_out:
+            raise errors.TerminatedProcessError(self.pid)
+        super(ForkedProcess, self).on_eof()
+
+    def on_timeout(self):
+        self.terminate()
+        if not self.pid:
+            # no child to wait for
+            raise errors.TerminatedProcessError(self.pid)
+
+    def on_kill(self):
+        self.kill()
+        raise errors.TerminatedProcessError(self.pid)
+
+    def terminate(self):
+        """
+        Ask the child, and anything it started, to exit (without waiting).
+        """
+        self.terminated = True
+        if self.pid:
+            signal_group(self.pid, signal.SIGTERM)
+
+    def kill(self):
+        # (the server reaps its children)
+        self.terminated = True
+        if self.pid:
+            signal_group(self.pid, signal.SIGKILL)
+
+    def cleanup(self):
+        super(ForkedProcess, self).cleanup()
+        if self._sock is not None:
+            self._sock.close()
+        if self._stderr_fd is not None:
+            # (the child flushed its stderr before sending the result)
+            try:
+                while self._read_stderr():
+                    pass
+            finally:
+                self.unwatch(self._stderr_fd)
+                os.close(self._stderr_fd)
+                self._stderr_fd = None
+                self._output.close()
+
+    def abort(self):
+        self.kill()
+        super(ForkedProcess, self).abort()
+
+    def get_result(self):
+        return payload.loads(self._result)
+
+
+class ForkServer(WorkerProcess):
+
+    def __init__(self, cmd, env=None):
+        """
+        Kwargs:
+            cmd (List[str]): `args` arg to `Popen` call, without the
+                `--address` option
+            env (Optional[Dict[str, str]]): environment for the server
+                (defaults to a copy of `os.environ`), plus our test dbs
+                (see `utils.get_test_databases_env`)
+        """
+        self._socket_dir = tempfile.mkdtemp(prefix='concurrent_tests')
+        self.address = os.path.join(self._socket_dir, 'forkserver.sock')
+        env = (env if env is not None else os.environ).copy()
+        env['DJANGO_CONCURRENT_TESTS_PARENT_PID'] = str(os.getpid())
+        env.update(get_test_databases_env())
+        try:
+            super(ForkServer, self).__init__(
+                cmd + ['--address=%s' % self.address], env
+            )
+            # block until the server is initialised and listening
+            ready = self._read_frame(SUBPROCESS_TIMEOUT)
+            if ready != b'ready':
+                raise errors.WorkerDiedError(
+                    'fork server {pid} failed to start: {output!r}'.format(
+                        pid=self.pid, output=ready,
+                    )
+                )
+        except Exception:
+            if getattr(self, 'process', None) is not None:
+                self.kill()
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            raise
+
+    def _read_frame(self, timeout):
+        deadline = time.time() + timeout
+        reader = transport.FrameReader()
+        while True:
+            frame = reader.next_frame()
+            if frame is not None:
+                return frame
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.kill()
+                raise errors.TerminatedProcessError(reader.pending())
+            readable, _, _ = select.select(
+                [self.stdout_fd, self.stderr_fd], [], [], remaining
+            )
+            if self.stderr_fd in readable:
+                self.log_stderr()
+            if self.stdout_fd in readable:
+                chunk = read_available(self.stdout_fd)
+                if chunk == b'':
+                    self.flush_stderr()
+                    raise errors.WorkerDiedError(
+                        'fork server {pid} exited with code {code}'.format(
+                            pid=self.pid, code=self.process.wait(),
+                        )
+                    )
+                reader.feed(chunk or b'')
+
+    def job(self, f, kwargs, timeout=SUBPROCESS_TIMEOUT):
+        """
+        Returns:
+            ForkedProcess: to call `f` in a process forked by the server
+        """
+        return ForkedProcess(self, f, kwargs, timeout=timeout)
+
+    def run(self, f, **kwargs):
+        """
+        Same as `utils.run_in_subprocess`, but in a process forked by
+        the server.
+
+        Returns:
+            SubprocessRun: where `<SubprocessRun>.manager` is the
+                `ForkedProcess` which made the call
+        """
+        return run_job(self.job(f, kwargs))
+
+    def close(self, timeout=5):
+        super(ForkServer, self).close(timeout)
+        shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def get_fork_server():
+    """
+    Returns:
+        ForkServer: the server for the current settings, test dbs and
+            environment (started on first use, then kept until exit or
+            until a server for other settings etc is needed)
+    """
+    if django.VERSION < (1, 8):
+        raise ImproperlyConfigured(
+            "The 'forkserver' mode requires Django 1.8+"
+        )
+    key = get_session_key()
+    with _servers_lock:
+        server = _servers.get(key)
+        if server is not None and not server.is_alive():
+            # (e.g. killed after a timeout)
+            server.close()
+            server = None
+        if server is None:
+            # (its children, in their own process groups, carry on with
+            # any calls in flight)
+            for old in _servers.values():
+                old.close()
+            _servers.clear()
+            server = _servers[key] = ForkServer(
+                cmd=[
+                    getattr(settings, 'MANAGE_PY_PATH', './manage.py'),
+                    'concurrent_forkserver',
+                ],
+            )
+    return server
+
+
+@atexit.register
+def close_fork_servers():
+    with _servers_lock:
+        servers = list(_servers.values())
+        _servers.clear()
+    for server in servers:
+        server.close()
+
+
+def run_in_fork_server(f, **kwargs):
+    """
+    Like `utils.run_in_subprocess` but the call is made by a process forked
+    from the current `get_fork_server()`.
+    """
+    return get_fork_server().run(f, **kwargs)
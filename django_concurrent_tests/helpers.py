@@ -1,6 +1,24 @@
-from multiprocessing.pool import ThreadPool as Pool
+import logging
+import time
+from collections import namedtuple
+from contextlib import closing
 
-from .utils import run_in_subprocess, SUBPROCESS_TIMEOUT
+from . import errors
+from .metrics import get_overlap
+from .supervisor import Batch, Supervisor
+from .utils import (
+    get_mode,
+    override_switch_interval,
+    subprocess_job,
+    SUBPROCESS_TIMEOUT,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# how many times `require_overlap` makes the calls before giving up
+REQUIRE_OVERLAP_ATTEMPTS = 5
 
 
 def call_concurrently(concurrency, function, **kwargs):
@@ -32,7 +50,244 @@ def call_concurrently(concurrency, function, **kwargs):
     )
 
 
-def make_concurrent_calls(*calls):
+def _get_job_factory(mode, concurrency):
+    """
+    Returns:
+        Callable[[Union[function, str], dict, Float], supervisor.Job]
+    """
+    if mode == 'pool':
+        from .pool import get_worker_pool
+        pool = get_worker_pool()
+        # boot all the workers we need in parallel, up front
+        pool.warm_up(concurrency)
+        return pool.job
+    if mode == 'forkserver':
+        from .forkserver import get_fork_server
+        return get_fork_server().job
+    if mode == 'threads':
+        from .threads import thread_job
+        return thread_job
+    return subprocess_job
+
+
+def _prepare(calls, options):
+    """
+    Returns:
+        Tuple[List[supervisor.Job], List[supervisor.Batch]]: a job for each
+            of `calls`, and the same jobs split into batches
+    """
+    if options.batch_size:
+        batch_size = options.batch_size
+    elif options.max_workers and not options.barrier:
+        # nothing to hold the calls of a batch together: start each call as
+        # soon as there's room for it
+        batch_size = 1
+    else:
+        batch_size = options.max_workers or len(calls)
+    concurrency = min(options.max_workers or len(calls), len(calls))
+    make_job = _get_job_factory(options.mode, concurrency)
+    jobs = [
+        make_job(func, kwargs, timeout=options.timeout)
+        for func, kwargs in calls
+    ]
+    for index, job in enumerate(jobs):
+        # (to tell the output of the calls apart)
+        job.call_index = index
+    batches = [
+        Batch(
+            jobs[i:i + batch_size],
+            barrier_timeout=options.timeout if options.barrier else None,
+        )
+        for i in range(0, len(jobs), batch_size)
+    ]
+    return jobs, batches
+
+
+def _get_deadline(options):
+    """
+    Returns:
+        Optional[Float]: `time.time()` by which the whole set of calls
+            must be done, if `total_timeout` was given
+    """
+    if options.total_timeout is None:
+        return None
+    return time.time() + options.total_timeout
+
+
+def _iter_runs(calls, options):
+    """
+    Make `calls` concurrently, all supervised from the current thread.
+
+    Yields:
+        Tuple[int, SubprocessRun]: (index in `calls`, run) in order
+            of completion
+    """
+    if not calls:
+        return
+    jobs, batches = _prepare(calls, options)
+    indexes = dict((job, index) for index, job in enumerate(jobs))
+    supervisor = Supervisor(
+        max_running=options.max_workers,
+        deadline=_get_deadline(options),
+    )
+    # (if our consumer stops early, closing this aborts any stragglers)
+    with override_switch_interval(options.switch_interval), \
+            closing(supervisor.iter_finished(batches)) as finished:
+        for job in finished:
+            yield indexes[job], job.get_run()
+
+
+_Options = namedtuple(
+    '_Options',
+    [
+        'mode',
+        'barrier',
+        'on_result',
+        'timeout',
+        'total_timeout',
+        'max_workers',
+        'batch_size',
+        'return_runs',
+        'require_overlap',
+        'switch_interval',
+    ],
+)
+
+
+def _pop_options(options):
+    """
+    Returns:
+        _Options: validated options of `make_concurrent_calls`
+    """
+    mode = get_mode(options.pop('mode', None))
+    barrier = options.pop('barrier', True)
+    on_result = options.pop('on_result', None)
+    timeout = options.pop('timeout', SUBPROCESS_TIMEOUT)
+    total_timeout = options.pop('total_timeout', None)
+    max_workers = options.pop('max_workers', None)
+    batch_size = options.pop('batch_size', None)
+    return_runs = options.pop('return_runs', False)
+    require_overlap = options.pop('require_overlap', None)
+    switch_interval = options.pop('switch_interval', None)
+    if options:
+        raise TypeError(
+            'Unexpected option(s): {}'.format(', '.join(sorted(options)))
+        )
+    for name, value in (
+        ('max_workers', max_workers),
+        ('batch_size', batch_size),
+        ('require_overlap', require_overlap),
+    ):
+        if value is not None and value < 1:
+            raise ValueError('{name} must be at least 1'.format(name=name))
+    if max_workers and batch_size and batch_size > max_workers:
+        raise ValueError('batch_size must not be greater than max_workers')
+    if total_timeout is not None and total_timeout <= 0:
+        raise ValueError('total_timeout must be positive')
+    if switch_interval is not None and switch_interval <= 0:
+        raise ValueError('switch_interval must be positive')
+    return _Options(
+        mode,
+        barrier,
+        on_result,
+        timeout,
+        total_timeout,
+        max_workers,
+        batch_size,
+        return_runs,
+        require_overlap,
+        switch_interval,
+    )
+
+
+def iter_concurrent_calls(*calls, **options):
+    """
+    As `make_concurrent_calls` but returns an iterator which yields each
+    result as soon as its call completes, so you can start asserting
+    before the slowest call has finished, stop waiting for stragglers
+    (just stop iterating, any calls still running are then terminated)
+    and don't have to hold every result in memory.
+
+    Args:
+        *calls (Iterable[Union[function, str], dict]) - list of
+            (func or func path, kwargs) tuples to call concurrently
+
+    Kwargs:
+        see `make_concurrent_calls`
+
+    Returns:
+        Iterator[Tuple[int, Any]] - (index in `calls`, return value)
+            for each call, in order of completion (or the `SubprocessRun`
+            instead of the return value, with `return_runs=True`)
+    """
+    options = _pop_options(options)
+    if options.require_overlap:
+        raise ValueError(
+            "require_overlap may re-run the calls, so it can't be used "
+            "when results are streamed"
+        )
+    return _iter_results(_iter_runs(calls, options), options)
+
+
+def _check_require_overlap(calls, options):
+    if options.require_overlap > min(options.max_workers or len(calls), len(calls)):
+        raise ValueError(
+            "require_overlap can't be more than the number of calls "
+            "allowed to run at once"
+        )
+
+
+def _overlapped_enough(runs, options):
+    """
+    Returns:
+        bool: whether at least `require_overlap` of `runs` were running
+            their function at the same time
+    """
+    overlap = get_overlap(runs)
+    if overlap.max_degree >= options.require_overlap:
+        return True
+    logger.info('Calls did not overlap enough, {overlap}'.format(overlap=overlap))
+    return False
+
+
+def _run_overlapping(calls, options):
+    """
+    Make `calls` (again and again) until at least `require_overlap` of
+    them were running at the same time.
+
+    Returns:
+        List[Tuple[int, SubprocessRun]]: (index in `calls`, run) in order
+            of completion, for the attempt which overlapped enough
+
+    Raises:
+        errors.InsufficientOverlapError
+    """
+    _check_require_overlap(calls, options)
+    for _ in range(REQUIRE_OVERLAP_ATTEMPTS):
+        indexed_runs = list(_iter_runs(calls, options))
+        if _overlapped_enough([run for _, run in indexed_runs], options):
+            return indexed_runs
+    raise _overlap_error(options)
+
+
+def _overlap_error(options):
+    return errors.InsufficientOverlapError(
+        'Calls did not overlap {required} at a time in {attempts} '
+        'attempts'.format(
+            required=options.require_overlap,
+            attempts=REQUIRE_OVERLAP_ATTEMPTS,
+        )
+    )
+
+
+def _iter_results(runs, options):
+    for index, run in runs:
+        if options.on_result is not None:
+            options.on_result(index, run.result)
+        yield index, run if options.return_runs else run.result
+
+
+def make_concurrent_calls(*calls, **options):
     """
     If you need to make multiple concurrent calls, potentially to
     different functions, or with different kwargs each time.
@@ -41,21 +296,112 @@ def make_concurrent_calls(*calls):
         *calls (Iterable[Union[function, str], dict]) - list of
             (func or func path, kwargs) tuples to call concurrently
 
+    Kwargs:
+        mode (Optional[str]): how to execute the calls, one of
+            'subprocess' - a fresh `manage.py` process per call
+            'pool' - long-lived workers, see `django_concurrent_tests.pool`
+            'forkserver' - a process forked per call from a pre-initialised
+                Django process, see `django_concurrent_tests.forkserver`
+            'threads' - a thread of the current process per call, see
+                `django_concurrent_tests.threads`
+            (defaults to `utils.get_mode()`)
+        barrier (bool): whether to hold back every call until all of them
+            are set up and ready, then release them together, so that they
+            really overlap (default: True)
+        on_result (Optional[Callable[[int, Any], None]]): called with
+            (index in `calls`, return value) as soon as each call completes
+        timeout (Float): seconds after which a call is terminated, its
+            result is then a `WrappedError` of `TerminatedProcessError`
+            (default: the `DJANGO_CONCURRENT_TESTS_TIMEOUT` env var, or 30)
+        total_timeout (Optional[Float]): seconds by which all of the calls
+            must be done, any still running are then terminated and any
+            not started yet fail with `DeadlineExceededError`
+        max_workers (Optional[int]): never run more than this many calls
+            (i.e. processes) at once, the rest wait for a free slot
+        batch_size (Optional[int]): start the calls in batches of this
+            many, each batch held at its own start barrier, a new batch is
+            started as soon as there's room for it within `max_workers`
+            (default: `max_workers`, or else all calls in one batch)
+        return_runs (bool): return a `SubprocessRun` for each call instead
+            of just its return value (`<SubprocessRun>.result`), e.g. to
+            look at its `<SubprocessRun>.metrics` (see
+            `metrics.CallMetrics`)
+        require_overlap (Optional[int]): make the calls again (up to
+            `REQUIRE_OVERLAP_ATTEMPTS` times) until at least this many of
+            them were running their function at the same time, else raise
+            `InsufficientOverlapError` (see `metrics.get_overlap`)...
+            NOTE: the calls must be safe to repeat, and `on_result` is
+            only called for the attempt which is returned
+        switch_interval (Optional[Float]): while the calls are running,
+            have the threads of this process switch every this many
+            seconds (see `utils.override_switch_interval`) instead of
+            every 5ms... so that calls in 'threads' mode interleave more
+            often, and races between them show up sooner (see
+            `metrics.get_context_switches`)
+
     Returns:
         List[Any] - return values from each call in `calls`
             (results are returned in same order as supplied)
     """
-    pool = Pool(len(calls))
-    futures = []
-    for func, kwargs in calls:
-        futures.append(
-            pool.apply_async(run_in_subprocess, args=(func,), kwds=kwargs)
-        )
-    pool.close()
-    pool.join()
-    # add a bit of extra timeout to allow process terminate cleanup to run
-    # (because we also have an inner timeout on our ProcessManager thread join)
-    return [
-        future.get(timeout=SUBPROCESS_TIMEOUT + 2).result
-        for future in futures
-    ]
+    options = _pop_options(options)
+    if options.require_overlap:
+        runs = _run_overlapping(calls, options)
+    else:
+        runs = _iter_runs(calls, options)
+    results = [None] * len(calls)
+    for index, result in _iter_results(runs, options):
+        results[index] = result
+    return results
+
+
+RaceHunt = namedtuple('RaceHunt', ['found', 'iterations', 'results', 'upper_bound'])
+
+
+def hunt_race(calls, check, max_iterations=100, confidence=0.95, reset=None, **options):
+    """
+    Make the same concurrent `calls` again and again, until `check` says
+    the race condition you are looking for showed up, or `max_iterations`
+    went by without it... a race which only shows up some of the time
+    then fails (or passes) your test reliably, rather than needing reruns.
+
+    Unless you say otherwise, the calls are made by warm workers (in the
+    'pool' mode), so each iteration only costs the calls themselves.
+
+    Args:
+        calls (Iterable[Union[function, str], dict]) - list of
+            (func or func path, kwargs) tuples to call concurrently
+        check (Callable[[List[Any]], bool]): called in the test process
+            with the results of each iteration (as from
+            `make_concurrent_calls`), returns False if they show the race,
+            e.g. if a counter in the db is not what it should be
+
+    Kwargs:
+        max_iterations (int): give up looking after this many iterations
+        confidence (Float): for `upper_bound`, between 0 and 1
+        reset (Optional[Callable[[], None]]): called in the test process
+            before each iteration, e.g. to put the db state which the
+            calls change back as it was
+        **options: as for `make_concurrent_calls`
+
+    Returns:
+        RaceHunt: `found` - whether `check` failed, `iterations` - how many
+            iterations were made, `results` - of the last iteration,
+            `upper_bound` - if not found, with `confidence` the chance of
+            the race showing up in any one iteration is at most this
+            (1 - (1 - confidence) ** (1 / iterations)), else None
+    """
+    if max_iterations < 1:
+        raise ValueError('max_iterations must be at least 1')
+    if not 0 < confidence < 1:
+        raise ValueError('confidence must be between 0 and 1')
+    calls = list(calls)
+    options.setdefault('mode', 'pool')
+    for iteration in range(1, max_iterations + 1):
+        if reset is not None:
+            reset()
+        results = make_concurrent_calls(*calls, **options)
+        if not check(results):
+            logger.info('Race found in iteration {iteration}'.format(iteration=iteration))
+            return RaceHunt(True, iteration, results, None)
+    upper_bound = 1 - (1 - confidence) ** (1.0 / max_iterations)
+    return RaceHunt(False, max_iterations, results, upper_bound)
@@ -0,0 +1,145 @@
+"""
+Constant memory, mergeable histogram of latencies, after HdrHistogram.
+
+Values are counted in buckets whose width grows with the value, so that
+every value is known to within a fixed relative precision, from
+microseconds to hours, in a few thousand counters. Each worker fills its
+own histogram and sends it to the parent once, at the end (see
+`load.load_loop`), and the parent merges them to get percentiles across
+all workers.
+"""
+from __future__ import division
+import math
+from array import array
+
+
+class Histogram(object):
+    """
+    Counts in bucket `b` (0-based) are at a resolution of `lowest * 2**b`,
+    with `2**sub_bucket_bits` counters per bucket (only the top half of
+    which are used above bucket 0, the bottom half being covered by the
+    buckets below).
+
+    Attributes:
+        count (int): how many values were recorded
+        max (Optional[Float]): the largest value recorded (exactly)
+    """
+
+    def __init__(self, lowest=1e-6, highest=3600, significant_digits=2):
+        """
+        Kwargs:
+            lowest (Float): smallest value to tell apart from zero (e.g.
+                one microsecond, for latencies in seconds)
+            highest (Float): largest value to track, larger values are
+                counted as `highest`
+            significant_digits (int): values are known to within
+                `10 ** -significant_digits` of their value
+        """
+        if lowest <= 0 or highest <= lowest:
+            raise ValueError('Need 0 < lowest < highest')
+        self.lowest = lowest
+        self.highest = highest
+        self.significant_digits = significant_digits
+        self.sub_bucket_bits = int(math.ceil(
+            math.log(2 * 10 ** significant_digits, 2)
+        ))
+        self._highest_units = int(highest / lowest)
+        self.counts = array('L', [0]) * (self._index(self._highest_units) + 1)
+        self.count = 0
+        self.max = None
+
+    def _index(self, units):
+        bucket = max(units.bit_length() - self.sub_bucket_bits, 0)
+        return (bucket << (self.sub_bucket_bits - 1)) + (units >> bucket)
+
+    def _upper_bound(self, index):
+        """
+        Returns:
+            Float: all values counted by `self.counts[index]` are below this
+        """
+        bucket = max((index >> (self.sub_bucket_bits - 1)) - 1, 0)
+        sub_bucket = index - (bucket << (self.sub_bucket_bits - 1))
+        return ((sub_bucket + 1) << bucket) * self.lowest
+
+    def record(self, value, count=1):
+        """
+        Args:
+            value (Float): e.g. a latency in seconds
+            count (int): how many times to count it
+        """
+        units = min(max(int(value / self.lowest), 0), self._highest_units)
+        self.counts[self._index(units)] += count
+        self.count += count
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _check_compatible(self, other):
+        if (other.lowest, other.highest, other.significant_digits) != (
+                self.lowest, self.highest, self.significant_digits):
+            raise ValueError("Can't merge histograms with different buckets")
+
+    def merge(self, other):
+        """
+        Add the counts of `other`, which must have the same buckets.
+
+        Returns:
+            Histogram: self
+        """
+        self._check_compatible(other)
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        return self
+
+    def percentiles(self, percents):
+        """
+        All of `percents` in a single pass over the counts.
+
+        Args:
+            percents (Iterable[Float]): e.g. `[50, 90, 99]`
+
+        Returns:
+            List[Optional[Float]]: for each of `percents`, the value which
+                at least that percent of the recorded values are less than
+                or equal to (nearest rank, rounded up to within the
+                precision of the histogram, but never more than `max`),
+                None if nothing was recorded
+        """
+        percents = list(percents)
+        values = [None] * len(percents)
+        if not self.count:
+            return values
+        # (rank, position in `percents`) in order of rank
+        ranks = sorted(
+            (max(int(math.ceil(percent / 100 * self.count)), 1), position)
+            for position, percent in enumerate(percents)
+        )
+        pending = iter(ranks)
+        rank, position = next(pending)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            seen += count
+            # (the last values may have been above `highest`)
+            value = self.max if seen == self.count else min(
+                self._upper_bound(index), self.max
+            )
+            while rank <= seen:
+                values[position] = value
+                try:
+                    rank, position = next(pending)
+                except StopIteration:
+                    return values
+        return values
+
+    def percentile(self, percent):
+        """
+        Returns:
+            Optional[Float]: see `percentiles`
+        """
+        return self.percentiles([percent])[0]
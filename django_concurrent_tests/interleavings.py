@@ -0,0 +1,470 @@
+"""
+Controlled interleaving of concurrent calls, at their db queries.
+
+Rather than make the calls at the same time and hope that their queries
+interleave badly (see `helpers.hunt_race`), we let one call at a time run,
+from one query to the next, and choose which call goes next. Each such
+order of the queries is a schedule: we make the calls once per schedule,
+until the user's `check` of the results fails, and then report the
+schedule which broke it. Races like a read-modify-write over two queries
+then show up in a handful of deterministic runs, rather than by luck.
+
+Schedules are either enumerated systematically, those with the fewest
+preemptions first (a call which could have carried on being held back for
+another), as most races need only one or two of them... or sampled at
+random with PCT (Probabilistic Concurrency Testing, Burckhardt et al.),
+which finds a race needing `depth - 1` preemptions with a known probability.
+
+The calls are made in 'threads' mode (see `threads`): the scheduler holds
+their threads at each query via Django's `execute_wrapper` (or, before
+Django 2.0, by wrapping the cursors of their connections).
+"""
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial, wraps
+
+import django
+import six
+from django.db import connections
+
+from .helpers import make_concurrent_calls
+from .utils import import_function
+
+
+logger = logging.getLogger(__name__)
+
+
+# seconds a call may take from one query to the next before we assume it's
+# waiting for a db lock held by another call, and let the others go ahead
+STEP_TIMEOUT = 1
+
+STRATEGIES = ('systematic', 'pct')
+
+# states of a call
+STARTING = 'starting'
+WAITING = 'waiting'
+RUNNING = 'running'
+BLOCKED = 'blocked'
+DONE = 'done'
+
+
+Step = namedtuple('Step', ['call_index', 'sql'])
+
+Interleaving = namedtuple(
+    'Interleaving', ['found', 'schedules', 'schedule', 'results', 'exhausted'],
+)
+
+
+class _WrappedCursor(object):
+    """
+    A cursor whose queries go through `wrapper` first, as with Django's
+    `execute_wrapper`, for Django < 2.0 which doesn't have it.
+    """
+
+    def __init__(self, cursor, wrapper, connection):
+        self._cursor = cursor
+        self._wrapper = wrapper
+        self._context = {'connection': connection, 'cursor': cursor}
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _execute(self, sql, params, many, context):
+        if many:
+            return self._cursor.executemany(sql, params)
+        return self._cursor.execute(sql, params)
+
+    def execute(self, sql, params=None):
+        return self._wrapper(self._execute, sql, params, False, self._context)
+
+    def executemany(self, sql, param_list):
+        return self._wrapper(self._execute, sql, param_list, True, self._context)
+
+
+@contextmanager
+def _wrapping_cursors(connection, wrapper):
+    """
+    Have `wrapper` wrap the queries of every cursor `connection` hands out
+    meanwhile (of the current thread, as `connection` is its own).
+    """
+    cursor = connection.cursor
+
+    @wraps(cursor)
+    def wrapped_cursor(*args, **kwargs):
+        return _WrappedCursor(cursor(*args, **kwargs), wrapper, connection)
+
+    connection.cursor = wrapped_cursor
+    try:
+        yield
+    finally:
+        del connection.cursor
+
+
+@contextmanager
+def _wrapping_queries(wrapper):
+    """
+    Have `wrapper` wrap every query of the current thread meanwhile, on any
+    of its connections (see `execute_wrapper` of Django's db connections).
+    """
+    entered = []
+    try:
+        for alias in connections:
+            if django.VERSION < (2, 0):
+                # (no `execute_wrapper`)
+                manager = _wrapping_cursors(connections[alias], wrapper)
+            else:
+                manager = connections[alias].execute_wrapper(wrapper)
+            manager.__enter__()
+            entered.append(manager)
+        yield
+    finally:
+        for manager in reversed(entered):
+            manager.__exit__(None, None, None)
+
+
+class Scheduler(object):
+    """
+    Lets one call at a time run, from the start of the call to its first
+    query and from each query to the next, choosing which call goes next.
+
+    The calls hand over to each other, there's no thread of our own: a call
+    which reaches its next query (or returns) makes the next choice once
+    every other call is waiting for its turn too.
+    """
+
+    def __init__(self, parties, choose, step_timeout=STEP_TIMEOUT):
+        """
+        Kwargs:
+            parties (int): number of calls
+            choose (Callable[[List[int], Optional[int]], int]): given the
+                indexes of the calls waiting for their turn and of the call
+                which had the last one (if any), returns the index of the
+                call to go next
+            step_timeout (Float): see `STEP_TIMEOUT`
+        """
+        self.step_timeout = step_timeout
+        self.steps = []  # List[Step], in the order they were taken
+        self._choose = choose
+        self._cond = threading.Condition()
+        self._states = [STARTING] * parties
+        self._queries = [None] * parties
+        self._running = None
+        self._last = None
+        self._progress_at = time.time()
+        self._closed = False
+
+    def wrap(self, index, f):
+        """
+        Returns:
+            function: calls `f` with the scheduler in control of call
+                `index`, to make in a thread (see `threads.ThreadCall`)
+        """
+        @wraps(f)
+        def call(**kwargs):
+            with _wrapping_queries(partial(self._before_query, index)):
+                self.wait_turn(index)
+                try:
+                    return f(**kwargs)
+                finally:
+                    self.done(index)
+        return call
+
+    def _before_query(self, index, execute, sql, params, many, context):
+        self.wait_turn(index, sql)
+        return execute(sql, params, many, context)
+
+    def wait_turn(self, index, sql=None):
+        """
+        Block call `index` until it's chosen to go next.
+
+        Args:
+            sql (Optional[str]): the query it's about to make, if any
+        """
+        with self._cond:
+            self._states[index] = WAITING
+            self._queries[index] = sql
+            if self._running == index:
+                self._running = None
+            self._progress_at = time.time()
+            while not self._closed:
+                self._schedule()
+                if self._running == index:
+                    return
+                self._cond.wait(self.step_timeout / 10.0)
+
+    def done(self, index):
+        with self._cond:
+            self._states[index] = DONE
+            if self._running == index:
+                self._running = None
+            self._progress_at = time.time()
+            self._schedule()
+
+    def close(self):
+        """
+        Let any call still waiting go, e.g. once the calls timed out.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _schedule(self):
+        now = time.time()
+        stalled = now - self._progress_at >= self.step_timeout
+        if self._running is not None:
+            if not stalled:
+                return
+            # (e.g. waiting for a lock held by a call which is waiting for
+            # its turn)
+            logger.debug('Call {index} blocked'.format(index=self._running))
+            self._states[self._running] = BLOCKED
+            self._running = None
+        if STARTING in self._states:
+            if not stalled:
+                return
+            # (e.g. failed before it even got to the function)
+            self._states = [
+                BLOCKED if state == STARTING else state for state in self._states
+            ]
+        waiting = [
+            index for index, state in enumerate(self._states) if state == WAITING
+        ]
+        if not waiting:
+            return
+        index = self._choose(waiting, self._last)
+        self._states[index] = RUNNING
+        self._running = self._last = index
+        self.steps.append(Step(index, self._queries[index]))
+        self._progress_at = now
+        self._cond.notify_all()
+
+
+def _is_preemption(waiting, last, choice):
+    # (the last call could have carried on, but another was chosen)
+    return last in waiting and choice != last
+
+
+class SystematicSearch(object):
+    """
+    Enumerates the schedules of the calls, those with the fewest
+    preemptions first, up to `max_preemptions`.
+
+    Each schedule is a prefix of choices to make, after which the call
+    which had the last turn carries on for as long as it can. Once it has
+    been run, every other choice it could have made after its prefix is
+    queued up as a new prefix... so no schedule is run twice.
+    """
+
+    def __init__(self, max_preemptions):
+        self.max_preemptions = max_preemptions
+        # prefixes to run, by number of preemptions
+        self._queues = [[[]]] + [[] for _ in range(max_preemptions)]
+        self._prefix = None
+        self._decisions = []
+
+    @property
+    def exhausted(self):
+        return not any(self._queues)
+
+    def next_schedule(self):
+        """
+        Returns:
+            bool: whether there's another schedule to run
+        """
+        for queue in self._queues:
+            if queue:
+                self._prefix = queue.pop(0)
+                self._decisions = []
+                return True
+        return False
+
+    def choose(self, waiting, last):
+        position = len(self._decisions)
+        choice = last if last in waiting else waiting[0]
+        if position < len(self._prefix):
+            if self._prefix[position] in waiting:
+                choice = self._prefix[position]
+            else:
+                # the calls don't make the same queries every time
+                logger.debug('Schedule diverged at step {position}'.format(
+                    position=position,
+                ))
+        self._decisions.append((waiting, last, choice))
+        return choice
+
+    def finish_schedule(self):
+        choices = [choice for _, _, choice in self._decisions]
+        preemptions = 0
+        for position, (waiting, last, choice) in enumerate(self._decisions):
+            if position >= len(self._prefix):
+                for alternative in waiting:
+                    if alternative == choice:
+                        continue
+                    count = preemptions + _is_preemption(waiting, last, alternative)
+                    if count <= self.max_preemptions:
+                        self._queues[count].append(choices[:position] + [alternative])
+            preemptions += _is_preemption(waiting, last, choice)
+
+
+class PCTSearch(object):
+    """
+    Samples schedules at random, with PCT: the calls get random priorities
+    and the highest priority call waiting goes next, except that at
+    `depth - 1` random steps the call about to go is demoted below all
+    others. A race which needs `depth - 1` preemptions is then found in each
+    schedule with probability at least 1 / (calls * steps ** (depth - 1)).
+    """
+
+    exhausted = False
+
+    def __init__(self, parties, depth, seed=None):
+        self.parties = parties
+        self.depth = depth
+        self._random = random.Random(seed)
+        # (estimated from the schedules run so far)
+        self._steps = 2 * parties
+        self._priorities = None
+        self._change_points = None
+        self._step = 0
+
+    def next_schedule(self):
+        priorities = list(range(self.depth, self.depth + self.parties))
+        self._random.shuffle(priorities)
+        self._priorities = priorities
+        points = self._random.sample(
+            range(1, max(self._steps, self.depth) + 1), self.depth - 1,
+        )
+        # demoted to priorities below those of all calls
+        self._change_points = dict(
+            (point, priority) for priority, point in enumerate(points, 1)
+        )
+        self._step = 0
+        return True
+
+    def choose(self, waiting, last):
+        self._step += 1
+        choice = max(waiting, key=self._priorities.__getitem__)
+        if self._step in self._change_points:
+            self._priorities[choice] = self._change_points[self._step]
+            choice = max(waiting, key=self._priorities.__getitem__)
+        return choice
+
+    def finish_schedule(self):
+        self._steps = max(self._steps, self._step)
+
+
+def format_schedule(schedule):
+    """
+    Args:
+        schedule (List[Step]): e.g. `Interleaving.schedule`
+
+    Returns:
+        str: one line per step
+    """
+    return '\n'.join(
+        'call {index}: {sql}'.format(
+            index=step.call_index,
+            sql='(start)' if step.sql is None else step.sql,
+        )
+        for step in schedule
+    )
+
+
+def explore_interleavings(
+        calls, check, strategy='systematic', max_schedules=100,
+        max_preemptions=2, depth=2, seed=None, reset=None,
+        step_timeout=STEP_TIMEOUT, **options):
+    """
+    Make the same concurrent `calls` once per schedule of their db queries
+    (see the module docstring), until `check` says a schedule broke them,
+    or we ran out of schedules.
+
+    Args:
+        calls (Iterable[Union[function, str], dict]) - list of
+            (func or func path, kwargs) tuples to call concurrently
+        check (Callable[[List[Any]], bool]): called in the test process
+            with the results of each schedule (as from
+            `make_concurrent_calls`), returns False if they show the race
+
+    Kwargs:
+        strategy (str): 'systematic' to enumerate the schedules, fewest
+            preemptions first, or 'pct' to sample them at random
+        max_schedules (int): give up after this many schedules
+        max_preemptions (int): for 'systematic', leave out schedules with
+            more preemptions than this
+        depth (int): for 'pct', the number of preemptions (plus one) the
+            race is expected to need
+        seed (Optional[int]): for 'pct', to sample the same schedules again
+        reset (Optional[Callable[[], None]]): called in the test process
+            before each schedule, e.g. to put the db state which the calls
+            change back as it was
+        step_timeout (Float): see `STEP_TIMEOUT`
+        **options: as for `make_concurrent_calls`, in 'threads' mode
+
+    Returns:
+        Interleaving: `found` - whether `check` failed, `schedules` - how
+            many schedules were run, `schedule` - if found, the `Step`s of
+            the schedule which broke it (see `format_schedule`), `results` -
+            of the last schedule, `exhausted` - whether every schedule
+            within `max_preemptions` was run
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            'Invalid strategy {strategy!r}, expected one of: {strategies}'.format(
+                strategy=strategy, strategies=', '.join(STRATEGIES),
+            )
+        )
+    if max_schedules < 1:
+        raise ValueError('max_schedules must be at least 1')
+    if max_preemptions < 0:
+        raise ValueError('max_preemptions must not be negative')
+    if depth < 1:
+        raise ValueError('depth must be at least 1')
+    if options.setdefault('mode', 'threads') != 'threads':
+        raise ValueError("Interleavings can only be explored in 'threads' mode")
+    calls = [
+        (import_function(f) if isinstance(f, six.string_types) else f, kwargs)
+        for f, kwargs in calls
+    ]
+    if strategy == 'pct':
+        search = PCTSearch(len(calls), depth, seed=seed)
+    else:
+        search = SystematicSearch(max_preemptions)
+
+    schedules = 0
+    results = None
+    while schedules < max_schedules and search.next_schedule():
+        schedules += 1
+        if reset is not None:
+            reset()
+        scheduler = Scheduler(len(calls), search.choose, step_timeout=step_timeout)
+        try:
+            results = make_concurrent_calls(
+                *[
+                    (scheduler.wrap(index, f), kwargs)
+                    for index, (f, kwargs) in enumerate(calls)
+                ],
+                **options
+            )
+        finally:
+            scheduler.close()
+        search.finish_schedule()
+        if not check(results):
+            logger.info('Race found in schedule {schedules}:\n{schedule}'.format(
+                schedules=schedules, schedule=format_schedule(scheduler.steps),
+            ))
+            return Interleaving(True, schedules, scheduler.steps, results, False)
+    return Interleaving(False, schedules, None, results, search.exhausted)
@@ -0,0 +1,133 @@
+"""
+Sustained load: each of a number of concurrent workers calls a function
+over and over for a while, and we report on all of those calls together
+(throughput, error rate, latency percentiles) rather than on each one.
+
+Each worker is a single call made by the usual helpers, in any execution
+mode, of `load_loop`. The loop runs in the worker process itself, so
+there's no round trip to the test process between the calls, and the
+latencies come back as one fixed size `histogram.Histogram` per worker.
+"""
+from __future__ import division
+from collections import namedtuple
+
+from .errors import WrappedError
+from .helpers import make_concurrent_calls
+from .histogram import Histogram
+from .metrics import monotonic
+from .utils import get_function_path, import_function, SUBPROCESS_TIMEOUT
+
+
+LoadReport = namedtuple(
+    'LoadReport',
+    [
+        'calls',
+        'errors',
+        'throughput',
+        'error_rate',
+        'p50',
+        'p90',
+        'p99',
+        'max',
+    ],
+)
+
+
+def load_loop(function_path, kwargs, duration, warmup):
+    """
+    Call the function again and again, in the process of a worker, for
+    `warmup` + `duration` seconds.
+
+    Args:
+        function_path (str): 'dotted module.path.to:function'
+        kwargs (dict): kwargs to pass to the function
+        duration (Float): seconds during which calls are measured
+        warmup (Float): seconds to call the function for beforehand,
+            without measuring
+
+    Returns:
+        Tuple[Histogram, int]: latencies in seconds of the measured calls
+            which didn't raise, and how many measured calls raised
+    """
+    f = import_function(function_path)
+    latencies = Histogram()
+    errors = 0
+    measure_from = monotonic() + warmup
+    measure_until = measure_from + duration
+    while True:
+        start = monotonic()
+        if start >= measure_until:
+            break
+        try:
+            f(**kwargs)
+        except Exception:
+            if start >= measure_from:
+                errors += 1
+            continue
+        if start >= measure_from:
+            latencies.record(monotonic() - start)
+    return latencies, errors
+
+
+def run_load(concurrency, function, duration=60, warmup=0, **kwargs):
+    """
+    Call `function` in a loop from each of `concurrency` concurrent
+    workers, all starting together, for `warmup` seconds and then for
+    another `duration` seconds, during which the calls are measured.
+
+    Args:
+        concurrency (int): how many workers
+        function (Union[function, str]): the function to call, or
+            the 'dotted module.path.to:function' as a string
+        duration (Float): seconds to measure the calls for
+        warmup (Float): seconds to call `function` for beforehand, without
+            measuring (e.g. for caches and connections to warm up)
+        **kwargs: kwargs to pass to `function`
+
+    Returns:
+        LoadReport: for the calls made after the warm-up, `calls` - how
+            many, `errors` - how many of them raised, `throughput` - calls
+            per second across all workers, `error_rate` - fraction of the
+            calls which raised, `p50`, `p90`, `p99`, `max` - latency
+            percentiles in seconds of the calls which didn't raise, to
+            within 1% (see `histogram.Histogram`, None if there were none)
+
+    NOTE:
+        the workers are made in the default execution mode (see
+        `utils.get_mode`), and if any of them fails as a whole, e.g. it
+        couldn't import `function`, its error is raised
+    """
+    if duration <= 0:
+        raise ValueError('duration must be positive')
+    if warmup < 0:
+        raise ValueError('warmup must not be negative')
+    loop_kwargs = {
+        'function_path': get_function_path(function),
+        'kwargs': kwargs,
+        'duration': duration,
+        'warmup': warmup,
+    }
+    results = make_concurrent_calls(
+        *[(load_loop, loop_kwargs)] * concurrency,
+        timeout=warmup + duration + SUBPROCESS_TIMEOUT
+    )
+    latencies = Histogram()
+    errors = 0
+    for result in results:
+        if isinstance(result, WrappedError):
+            result.reraise()
+        worker_latencies, worker_errors = result
+        latencies.merge(worker_latencies)
+        errors += worker_errors
+    calls = latencies.count + errors
+    p50, p90, p99 = latencies.percentiles([50, 90, 99])
+    return LoadReport(
+        calls=calls,
+        errors=errors,
+        throughput=calls / duration,
+        error_rate=errors / calls if calls else 0.0,
+        p50=p50,
+        p90=p90,
+        p99=p99,
+        max=latencies.max,
+    )
@@ -1,15 +1,19 @@
 from __future__ import print_function
 
 import json
+import os
 import sys
+import threading
+import time
 import traceback
 import warnings
+from contextlib import contextmanager
 from functools import partial
-from importlib import import_module
 from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends.signals import connection_created
 from django.test.utils import setup_test_environment
 try:
     # Django 1.4
@@ -22,13 +26,29 @@ except ImportError:
         # Django 1.11+
         from django.test.utils import dependency_ordered
 
-from ... import b64pickle, errors
-from ...utils import redirect_stdout
+from ... import b64pickle, binpickle, errors, payload
+from ...barrier import wait_for_start
+from ...metrics import call_timing, monotonic
+from ...output import install_log_handler
+from ...transport import read_frame, write_frame
+from ...utils import (
+    _get_test_mirror,
+    import_function,
+    redirect_stdout,
+    TEST_DATABASES_ENV,
+)
 
 
-def use_test_databases():
+def resolve_test_databases():
     """
+    Work out the test dbs from our settings, for when we were not started
+    by a parent test run (see `utils.get_test_databases`).
+
     Adapted from DjangoTestSuiteRunner.setup_databases
+
+    Returns:
+        Dict[str, Dict[str, str]]: alias -> `{'NAME': test db name}`, plus
+            the `'MIRROR'` alias for test mirrors
     """
     # First pass -- work out which databases connections need to be switched
     # and which ones are test mirrors or duplicate entries in DATABASES
@@ -37,7 +57,7 @@ def use_test_databases():
     dependencies = {}
     for alias in connections:
         connection = connections[alias]
-        test_mirror = connection.settings_dict.get('TEST_MIRROR')
+        test_mirror = _get_test_mirror(connection.settings_dict)
         if test_mirror:
             # If the database is marked as a test mirror, save
             # the alias.
@@ -60,14 +80,12 @@ def use_test_databases():
                     dependencies[alias] = connection.settings_dict.get(
                         'TEST_DEPENDENCIES', [DEFAULT_DB_ALIAS])
 
-    # Second pass -- switch the databases to use test db settings.
+    # Second pass -- the test db names
+    databases = {}
     for signature, (db_name, aliases) in dependency_ordered(
             test_databases.items(), dependencies):
-        # get test db name from the first connection
-        connection = connections[aliases[0]]
         for alias in aliases:
-            connection = connections[alias]
-            test_db_name = connection.creation._get_test_db_name()
+            test_db_name = connections[alias].creation._get_test_db_name()
             # NOTE: if using sqlite for tests, be sure to specify a
             # TEST_NAME / TEST:NAME with a real filename to avoid using
             # in-memory db
@@ -81,23 +99,48 @@ def use_test_databases():
                     "test processes. "
                     "{parent} -> {test}".format(parent=db_name, test=test_db_name)
                 )
-            # we are running late in Django life-cycle so it has already
-            # opened connections to default db, need to close and re-open
-            # against test db:
-            connection.close()
-            connection.settings_dict['NAME'] = test_db_name
-            connection.cursor()
+            databases[alias] = {'NAME': test_db_name}
 
     for alias, mirror_alias in mirrored_aliases.items():
-        # we are running late in Django life-cycle so it has already
-        # opened connections to default db, need to close and re-open
-        # against test mirror db:
+        databases[alias] = {
+            'NAME': databases[mirror_alias]['NAME'],
+            'MIRROR': mirror_alias,
+        }
+    return databases
+
+
+def use_test_databases():
+    """
+    Switch our connections to the test dbs of the parent test run, as
+    passed on by the parent (see `utils.get_test_databases_env`), or else
+    as worked out by `resolve_test_databases`.
+
+    Connections are (re-)opened lazily, on first use... so only to the
+    dbs the call actually uses.
+    """
+    encoded = os.environ.get(TEST_DATABASES_ENV)
+    if encoded:
+        databases = json.loads(encoded)
+    else:
+        databases = resolve_test_databases()
+    for alias, database in databases.items():
+        if alias not in connections:
+            continue
         connection = connections[alias]
+        # in case it's open already, against the non-test db
         connection.close()
-        connection.settings_dict['NAME'] = (
-            connections[mirror_alias].settings_dict['NAME'])
-        connection.features = connections[mirror_alias].features
-        connection.cursor()
+        connection.settings_dict['NAME'] = database['NAME']
+        if database.get('MIRROR'):
+            connection.features = connections[database['MIRROR']].features
+
+
+def open_db_connections():
+    """
+    Connect (and warm up a cursor) up front, so that our first query
+    doesn't pay for it.
+    """
+    for alias in connections:
+        connections[alias].cursor().close()
 
 
 def close_db_connections():
@@ -106,6 +149,178 @@ def close_db_connections():
         connection.close()
 
 
+def count_open_db_connections():
+    return sum(connections[alias].connection is not None for alias in connections)
+
+
+def _rollback_open_transaction(connection):
+    """
+    Roll back a transaction opened behind Django's back (e.g. by a raw
+    `BEGIN`), which it doesn't know about in autocommit mode.
+    """
+    raw = connection.connection
+    if hasattr(raw, 'get_transaction_status'):
+        # psycopg2, whose `rollback` does nothing in autocommit mode
+        if raw.get_transaction_status() != 0:  # TRANSACTION_STATUS_IDLE
+            cursor = raw.cursor()
+            try:
+                cursor.execute('ROLLBACK')
+            finally:
+                cursor.close()
+    elif getattr(raw, 'in_transaction', True):
+        # (sqlite3 can tell us, for the others roll back regardless)
+        raw.rollback()
+
+
+def _reset_db_connection(connection):
+    if not hasattr(connection, 'in_atomic_block') or connection.in_atomic_block:
+        # Django < 1.6, or the call left an `atomic` block open: start afresh
+        connection.close()
+        return
+    autocommit = connection.settings_dict.get('AUTOCOMMIT', True)
+    if connection.get_autocommit() != autocommit:
+        # whatever the call didn't commit
+        connection.rollback()
+        connection.set_autocommit(autocommit)
+    if autocommit:
+        _rollback_open_transaction(connection)
+    if not connection.settings_dict.get('CONN_MAX_AGE'):
+        # Django's default of 0 (close after each request) would rule out
+        # the reuse we were asked for: no max age then
+        connection.close_at = None
+    connection.close_if_unusable_or_obsolete()
+
+
+def reset_db_connections():
+    """
+    Instead of closing our db connections after a call, get them ready for
+    the next one (see `worker.execute_job`): roll back anything left
+    uncommitted and close any connection which is no longer usable, or
+    older than its `CONN_MAX_AGE` (if any).
+
+    NOTE:
+        session state set by the call itself (e.g. a postgres `SET`) is
+        kept, as `RESET ALL` would also undo what Django set up on connect
+    """
+    for alias in connections:
+        connection = connections[alias]
+        if connection.connection is None:
+            continue
+        try:
+            _reset_db_connection(connection)
+        except Exception:
+            # e.g. the connection was lost
+            try:
+                connection.close()
+            except Exception:
+                # (Django drops the connection regardless)
+                pass
+
+
+@contextmanager
+def counting_db_connects(metrics):
+    """
+    Count the db connections opened meanwhile (by the current thread), as
+    `metrics['db_connects']`.
+    """
+    metrics['db_connects'] = 0
+    thread = threading.current_thread()
+
+    def on_connect(sender, connection, **kwargs):
+        if threading.current_thread() is thread:
+            metrics['db_connects'] += 1
+
+    connection_created.connect(on_connect, weak=False)
+    try:
+        yield
+    finally:
+        connection_created.disconnect(on_connect)
+
+
+def wrap_error(e):
+    """
+    Print the traceback of `e` (for the log of the parent) and wrap it, to
+    return in place of the result of a call.
+    """
+    _,  _, tb_ = sys.exc_info()
+    traceback.print_tb(tb_)
+    print(repr(e))
+    return errors.WrappedError(e)
+
+
+def dump_result(serialize, result):
+    try:
+        return serialize(result)
+    except Exception as e:
+        # e.g. return value was not pickleable
+        return serialize(errors.WrappedError(e))
+
+
+def write_result(stream, metrics, result):
+    """
+    Send the outcome of a call to the parent: a frame with the pickled
+    metrics, then one with the pickled result (see `payload.dumps`).
+    """
+    result = payload.dumps(result, metrics=metrics)
+    write_frame(stream, binpickle.dumps(metrics))
+    write_frame(stream, result)
+
+
+def make_call(load_call, no_test_db=False, barrier=None):
+    """
+    Make the one call of a process started for it (see `Command` and
+    `worker.main`), against the test dbs of the parent test run.
+
+    Args:
+        load_call (Callable[[], Tuple[function, dict]]): imports the
+            function and reads its kwargs
+
+    Kwargs:
+        no_test_db (bool): stay on the dbs from our settings
+        barrier (Optional[str]): 'READY_FD,GO_FD' inherited from the
+            parent, to wait on before the call (see `barrier.wait_for_start`)
+
+    Returns:
+        Tuple[dict, Any]: metrics of the call and its return value (or a
+            `WrappedError` for whatever went wrong)
+    """
+    install_log_handler()
+    # (for the parent to work out how long we took to boot)
+    metrics = {'started_at': time.time()}
+    # redirect any printing that may occur from stdout->stderr
+    # so as not to pollute our stdout output (we serialize the
+    # return value of func and write it to stdout for capture in
+    # parent process)
+    with redirect_stdout(sys.stderr), counting_db_connects(metrics):
+        try:
+            f, f_kwargs = load_call()
+
+            start = time.time()
+            setup_test_environment()
+            # ensure we're using test dbs, shared with parent test run
+            if not no_test_db:
+                use_test_databases()
+            if barrier:
+                # connect now, so that we all start on an equal footing
+                open_db_connections()
+            metrics['db_setup'] = time.time() - start
+
+            if barrier:
+                ready_fd, go_fd = map(int, barrier.split(','))
+                wait_for_start(ready_fd, go_fd)
+
+            start = monotonic()
+            try:
+                result = f(**f_kwargs)
+            finally:
+                metrics.update(call_timing(start, monotonic()))
+
+            close_db_connections()
+        except Exception as e:
+            result = wrap_error(e)
+    return metrics, result
+
+
 class Command(BaseCommand):
     """
     The goal of this command is to allow us to do actual concurrent requests
@@ -130,15 +345,19 @@ class Command(BaseCommand):
         option_list = BaseCommand.option_list + (
             make_option(
                 '-k', '--kwargs',
-                help='kwargs to request client method call (serialized to ascii)',
+                help='kwargs to request client method call (serialized to ascii), '
+                     'or - to read them from a length-prefixed frame on stdin',
             ),
             make_option(
                 '-s', '--serializer',
                 help='Serialization format',
-                type='choice', choices=('b64pickle', 'json'),
+                type='choice', choices=('b64pickle', 'pickle', 'json'),
                 default='b64pickle',
                 # json is included to have a hand-editable option, which may be
                 # useful if running this command directly (dev use only)
+                # pickle is binary: needs --kwargs=- and the result is written
+                # to stdout as a length-prefixed frame, after a frame with
+                # the metrics of the call
             ),
             make_option(
                 '-t', '--no-test-db',
@@ -147,6 +366,11 @@ class Command(BaseCommand):
             ),
             # (dev use only) if running this command directly, option to use the
             # default dbs created via syncdb instead of dbs from parent test run
+            make_option(
+                '-b', '--barrier',
+                help='READY_FD,GO_FD inherited from parent, wait on these '
+                     'start barrier pipes before calling the function',
+            ),
         )
 
     help = "We use nosetests path format - path.to.module:function_name"
@@ -155,21 +379,30 @@ class Command(BaseCommand):
         # Django >= 1.10
         parser.add_argument(
             '--kwargs', '-k',
-            help='kwargs to request client method call (serialized to ascii)',
+            help='kwargs to request client method call (serialized to ascii), '
+                 'or - to read them from a length-prefixed frame on stdin',
         )
         parser.add_argument(
             '-s', '--serializer',
             help='Serialization format',
-            choices=('b64pickle', 'json'),
+            choices=('b64pickle', 'pickle', 'json'),
             default='b64pickle',
             # json is included to have a hand-editable option, which may be
             # useful if running this command directly (dev use only)
+            # pickle is binary: needs --kwargs=- and the result is written
+            # to stdout as a length-prefixed frame, after a frame with
+            # the metrics of the call
         )
         parser.add_argument(
             '-t', '--no-test-db',
             help="Don't patch connection to use test db",
             action='store_true',
         )
+        parser.add_argument(
+            '-b', '--barrier',
+            help='READY_FD,GO_FD inherited from parent, wait on these '
+                 'start barrier pipes before calling the function',
+        )
         parser.add_argument(
             'funcpath',
             help='path.to.module:function_name'
@@ -180,6 +413,9 @@ class Command(BaseCommand):
         if serializer_name == 'json':
             serialize = partial(json.dumps, ensure_ascii=True)
             deserialize = json.loads
+        elif serializer_name == 'pickle':
+            serialize = binpickle.dumps
+            deserialize = payload.loads
         else:
             # default
             serialize = b64pickle.dumps
@@ -191,46 +427,37 @@ class Command(BaseCommand):
         except KeyError:
             func_path = args[0]
 
-        # redirect any printing that may occur from stdout->stderr
-        # so as not to pollute our stdout output (we serialize the
-        # return value of func and print to stdout for capture in
-        # parent process)
-        with redirect_stdout(sys.stderr):
-            try:
-                if not func_path:
-                    raise CommandError(
-                        'Must supply an import path to function to execute')
-
-                if serializer_name not in ('json', 'b64pickle'):
-                    raise CommandError(
-                        'Invalid --serializer name')
-
-                module_name, function_name = func_path.split(':')
-                module = import_module(module_name)
-                try:
-                    f = getattr(module, function_name)
-                except AttributeError:
-                    print(
-                        "Could not import '{module}.{func}', you may need to use "
-                        "https://github.com/depop/django-concurrent-test-helper/#string-import-paths"
-                        .format(module=module_name, func=function_name)
-                    )
-                    raise
-
-                f_kwargs = deserialize(kwargs['kwargs'] or '{}')
-
-                setup_test_environment()
-                # ensure we're using test dbs, shared with parent test run
-                if not kwargs['no_test_db']:
-                    use_test_databases()
+        def load_call():
+            if not func_path:
+                raise CommandError(
+                    'Must supply an import path to function to execute')
 
-                result = f(**f_kwargs)
+            if serializer_name not in ('json', 'b64pickle', 'pickle'):
+                raise CommandError(
+                    'Invalid --serializer name')
+            if serializer_name == 'pickle' and kwargs['kwargs'] != '-':
+                raise CommandError(
+                    '--serializer=pickle requires --kwargs=-')
 
-                close_db_connections()
-            except Exception as e:
-                _,  _, tb_ = sys.exc_info()
-                traceback.print_tb(tb_)
-                print(repr(e))
-                result = errors.WrappedError(e)
+            f = import_function(func_path)
 
-        print(serialize(result), end='')
+            serialized_kwargs = kwargs['kwargs'] or '{}'
+            if serialized_kwargs == '-':
+                stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+                serialized_kwargs = read_frame(stdin)
+                if serializer_name != 'pickle':
+                    serialized_kwargs = serialized_kwargs.decode('ascii')
+            return f, deserialize(serialized_kwargs)
+
+        metrics, result = make_call(
+            load_call,
+            no_test_db=kwargs['no_test_db'],
+            barrier=kwargs.get('barrier'),
+        )
+
+        output = dump_result(serialize, result)
+        if serializer_name == 'pickle':
+            stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+            write_result(stdout, metrics, output)
+        else:
+            print(output, end='')
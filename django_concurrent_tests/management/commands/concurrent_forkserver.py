@@ -0,0 +1,95 @@
+import gc
+import socket
+import sys
+from importlib import import_module
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment
+
+from ...output import install_log_handler
+from ...transport import write_frame
+from ...worker import serve_forks
+from .concurrent_call_wrapper import close_db_connections, use_test_databases
+
+
+class Command(BaseCommand):
+    """
+    Fork server: initialise Django once, then fork a child process for
+    each call (Django 1.8+ only).
+
+    Before listening we import any modules listed in the
+    `CONCURRENT_TESTS_PRELOAD_MODULES` setting, close all db connections
+    (so that no sockets are shared with the children, each child connects
+    afresh) and, on Python 3.7+, `gc.freeze()` everything, so that memory
+    pages can stay shared copy-on-write with the children. Set
+    `CONCURRENT_TESTS_GC_FREEZE = False` to disable the latter.
+
+    Writes a 'ready' frame to stdout once listening. Exits when stdin is
+    closed.
+
+    You don't need to use this command directly, see
+    `django_concurrent_tests.forkserver`.
+    """
+
+    if hasattr(BaseCommand, 'option_list'):
+        # Django < 1.10
+        option_list = BaseCommand.option_list + (
+            make_option(
+                '-a', '--address',
+                help='Path of the unix socket to listen on',
+            ),
+            make_option(
+                '-t', '--no-test-db',
+                help="Don't patch connection to use test db",
+                action='store_true',
+            ),
+        )
+
+    help = "Fork a process per call, see django_concurrent_tests.forkserver"
+
+    def add_arguments(self, parser):
+        # Django >= 1.10
+        parser.add_argument(
+            '-a', '--address',
+            help='Path of the unix socket to listen on',
+        )
+        parser.add_argument(
+            '-t', '--no-test-db',
+            help="Don't patch connection to use test db",
+            action='store_true',
+        )
+
+    def handle(self, *args, **kwargs):
+        if not kwargs['address']:
+            raise CommandError('Must supply a socket --address')
+
+        install_log_handler()
+        setup_test_environment()
+        # ensure we're using test dbs, shared with parent test run
+        if not kwargs['no_test_db']:
+            use_test_databases()
+
+        for module_name in getattr(settings, 'CONCURRENT_TESTS_PRELOAD_MODULES', ()):
+            import_module(module_name)
+
+        # forked children must not inherit our db sockets
+        close_db_connections()
+
+        if getattr(settings, 'CONCURRENT_TESTS_GC_FREEZE', True) and hasattr(gc, 'freeze'):
+            # Python 3.7+: move everything to the permanent generation so
+            # that gc in the children doesn't touch (and copy) shared pages
+            gc.collect()
+            gc.freeze()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(kwargs['address'])
+        listener.listen(128)
+
+        write_frame(getattr(sys.stdout, 'buffer', sys.stdout), b'ready')
+
+        try:
+            serve_forks(listener, control=sys.stdin)
+        finally:
+            listener.close()
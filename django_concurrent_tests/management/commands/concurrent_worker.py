@@ -0,0 +1,68 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment
+
+from ...output import install_log_handler
+from ...worker import serve
+from .concurrent_call_wrapper import use_test_databases
+
+
+class Command(BaseCommand):
+    """
+    Long-lived counterpart to `concurrent_call_wrapper`.
+
+    Boots Django and switches to the test dbs once, then executes any number
+    of calls sent by the parent test process over stdin, writing each result
+    to stdout. Exits when stdin is closed.
+
+    With `--reuse-db-connections` db connections are kept open between
+    calls, else each call connects afresh.
+
+    You don't need to use this command directly, see
+    `django_concurrent_tests.pool`.
+    """
+
+    if hasattr(BaseCommand, 'option_list'):
+        # Django < 1.10
+        option_list = BaseCommand.option_list + (
+            make_option(
+                '-t', '--no-test-db',
+                help="Don't patch connection to use test db",
+                action='store_true',
+            ),
+            make_option(
+                '-r', '--reuse-db-connections',
+                help='Keep db connections open from one call to the next',
+                action='store_true',
+            ),
+        )
+
+    help = "Execute calls sent over stdin, see django_concurrent_tests.pool"
+
+    def add_arguments(self, parser):
+        # Django >= 1.10
+        parser.add_argument(
+            '-t', '--no-test-db',
+            help="Don't patch connection to use test db",
+            action='store_true',
+        )
+        parser.add_argument(
+            '-r', '--reuse-db-connections',
+            help='Keep db connections open from one call to the next',
+            action='store_true',
+        )
+
+    def handle(self, *args, **kwargs):
+        install_log_handler()
+        setup_test_environment()
+        # ensure we're using test dbs, shared with parent test run
+        if not kwargs['no_test_db']:
+            use_test_databases()
+
+        serve(
+            infile=getattr(sys.stdin, 'buffer', sys.stdin),
+            outfile=getattr(sys.stdout, 'buffer', sys.stdout),
+            reuse_db_connections=kwargs['reuse_db_connections'],
+        )
@@ -0,0 +1,247 @@
+"""
+Where the seconds (and the memory) of a concurrent call go.
+
+The parent measures what it can see from outside, e.g. how long it took
+to spawn the process, and the process making the call measures the rest
+and sends it back along with the result (see `worker.execute_job`).
+"""
+import resource
+import sys
+import time
+from collections import namedtuple
+
+
+# clock for timestamps which are comparable between the processes on this
+# machine, and don't jump with the wall clock (Python 3.3+)
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class CallMetrics(object):
+    """
+    Timing and resource usage of a single call. Any of these is None where
+    it doesn't apply to the execution mode, or the call didn't get that far.
+
+    Attributes:
+        spawn (Optional[Float]): seconds to start the process for the call
+            ('subprocess': `Popen`, 'forkserver': until the forked child
+            reported in, None for a pool worker which was already running)
+        boot (Optional[Float]): seconds from then until Django was set up
+            and our management command started ('subprocess' only)
+        db_setup (Optional[Float]): seconds to switch to the test dbs and
+            connect to them
+        db_connects (Optional[int]): db connections opened for the call
+        db_reuses (Optional[int]): db connections left open by an earlier
+            call, which were reused (only by a pool worker, see
+            `CONCURRENT_TESTS_REUSE_DB_CONNECTIONS`)
+        call (Optional[Float]): seconds spent in the function itself
+        call_start (Optional[Float]): `monotonic` time the function was
+            called at
+        call_end (Optional[Float]): `monotonic` time the function returned
+            (or raised) at
+        wall (Optional[Float]): seconds from starting the call until we had
+            its result, as seen by the parent (including any time held at
+            the start barrier)
+        cpu_user (Optional[Float]): user CPU seconds
+        cpu_sys (Optional[Float]): system CPU seconds
+            ('subprocess': of the whole process, including booting Django,
+            otherwise: from receiving the call until it returned)
+        voluntary_switches (Optional[int]): context switches because the
+            process (or thread, in 'threads' mode) had to wait, e.g. for
+            I/O, a lock or the GIL (counted as for `cpu_user`)
+        involuntary_switches (Optional[int]): context switches because it
+            was preempted
+        max_rss (Optional[int]): peak resident set size in bytes of the
+            process which made the call (for a pool worker, over its whole
+            life so far)
+        kwargs_bytes (Optional[int]): size of the pickled kwargs (for
+            'pool' and 'forkserver', with the function path)
+        kwargs_sent_bytes (Optional[int]): of those, as sent to the process
+            making the call, i.e. compressed if they were large
+            (see `payload`)
+        result_bytes (Optional[int]): size of the pickled result
+        result_sent_bytes (Optional[int]): of that, as sent to the parent
+    """
+
+    FIELDS = (
+        'spawn',
+        'boot',
+        'db_setup',
+        'db_connects',
+        'db_reuses',
+        'call',
+        'call_start',
+        'call_end',
+        'wall',
+        'cpu_user',
+        'cpu_sys',
+        'voluntary_switches',
+        'involuntary_switches',
+        'max_rss',
+        'kwargs_bytes',
+        'kwargs_sent_bytes',
+        'result_bytes',
+        'result_sent_bytes',
+    )
+
+    __slots__ = FIELDS
+
+    def __init__(self, **kwargs):
+        for name in self.FIELDS:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError(
+                'Unexpected metric(s): {}'.format(', '.join(sorted(kwargs)))
+            )
+
+    def update(self, values):
+        """
+        Args:
+            values (Dict[str, Any]): metrics measured by the process which
+                made the call, any we don't know about are ignored
+        """
+        for name in self.FIELDS:
+            if name in values:
+                setattr(self, name, values[name])
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def __repr__(self):
+        return '<CallMetrics {}>'.format(' '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.FIELDS
+        ))
+
+
+def _max_rss_bytes(ru_maxrss):
+    # (Linux reports kilobytes, macOS bytes)
+    if sys.platform == 'darwin':
+        return ru_maxrss
+    return ru_maxrss * 1024
+
+
+def get_rusage():
+    """
+    Returns:
+        resource.struct_rusage: of the current process
+    """
+    return resource.getrusage(resource.RUSAGE_SELF)
+
+
+def get_thread_rusage():
+    """
+    Returns:
+        Optional[resource.struct_rusage]: of the current thread, or None
+            where that's not supported (only Linux has it)
+    """
+    who = getattr(resource, 'RUSAGE_THREAD', None)
+    if who is None:
+        return None
+    return resource.getrusage(who)
+
+
+def rusage_metrics(rusage, since=None):
+    """
+    Args:
+        rusage (resource.struct_rusage): e.g. from `get_rusage` or `wait4`
+        since (Optional[resource.struct_rusage]): earlier usage of the same
+            process, to only count the CPU time used after it
+
+    Returns:
+        Dict[str, Any]: `cpu_user`, `cpu_sys`, `voluntary_switches`,
+            `involuntary_switches` and `max_rss` metrics
+    """
+    cpu_user = rusage.ru_utime
+    cpu_sys = rusage.ru_stime
+    voluntary = rusage.ru_nvcsw
+    involuntary = rusage.ru_nivcsw
+    if since is not None:
+        cpu_user -= since.ru_utime
+        cpu_sys -= since.ru_stime
+        voluntary -= since.ru_nvcsw
+        involuntary -= since.ru_nivcsw
+    return {
+        'cpu_user': cpu_user,
+        'cpu_sys': cpu_sys,
+        'voluntary_switches': voluntary,
+        'involuntary_switches': involuntary,
+        'max_rss': _max_rss_bytes(rusage.ru_maxrss),
+    }
+
+
+def call_timing(start, end):
+    """
+    Args:
+        start (Float): `monotonic` time the function was called at
+        end (Float): `monotonic` time the function returned at
+
+    Returns:
+        Dict[str, Float]: `call`, `call_start` and `call_end` metrics
+    """
+    return {'call': end - start, 'call_start': start, 'call_end': end}
+
+
+Overlap = namedtuple('Overlap', ['max_degree', 'average_degree'])
+
+
+def get_overlap(runs):
+    """
+    How far the calls actually ran concurrently, i.e. how many of them
+    were inside their function at the same time. Calls which never got as
+    far as calling it (or whose result was lost) are left out.
+
+    Args:
+        runs (Iterable[SubprocessRun])
+
+    Returns:
+        Overlap: `max_degree` - most calls running at any moment,
+            `average_degree` - average number of calls running, from the
+            first call starting until the last one returned
+    """
+    intervals = [
+        (run.metrics.call_start, run.metrics.call_end)
+        for run in runs
+        if run.metrics is not None and run.metrics.call_start is not None
+    ]
+    if not intervals:
+        return Overlap(0, 0.0)
+    # (a call starting just as another returns counts as overlapping it)
+    events = sorted(
+        [(start, 0, 1) for start, _ in intervals] +
+        [(end, 1, -1) for _, end in intervals]
+    )
+    running = max_degree = 0
+    for _, _, change in events:
+        running += change
+        max_degree = max(max_degree, running)
+    span = max(end for _, end in intervals) - min(start for start, _ in intervals)
+    if not span:
+        return Overlap(max_degree, float(max_degree))
+    busy = sum(end - start for start, end in intervals)
+    return Overlap(max_degree, busy / span)
+
+
+ContextSwitches = namedtuple('ContextSwitches', ['voluntary', 'involuntary'])
+
+
+def get_context_switches(runs):
+    """
+    How often the calls were switched out, in total, e.g. to see whether a
+    lower `switch_interval` (see `helpers.make_concurrent_calls`) made
+    the threads of the 'threads' mode take turns more often. Calls without
+    the metrics are left out.
+
+    Args:
+        runs (Iterable[SubprocessRun])
+
+    Returns:
+        ContextSwitches: `voluntary` - e.g. waiting for I/O, a lock or the
+            GIL, `involuntary` - preempted
+    """
+    voluntary = involuntary = 0
+    for run in runs:
+        metrics = run.metrics
+        if metrics is None or metrics.voluntary_switches is None:
+            continue
+        voluntary += metrics.voluntary_switches
+        involuntary += metrics.involuntary_switches
+    return ContextSwitches(voluntary, involuntary)
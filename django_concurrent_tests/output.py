@@ -0,0 +1,202 @@
+"""
+What the processes making calls write to their stderr (anything they
+print, see `redirect_stdout`, and their log records) is forwarded to our
+logging line by line, as it arrives, rather than collected and logged in
+one go once they are done.
+
+In those processes `install_log_handler` sends each log record over
+stderr as a line of JSON, so that we can log it at its original level.
+Everything else is logged at `OUTPUT_LEVEL`. Each line is prefixed with
+the pid of the process and the index of its call, if known.
+
+How much we log, and keep, per process is capped: a chatty process can't
+run us out of memory (or flood the test output).
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import sys
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+# marks a line of stderr as a log record (see `StderrLogHandler`)
+RECORD_MARKER = b'\x1edjango_concurrent_tests.log:'
+
+# level for output which isn't a log record, e.g. prints and tracebacks
+OUTPUT_LEVEL = logging.WARNING
+
+# bytes of output per process to forward to logging, the rest is only
+# counted (and kept in the tail)
+OUTPUT_LIMIT = int(os.environ.get('DJANGO_CONCURRENT_TESTS_OUTPUT_LIMIT', 1024 * 1024))
+
+# bytes of the latest output per process to keep, e.g. for error messages,
+# also the longest line: longer ones are forwarded in pieces
+OUTPUT_TAIL = 64 * 1024
+
+
+class OutputLogger(object):
+    """
+    Forwards the stderr output of a process to logging, line by line.
+    """
+
+    def __init__(self, pid, call_index=None, limit=OUTPUT_LIMIT, tail=OUTPUT_TAIL):
+        """
+        Kwargs:
+            pid (Optional[int]): of the process, if known yet
+            call_index (Optional[int]): of the call it's making, in its
+                batch of calls
+            limit (int): bytes to forward to logging at most
+            tail (int): bytes of the latest output to keep
+        """
+        self.pid = pid
+        self.call_index = call_index
+        self.limit = limit
+        self.tail_size = tail
+        self.logged = 0  # bytes
+        self.dropped = 0  # bytes
+        self._partial = b''
+        self._tail = deque()
+        self._tail_bytes = 0
+
+    def _prefix(self, pid):
+        if self.call_index is None:
+            return '[{pid}]'.format(pid=pid)
+        return '[{pid}:{index}]'.format(pid=pid, index=self.call_index)
+
+    @property
+    def prefix(self):
+        return self._prefix(self.pid)
+
+    @property
+    def tail(self):
+        """
+        Returns:
+            bytes: the latest output (up to `tail` bytes, in whole lines)
+        """
+        return b''.join(self._tail) + self._partial
+
+    def feed(self, chunk):
+        """
+        Args:
+            chunk (bytes): more of the output
+        """
+        lines = (self._partial + chunk).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._on_line(line + b'\n')
+        while len(self._partial) > self.tail_size:
+            line = self._partial[:self.tail_size]
+            self._partial = self._partial[self.tail_size:]
+            self._on_line(line)
+
+    def close(self):
+        """
+        At EOF: log any incomplete last line, and how much we didn't log.
+        """
+        if self._partial:
+            line = self._partial
+            self._partial = b''
+            self._on_line(line)
+        self._report_dropped()
+
+    def next_call(self, call_index=None):
+        """
+        For a long-lived process: it's starting another call, for which
+        it may log up to `limit` bytes again.
+        """
+        self._report_dropped()
+        self.logged = 0
+        self.call_index = call_index
+
+    def _report_dropped(self):
+        if self.dropped:
+            logger.warning(
+                '{prefix} {dropped} bytes of output not logged, over the limit '
+                'of {limit} (see DJANGO_CONCURRENT_TESTS_OUTPUT_LIMIT)'.format(
+                    prefix=self.prefix, dropped=self.dropped, limit=self.limit,
+                )
+            )
+            self.dropped = 0
+
+    def _on_line(self, line):
+        self._tail.append(line)
+        self._tail_bytes += len(line)
+        while self._tail_bytes > self.tail_size and len(self._tail) > 1:
+            self._tail_bytes -= len(self._tail.popleft())
+        if self.logged + len(line) > self.limit:
+            self.dropped += len(line)
+            return
+        self.logged += len(line)
+        self._log(line.rstrip(b'\n'))
+
+    def _log(self, line):
+        if not line.strip():
+            return
+        if line.startswith(RECORD_MARKER):
+            try:
+                fields = json.loads(line[len(RECORD_MARKER):].decode('utf-8'))
+            except ValueError:
+                pass
+            else:
+                record = logging.makeLogRecord(fields)
+                if logger.isEnabledFor(record.levelno):
+                    # (e.g. a child of a fork server, which shares its stderr)
+                    pid = fields.get('process') or self.pid
+                    record.msg = '{prefix} {name}: {msg}'.format(
+                        prefix=self._prefix(pid), name=record.name, msg=record.msg,
+                    )
+                    logger.handle(record)
+                return
+        logger.log(OUTPUT_LEVEL, '{prefix} {line}'.format(
+            prefix=self.prefix,
+            line=line.decode('utf-8', 'replace').rstrip(),
+        ))
+
+
+class StderrLogHandler(logging.Handler):
+    """
+    Writes each log record to stderr as a line of JSON, for the
+    `OutputLogger` of the parent to log at its original level.
+    """
+
+    def __init__(self, stream=None):
+        super(StderrLogHandler, self).__init__()
+        self.stream = stream if stream is not None else sys.stderr
+
+    def emit(self, record):
+        try:
+            fields = {
+                'name': record.name,
+                'levelno': record.levelno,
+                'levelname': record.levelname,
+                # (including any traceback)
+                'msg': self.format(record),
+                'created': record.created,
+                'process': record.process,
+                'threadName': record.threadName,
+            }
+            self.stream.write(
+                RECORD_MARKER.decode('ascii') + json.dumps(fields) + '\n'
+            )
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+def install_log_handler():
+    """
+    In a process making calls (started by the helpers, i.e. with a
+    `DJANGO_CONCURRENT_TESTS_PARENT_PID`), send log records to the parent
+    over stderr. Call after `django.setup()`, which may configure logging.
+    """
+    if not os.environ.get('DJANGO_CONCURRENT_TESTS_PARENT_PID'):
+        # e.g. the management command was run by hand, or in-process
+        return
+    root = logging.getLogger()
+    if not any(isinstance(handler, StderrLogHandler) for handler in root.handlers):
+        root.addHandler(StderrLogHandler())
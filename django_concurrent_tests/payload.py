@@ -0,0 +1,211 @@
+"""
+How pickled kwargs and results of a call (see `binpickle`) travel between
+the parent test process and the process making the call: a byte of flags,
+then the rest as the flags say.
+
+Payloads of over `COMPRESS_PAYLOAD` bytes are compressed (with
+`COMPRESSION`), if that makes them any smaller: the fixtures passed to,
+and data returned from, the functions under test tend to be repetitive.
+
+Small results are sent inline, in the frame on the pipe or socket (see
+`transport`). Results of over `LARGE_PAYLOAD` bytes (once compressed)
+don't go through it: the process making the call writes them to a temp
+file and sends only its path. The parent opens and deletes the file as
+soon as it gets the path (see `claim`), so it's gone even if the result is
+never loaded, then unpickles the result straight from a memory map of the
+file. So the parent never holds a big result in its read buffer, a frame
+and the unpickled object all at once.
+"""
+import mmap
+import os
+import tempfile
+import zlib
+
+import six
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+from . import binpickle
+from .b64pickle import PickleLoadsError
+
+
+__all__ = ('claim', 'dumps', 'loads')
+
+
+# bytes of pickled (and compressed) result above which it's sent via a temp file
+LARGE_PAYLOAD = int(os.environ.get('DJANGO_CONCURRENT_TESTS_LARGE_PAYLOAD', 1024 * 1024))
+
+# bytes of pickled kwargs or result above which they are compressed
+COMPRESS_PAYLOAD = int(os.environ.get('DJANGO_CONCURRENT_TESTS_COMPRESS_PAYLOAD', 64 * 1024))
+
+# 'zlib', 'lzma' (Python 3 only) or 'none'
+COMPRESSION = os.environ.get('DJANGO_CONCURRENT_TESTS_COMPRESSION', 'zlib')
+
+# flags
+IN_FILE = 0x01
+ZLIB = 0x02
+LZMA = 0x04
+
+
+def _zlib_compress(data):
+    # (fast, and plenty for repetitive data)
+    return zlib.compress(data, 1)
+
+
+def _lzma_compress(data):
+    return lzma.compress(data)
+
+
+def _lzma_decompress(data):
+    return lzma.decompress(data)
+
+
+COMPRESSORS = {
+    'zlib': (ZLIB, _zlib_compress),
+    'lzma': (LZMA, _lzma_compress),
+}
+
+DECOMPRESSORS = {
+    ZLIB: zlib.decompress,
+    LZMA: _lzma_decompress,
+}
+
+
+def _compress(data, compression):
+    """
+    Returns:
+        Tuple[int, bytes]: compression flag (or 0) and the data to send
+    """
+    if compression == 'none':
+        return 0, data
+    try:
+        flag, compress = COMPRESSORS[compression]
+    except KeyError:
+        raise ValueError('Unknown compression {!r}'.format(compression))
+    if flag == LZMA and lzma is None:
+        raise ValueError('lzma compression needs Python 3.3+')
+    compressed = compress(data)
+    if len(compressed) >= len(data):
+        return 0, data
+    return flag, compressed
+
+
+def dumps(data, in_file=True, metrics=None, name='result'):
+    """
+    Args:
+        data (bytes): e.g. a result pickled by `binpickle.dumps`
+        in_file (bool): whether to send `data` via a temp file if it's
+            over `LARGE_PAYLOAD` bytes (the receiver has to `claim` or
+            `loads` it, or the file is left behind)
+        metrics (Optional[Union[dict, CallMetrics]]): to update with
+            `<name>_bytes`, the size of `data`, and `<name>_sent_bytes`, of
+            what we actually send (compressed, inline or in a temp file)
+        name (str): of the metrics, e.g. 'kwargs' (see `CallMetrics`)
+
+    Returns:
+        bytes: to send (in a frame), for `loads`
+    """
+    flags = 0
+    sent = data
+    if len(data) > COMPRESS_PAYLOAD:
+        flags, sent = _compress(data, COMPRESSION)
+    if metrics is not None:
+        metrics.update({
+            name + '_bytes': len(data),
+            name + '_sent_bytes': len(sent),
+        })
+    if not in_file or len(sent) <= LARGE_PAYLOAD:
+        return six.int2byte(flags) + sent
+    fd, path = tempfile.mkstemp(prefix='concurrent_tests_result')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(sent)
+    except Exception:
+        os.unlink(path)
+        raise
+    return six.int2byte(flags | IN_FILE) + path.encode('utf-8')
+
+
+def _decompress(data, flags):
+    compression = flags & (ZLIB | LZMA)
+    if not compression:
+        return data
+    return DECOMPRESSORS[compression](data)
+
+
+class _ClaimedFile(object):
+    """
+    The temp file of a payload, open but already deleted: its space is
+    freed once it's closed, after `load` or when garbage collected.
+    """
+
+    def __init__(self, path, flags):
+        self.flags = flags
+        try:
+            self.file = open(path, 'rb')
+        finally:
+            os.unlink(path)
+
+    def load(self):
+        try:
+            mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if six.PY2:
+                    # (Python 2's pickle needs a str, so a copy)
+                    return binpickle.loads(_decompress(mapping[:], self.flags))
+                try:
+                    return binpickle.loads(_decompress(mapping, self.flags))
+                except PickleLoadsError as e:
+                    if e.pickled_value is mapping:
+                        # (we're about to close it)
+                        e.pickled_value = mapping[:]
+                    raise
+            finally:
+                mapping.close()
+        finally:
+            self.file.close()
+
+
+def _get_flags(payload):
+    flags = six.indexbytes(payload, 0)
+    if flags & ~(IN_FILE | ZLIB | LZMA) or flags & ZLIB and flags & LZMA:
+        raise ValueError('Unknown payload flags {flags:#x}'.format(flags=flags))
+    return flags
+
+
+def claim(payload):
+    """
+    Take over the temp file of `payload`, if it has one: the file is
+    deleted right away, so it's not left behind whatever becomes of the
+    payload. Call it as soon as the payload is received.
+
+    Args:
+        payload (bytes): from `dumps`
+
+    Returns:
+        Union[bytes, _ClaimedFile]: to pass to `loads` instead of `payload`
+    """
+    flags = _get_flags(payload)
+    if not flags & IN_FILE:
+        return payload
+    return _ClaimedFile(payload[1:].decode('utf-8'), flags)
+
+
+def loads(payload):
+    """
+    Args:
+        payload (Union[bytes, _ClaimedFile]): from `dumps`, or `claim`
+
+    Returns:
+        Any: the unpickled kwargs or result
+    """
+    if isinstance(payload, _ClaimedFile):
+        return payload.load()
+    flags, data = _get_flags(payload), payload[1:]
+    if flags & IN_FILE:
+        return _ClaimedFile(data.decode('utf-8'), flags).load()
+    return binpickle.loads(_decompress(data, flags))
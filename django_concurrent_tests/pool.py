@@ -0,0 +1,395 @@
+"""
+A pool of long-lived worker processes.
+
+Spawning a fresh `manage.py concurrent_call_wrapper` for every call means
+each call pays for interpreter start-up, `django.setup()` and management
+command discovery before our function even runs. Workers in the pool
+(`manage.py concurrent_worker`) pay that once per test session and then
+execute any number of calls.
+
+Pools are keyed on the settings module, the (test) db names and the
+environment of the parent process, so calls made under `override_environment`
+or against a different test db never run on a stale worker.
+"""
+import atexit
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+from . import binpickle, errors, payload
+from .output import OutputLogger
+from .supervisor import (
+    FramedJob,
+    kill_process,
+    NEW_PROCESS_GROUP,
+    read_available,
+    run_job,
+    set_cloexec,
+    set_nonblocking,
+    signal_group,
+    stop_process,
+)
+from .utils import (
+    get_function_path,
+    get_session_key,
+    get_test_databases_env,
+    SUBPROCESS_TIMEOUT,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerProcess(object):
+
+    def __init__(self, cmd, env):
+        """
+        Kwargs:
+            cmd (List[str]): `args` arg to `Popen` call
+            env (Dict[str, str]): environment for the worker
+        """
+        self.process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            **NEW_PROCESS_GROUP
+        )
+        self.pid = self.process.pid
+        self.terminated = False  # whether worker was terminated by timeout
+        for pipe in (self.process.stdin, self.process.stdout, self.process.stderr):
+            set_nonblocking(pipe.fileno())
+            # (so that closing its stdin is enough to stop it)
+            set_cloexec(pipe.fileno())
+        self.output = OutputLogger(self.pid)
+        logger.debug('[{pid}] {cmd}'.format(pid=self.pid, cmd=' '.join(cmd)))
+
+    @property
+    def stdin_fd(self):
+        return self.process.stdin.fileno()
+
+    @property
+    def stdout_fd(self):
+        return self.process.stdout.fileno()
+
+    @property
+    def stderr_fd(self):
+        return self.process.stderr.fileno()
+
+    def _read_stderr(self):
+        chunk = read_available(self.stderr_fd)
+        if chunk:
+            self.output.feed(chunk)
+        elif chunk is not None:
+            # EOF
+            self.output.close()
+        return chunk
+
+    def log_stderr(self):
+        """
+        Log any complete lines available on the worker's stderr. Has to be
+        called whenever it's readable while the worker is busy (see
+        `supervisor.Supervisor.drain`), else a chatty worker would block
+        once the pipe buffer is full.
+
+        Returns:
+            bool: False once the worker has closed its stderr
+        """
+        return self._read_stderr() != b''
+
+    def flush_stderr(self):
+        """
+        Log everything on the worker's stderr which can be read without
+        blocking.
+        """
+        while not self.process.stderr.closed:
+            chunk = self._read_stderr()
+            if chunk is None:
+                break
+            if not chunk:
+                self.process.stderr.close()
+
+    def is_alive(self):
+        return not self.terminated and self.process.poll() is None
+
+    def terminate(self):
+        """
+        Ask the worker, and anything it started, to exit (without waiting).
+        """
+        self.terminated = True
+        signal_group(self.pid, signal.SIGTERM)
+
+    def kill(self):
+        self.terminated = True
+        kill_process(self.process)
+
+    def close(self, timeout=5):
+        """
+        Ask the worker to exit by closing its stdin, falling back to
+        `supervisor.stop_process` if it does not do so within `timeout`
+        seconds.
+        """
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        deadline = time.time() + timeout
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.terminated = True
+        stop_process(self.process)
+        self.flush_stderr()
+
+
+class WorkerCall(FramedJob):
+    """
+    A call made by a worker from a `WorkerPool`: we send the job, the
+    worker sets up for it and says 'ready', once released by the start
+    barrier we say 'go' and the worker replies with the metrics and the
+    result of the call.
+    """
+
+    def __init__(self, pool, f, kwargs, timeout=SUBPROCESS_TIMEOUT):
+        super(WorkerCall, self).__init__(timeout)
+        self.pool = pool
+        self.function_path = get_function_path(f)
+        self.kwargs = kwargs
+        self.worker = None
+        self._got_metrics = False
+        self._result = None
+        # whether the worker got through our call, i.e. is ready for another
+        self._completed = False
+
+    @property
+    def manager(self):
+        return self.worker
+
+    @property
+    def name(self):
+        return 'worker {pid}'.format(pid=self.worker.pid)
+
+    def start(self, supervisor):
+        super(WorkerCall, self).start(supervisor)
+        self.worker = self.pool.acquire()
+        self.worker.output.next_call(self.call_index)
+        supervisor.drain(self.worker.stderr_fd, self.worker.log_stderr)
+        self.open_channel(self.worker.stdout_fd, self.worker.stdin_fd)
+        self.send(payload.dumps(
+            binpickle.dumps((self.function_path, self.kwargs)), in_file=False,
+            metrics=self.metrics, name='kwargs',
+        ))
+
+    def on_frame(self, frame):
+        if not self.arrived:
+            self.arrive()  # 'ready'
+        elif not self._got_metrics:
+            self._got_metrics = True
+            self.metrics.update(binpickle.loads(frame))
+        else:
+            self._completed = not self._reader.pending()
+            self._result = payload.claim(frame)
+            self.finish()
+
+    def on_released(self):
+        self.send(b'go')
+
+    def on_eof(self):
+        code = self.worker.process.wait()
+        if self.timed_out:
+            raise errors.TerminatedProcessError(self._reader.pending())
+        raise errors.WorkerDiedError(
+            'worker {pid} exited with code {code}'.format(
+                pid=self.worker.pid, code=code,
+            )
+        )
+
+    def on_timeout(self):
+        logger.debug('[{pid}] reached timeout: terminating...'.format(pid=self.worker.pid))
+        self.worker.terminate()
+
+    def on_kill(self):
+        logger.debug('[{pid}] still running after SIGTERM: killing...'.format(pid=self.worker.pid))
+        self.worker.kill()
+        raise errors.TerminatedProcessError(self._reader.pending())
+
+    def cleanup(self):
+        super(WorkerCall, self).cleanup()
+        if self.worker is None:
+            return
+        if not self._completed and self.worker.is_alive():
+            # it's somewhere in the middle of our call (e.g. we failed to
+            # read its metrics), so whatever it sends next isn't a reply to
+            # the next call: not reusable
+            logger.debug('[{pid}] call not completed: killing...'.format(pid=self.worker.pid))
+            self.worker.kill()
+        if not self.worker.is_alive() and not self.worker.process.stderr.closed:
+            # log its dying words, before its fds can be closed & reused
+            self.supervisor.set_events(self.worker.stderr_fd, 0)
+            self.worker.flush_stderr()
+        self.pool.release(self.worker)
+
+    def get_result(self):
+        return payload.loads(self._result)
+
+
+class WorkerPool(object):
+
+    def __init__(self, cmd, env=None):
+        """
+        Kwargs:
+            cmd (List[str]): `args` arg to `Popen` call for each worker
+            env (Optional[Dict[str, str]]): environment for the workers
+                (defaults to a copy of `os.environ` at spawn time), plus
+                our test dbs (see `utils.get_test_databases_env`)
+        """
+        self.cmd = cmd
+        self.env = env
+        self._idle = []
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._retired = False
+
+    def __len__(self):
+        return len(self._workers)
+
+    def _spawn(self):
+        env = (self.env if self.env is not None else os.environ).copy()
+        env['DJANGO_CONCURRENT_TESTS_PARENT_PID'] = str(os.getpid())
+        env.update(get_test_databases_env())
+        worker = WorkerProcess(self.cmd, env)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def warm_up(self, size):
+        """
+        Ensure at least `size` workers are available without waiting on
+        a spawn, e.g. before making `size` concurrent calls. The workers
+        boot in parallel, in the background.
+        """
+        with self._lock:
+            self._idle = [worker for worker in self._idle if worker.is_alive()]
+            needed = size - len(self._idle)
+        for _ in range(needed):
+            worker = self._spawn()
+            with self._lock:
+                self._idle.append(worker)
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.is_alive():
+                    return worker
+                self._workers.discard(worker)
+        return self._spawn()
+
+    def release(self, worker):
+        with self._lock:
+            if worker.is_alive() and not self._retired:
+                self._idle.append(worker)
+                return
+            self._workers.discard(worker)
+        if self._retired:
+            worker.close()
+
+    def job(self, f, kwargs, timeout=SUBPROCESS_TIMEOUT):
+        """
+        Returns:
+            WorkerCall: to call `f` on a worker from the pool
+        """
+        return WorkerCall(self, f, kwargs, timeout=timeout)
+
+    def run(self, f, **kwargs):
+        """
+        Same as `utils.run_in_subprocess`, but on a worker from the pool.
+
+        Returns:
+            SubprocessRun: where `<SubprocessRun>.manager` is the
+                `WorkerProcess` which made the call
+        """
+        return run_job(self.job(f, kwargs))
+
+    def retire(self):
+        """
+        Close the idle workers now, and those still busy with a call once
+        they are released.
+        """
+        with self._lock:
+            self._retired = True
+            idle = self._idle
+            self._idle = []
+            self._workers.difference_update(idle)
+        for worker in idle:
+            worker.close()
+
+    def close(self):
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+            self._idle = []
+        for worker in workers:
+            worker.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """
+    Returns:
+        WorkerPool: the pool for the current settings, test dbs and
+            environment (created on first use, then kept until exit or
+            until a pool for other settings etc is needed)
+    """
+    reuse_db_connections = getattr(
+        settings, 'CONCURRENT_TESTS_REUSE_DB_CONNECTIONS', False
+    )
+    key = (get_session_key(), reuse_db_connections)
+    superseded = []
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            # (rather than keep their workers, maybe connected to the dbs,
+            # until exit)
+            superseded = list(_pools.values())
+            _pools.clear()
+            cmd = [
+                getattr(settings, 'MANAGE_PY_PATH', './manage.py'),
+                'concurrent_worker',
+            ]
+            if reuse_db_connections:
+                cmd.append('--reuse-db-connections')
+            pool = _pools[key] = WorkerPool(cmd=cmd)
+    for old in superseded:
+        old.retire()
+    return pool
+
+
+@atexit.register
+def close_worker_pools():
+    """
+    Shut down all workers. Happens at exit anyway, but with
+    `CONCURRENT_TESTS_REUSE_DB_CONNECTIONS` the workers stay connected to
+    the test dbs, so call it before those are torn down.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def run_in_worker_pool(f, **kwargs):
+    """
+    Like `utils.run_in_subprocess` but the call is made by a long-lived
+    worker from the current `get_worker_pool()`.
+    """
+    return get_worker_pool().run(f, **kwargs)
@@ -0,0 +1,672 @@
+"""
+Supervision of the child processes of a batch of concurrent calls, from a
+single thread.
+
+Each call is a `Job`: a small state machine which reacts to its pipes or
+socket becoming readable/writable, to its deadline passing and to the
+start barrier being released. A `Supervisor` multiplexes the fds of all
+the jobs in a batch with `poll`, so a batch of any size costs the parent
+just the thread it was started from, rather than a couple of threads per
+call each blocked in a `communicate()` or `select()` of its own.
+"""
+import errno
+import fcntl
+import math
+import os
+import select
+import signal
+import time
+from collections import deque, namedtuple
+from functools import partial
+
+import six
+
+from . import errors, transport
+from .metrics import CallMetrics
+
+
+# how long a call gets to exit after SIGTERM, before we SIGKILL it
+TERMINATE_GRACE = float(
+    os.environ.get('DJANGO_CONCURRENT_TESTS_TERMINATE_GRACE', '5')
+)
+
+# `Popen` kwargs to start a process as the leader of a new process group,
+# so that we can signal it along with anything it starts in turn
+if six.PY3:
+    NEW_PROCESS_GROUP = {'start_new_session': True}
+else:
+    NEW_PROCESS_GROUP = {'preexec_fn': os.setpgrp}
+
+READ = select.POLLIN
+WRITE = select.POLLOUT
+
+# poll reports these whatever we asked for, they mean the next read will
+# see EOF or the next write will fail, so we let the handler find out
+_HANGUP = select.POLLHUP | select.POLLERR
+
+
+SubprocessRun = namedtuple('SubprocessRun', ['manager', 'result', 'metrics'])
+SubprocessRun.__new__.__defaults__ = (None,)  # metrics
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def set_cloexec(fd):
+    """
+    Keep `fd` out of the processes we start. On Python 3 fds are created
+    that way already, on Python 2 `Popen` children inherit everything: e.g.
+    a child holding the write end of another pipe means its reader never
+    sees EOF.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def read_available(fd, size=65536):
+    """
+    Returns:
+        Optional[bytes]: whatever could be read from non-blocking `fd`
+            without blocking (b'' on EOF), or None if nothing was ready
+    """
+    try:
+        return os.read(fd, size)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return None
+        raise
+
+
+def signal_group(pid, signum):
+    """
+    Send `signum` to the process group led by `pid`, if it still exists.
+    """
+    try:
+        os.killpg(pid, signum)
+    except OSError as e:
+        # (EPERM: the group leader is a zombie, on some platforms)
+        if e.errno not in (errno.ESRCH, errno.EPERM):
+            raise
+
+
+def reap_process(process):
+    """
+    Wait for `subprocess.Popen` `process` to exit, as `process.wait()`
+    does, but also get its resource usage.
+
+    Returns:
+        Optional[resource.struct_rusage]: of the process and any children
+            it waited for, None if it had already been reaped
+    """
+    if process.returncode is not None:
+        return None
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # reaped behind our back
+                process.wait()
+                return None
+            raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+
+def kill_process(process):
+    """
+    SIGKILL the process group of `subprocess.Popen` `process` and reap it.
+    """
+    signal_group(process.pid, signal.SIGKILL)
+    process.wait()
+
+
+def stop_process(process, grace=TERMINATE_GRACE):
+    """
+    SIGTERM the process group of `subprocess.Popen` `process`, then
+    SIGKILL it if the process hasn't exited after `grace` seconds.
+    """
+    if process.poll() is not None:
+        return
+    signal_group(process.pid, signal.SIGTERM)
+    deadline = time.time() + grace
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.01)
+    kill_process(process)
+
+
+class Job(object):
+    """
+    A single call supervised by a `Supervisor`.
+
+    Subclasses `start` their process or connection and `watch` its fds,
+    then `finish` once they have a result, or raise from any of their
+    handlers to fail. A job which is set up and ready to make its call
+    `arrive`s at the start barrier and is told to go by `on_released`.
+
+    Once past its deadline the job gets `on_timeout`, to ask its process
+    to stop, and if it still hasn't finished after the supervisor's
+    `terminate_grace`, `on_kill`.
+    """
+
+    def __init__(self, timeout):
+        """
+        Kwargs:
+            timeout (Float): how long the call may take once started
+        """
+        self.timeout = timeout
+        self.deadline = None
+        self.kill_deadline = None
+        self.supervisor = None
+        self.batch = None
+        self.barrier = None  # `barrier.StartBarrier` of our batch, if any
+        self.arrived = False
+        self.timed_out = False
+        self.done = False
+        self.error = None
+        self.metrics = CallMetrics()
+        self.started_at = None
+        self.call_index = None  # in its list of calls, if any
+
+    @property
+    def manager(self):
+        """
+        The object to expose as `SubprocessRun.manager`.
+        """
+        return self
+
+    def start(self, supervisor):
+        self.supervisor = supervisor
+        self.started_at = time.time()
+        self.deadline = self.started_at + self.timeout
+        if supervisor.deadline is not None:
+            self.deadline = min(self.deadline, supervisor.deadline)
+
+    def watch(self, fd, events, callback):
+        self.supervisor.set_events(fd, events, callback, job=self)
+
+    def unwatch(self, fd):
+        self.supervisor.set_events(fd, 0)
+
+    def arrive(self):
+        self.arrived = True
+        self.supervisor.arrive(self)
+
+    def on_released(self):
+        pass
+
+    def on_timeout(self):
+        raise NotImplementedError
+
+    def on_kill(self):
+        raise NotImplementedError
+
+    def cleanup(self):
+        """
+        Release fds and resources, called once when the job finishes.
+        """
+
+    def abort(self):
+        """
+        Stop the job before it finished, e.g. because nobody is waiting for
+        its result any more.
+        """
+        self.cleanup()
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        if self.started_at is not None:
+            self.metrics.wall = time.time() - self.started_at
+        self.cleanup()
+        self.supervisor.on_finished(self)
+
+    def fail(self, error):
+        if self.done:
+            return
+        # (we're called from an `except` block, so this captures the tb)
+        self.error = errors.WrappedError(error)
+        self.finish()
+
+    def get_result(self):
+        """
+        Returns:
+            Any: return value of the call (or exception raised by it),
+                may raise if the result can't be deserialized
+        """
+        raise NotImplementedError
+
+    def get_run(self):
+        """
+        Returns:
+            SubprocessRun: for a finished job
+        """
+        if self.error is not None:
+            result = self.error
+        else:
+            try:
+                result = self.get_result()
+            except Exception as e:
+                result = errors.WrappedError(e)
+        return SubprocessRun(
+            manager=self.manager, result=result, metrics=self.metrics,
+        )
+
+
+class FramedJob(Job):
+    """
+    A job which talks to its process in frames (see `transport`), over
+    separate read and write fds or a single socket.
+    """
+
+    def __init__(self, timeout):
+        super(FramedJob, self).__init__(timeout)
+        self._rfd = None
+        self._wfd = None
+        self._outbox = bytearray()
+        self._reader = transport.FrameReader()
+
+    def open_channel(self, rfd, wfd):
+        self._rfd = rfd
+        self._wfd = wfd
+        self._update_events()
+
+    def close_channel(self):
+        if self._rfd is not None:
+            self.unwatch(self._rfd)
+            if self._wfd != self._rfd:
+                self.unwatch(self._wfd)
+        self._rfd = self._wfd = None
+
+    def _update_events(self):
+        wants_write = WRITE if self._outbox else 0
+        if self._rfd == self._wfd:
+            self.watch(self._rfd, READ | wants_write, self._on_events)
+        else:
+            self.watch(self._rfd, READ, self._on_events)
+            self.watch(self._wfd, wants_write, self._on_events)
+
+    def send(self, frame):
+        self._outbox.extend(transport.encode_frame(frame))
+        self._update_events()
+
+    def _on_events(self, events):
+        if events & WRITE:
+            self._flush()
+        if events & READ and not self.done:
+            self._receive()
+
+    def _flush(self):
+        try:
+            sent = os.write(self._wfd, self._outbox)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise errors.WorkerDiedError(
+                '{name} is not accepting calls: {error!r}'.format(
+                    name=self.name, error=e,
+                )
+            )
+        del self._outbox[:sent]
+        if not self._outbox:
+            self._update_events()
+
+    def _receive(self):
+        chunk = read_available(self._rfd)
+        if chunk is None:
+            return
+        if not chunk:
+            self.on_eof()
+            return
+        self._reader.feed(chunk)
+        while not self.done:
+            frame = self._reader.next_frame()
+            if frame is None:
+                break
+            self.on_frame(frame)
+
+    @property
+    def name(self):
+        raise NotImplementedError
+
+    def on_frame(self, frame):
+        raise NotImplementedError
+
+    def on_eof(self):
+        raise errors.WorkerDiedError(
+            '{name} exited without a result'.format(name=self.name)
+        )
+
+    def cleanup(self):
+        self.close_channel()
+
+
+class Batch(object):
+    """
+    Jobs to be started together.
+    """
+
+    def __init__(self, jobs, barrier_timeout=None):
+        """
+        Kwargs:
+            jobs (Sequence[Job])
+            barrier_timeout (Optional[Float]): if given, the jobs are held
+                at a `barrier.StartBarrier` with this timeout, until all of
+                them are ready to make their calls
+        """
+        self.jobs = jobs
+        self.barrier_timeout = barrier_timeout
+        self.barrier = None
+        self.barrier_deadline = None
+        self.outstanding = len(jobs)
+        self._waiting = []
+
+    def __len__(self):
+        return len(self.jobs)
+
+    @property
+    def held(self):
+        """
+        Returns:
+            bool: whether the batch is still waiting at its barrier
+        """
+        return self.barrier is not None and not self.barrier.released
+
+
+class Supervisor(object):
+    """
+    Event loop for batches of jobs.
+
+    The supervisor takes care of each batch's start barrier: creating it
+    as the batch is started, counting the parties as they arrive (in-process
+    via `arrive`, or from subprocesses which signal it directly), releasing
+    it once all of them are ready or its timeout has passed, and closing it
+    once the batch has finished.
+    """
+
+    def __init__(self, max_running=None, deadline=None, terminate_grace=TERMINATE_GRACE):
+        """
+        Kwargs:
+            max_running (Optional[int]): if given, a batch isn't started
+                until there's room for all of its jobs without exceeding
+                this many running at once
+            deadline (Optional[Float]): `time.time()` by which all jobs
+                must be done, any still running are then timed out and
+                any not started yet fail with `DeadlineExceededError`
+            terminate_grace (Float): seconds between `Job.on_timeout` and
+                `Job.on_kill`
+        """
+        self.max_running = max_running
+        self.deadline = deadline
+        self.terminate_grace = terminate_grace
+        self._poll = select.poll()
+        self._watched = {}  # fd -> (events, callback, job)
+        self._pending = deque()
+        self._batches = []
+        self._running = []
+        self._finished = deque()
+
+    def set_events(self, fd, events, callback=None, job=None):
+        """
+        (Re-)register interest in `events` on `fd`, or stop watching it if
+        `events` is 0. `callback` is called with the events which occurred,
+        any exception it raises fails `job`.
+        """
+        if not events:
+            if self._watched.pop(fd, None) is not None:
+                self._unregister(fd)
+            return
+        if fd in self._watched:
+            self._modify(fd, events)
+        else:
+            self._register(fd, events)
+        self._watched[fd] = (events, callback, job)
+
+    # how we wait for events, overridden by `aio.AsyncSupervisor`
+
+    def _register(self, fd, events):
+        self._poll.register(fd, events)
+
+    def _modify(self, fd, events):
+        self._poll.modify(fd, events)
+
+    def _unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def drain(self, fd, read):
+        """
+        Keep reading `fd` (e.g. a stderr shared by several jobs) until EOF
+        or the end of the batch, whichever is first.
+
+        Args:
+            fd (int)
+            read (Callable[[], bool]): consumes whatever is available on
+                `fd`, returns False at EOF
+        """
+        if fd in self._watched:
+            return
+
+        def callback(events):
+            if not read():
+                self.set_events(fd, 0)
+
+        self.set_events(fd, READ, callback)
+
+    def arrive(self, job):
+        batch = job.batch
+        if not batch.held:
+            self._dispatch(job, job.on_released)
+        else:
+            batch._waiting.append(job)
+            batch.barrier.arrive()
+
+    def on_finished(self, job):
+        self._running.remove(job)
+        self._finished.append(job)
+        batch = job.batch
+        batch.outstanding -= 1
+        if batch.held and not job.arrived:
+            # this call failed before it reached the barrier
+            batch.barrier.leave()
+        if not batch.outstanding:
+            self._close_batch(batch)
+
+    def _dispatch(self, job, method, *args):
+        if job is not None and job.done:
+            return
+        try:
+            method(*args)
+        except Exception as e:
+            if job is None:
+                raise
+            job.fail(e)
+
+    def _start_pending(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            self._expire_pending()
+        while self._pending:
+            batch = self._pending[0]
+            if (
+                self.max_running is not None and
+                self._running and
+                len(self._running) + len(batch) > self.max_running
+            ):
+                break
+            self._pending.popleft()
+            self._start_batch(batch)
+
+    def _start_batch(self, batch):
+        self._batches.append(batch)
+        if batch.barrier_timeout is not None:
+            from .barrier import StartBarrier
+            batch.barrier = StartBarrier(len(batch), timeout=batch.barrier_timeout)
+            batch.barrier_deadline = time.time() + batch.barrier_timeout
+            self.set_events(
+                batch.barrier.fileno(), READ, partial(self._on_barrier, batch)
+            )
+        for job in batch.jobs:
+            # (set before `start`, for a job which fails while starting)
+            job.supervisor = self
+            job.batch = batch
+            job.barrier = batch.barrier
+            self._running.append(job)
+        for job in batch.jobs:
+            self._dispatch(job, job.start, self)
+
+    def _expire_pending(self):
+        while self._pending:
+            batch = self._pending.popleft()
+            for job in batch.jobs:
+                job.batch = batch
+                job.done = True
+                job.error = errors.WrappedError(errors.DeadlineExceededError(
+                    'deadline passed before the call could be started'
+                ))
+                self._finished.append(job)
+
+    def _close_batch(self, batch):
+        self._batches.remove(batch)
+        if batch.barrier is not None:
+            self.set_events(batch.barrier.fileno(), 0)
+            batch.barrier.close()
+
+    def _on_barrier(self, batch, events):
+        if batch.barrier.collect():
+            self._release(batch)
+
+    def _release(self, batch):
+        self.set_events(batch.barrier.fileno(), 0)
+        batch.barrier.release()
+        waiting, batch._waiting = batch._waiting, []
+        for job in waiting:
+            self._dispatch(job, job.on_released)
+
+    def _next_timeout(self):
+        """
+        Returns:
+            Optional[Float]: seconds until the next deadline, if any
+        """
+        deadlines = [
+            job.kill_deadline if job.timed_out else job.deadline
+            for job in self._running
+        ]
+        deadlines.extend(
+            batch.barrier_deadline for batch in self._batches if batch.held
+        )
+        if self._pending and self.deadline is not None:
+            deadlines.append(self.deadline)
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.time(), 0)
+
+    def _check_deadlines(self):
+        now = time.time()
+        for batch in list(self._batches):
+            if batch.held and now >= batch.barrier_deadline:
+                self._release(batch)
+        if self._pending and self.deadline is not None and now >= self.deadline:
+            self._expire_pending()
+        for job in list(self._running):
+            if not job.timed_out:
+                if now >= job.deadline:
+                    job.timed_out = True
+                    job.kill_deadline = now + self.terminate_grace
+                    self._dispatch(job, job.on_timeout)
+            elif job.kill_deadline is not None and now >= job.kill_deadline:
+                job.kill_deadline = None
+                self._dispatch(job, job.on_kill)
+
+    def _handle(self, fd, revents):
+        watched = self._watched.get(fd)
+        if watched is None:
+            # unwatched by an earlier handler in this same round
+            return
+        events, callback, job = watched
+        if revents & select.POLLNVAL:
+            self.set_events(fd, 0)
+            return
+        if revents & _HANGUP:
+            revents |= events
+        if revents & events:
+            self._dispatch(job, callback, revents & events)
+
+    def _step(self):
+        timeout = self._next_timeout()
+        try:
+            ready = self._poll.poll(
+                -1 if timeout is None else int(math.ceil(timeout * 1000))
+            )
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, revents in ready:
+            self._handle(fd, revents)
+        self._check_deadlines()
+
+    def begin(self, batches):
+        """
+        Start supervising `batches`, starting as many as we may right away.
+        """
+        self._pending.extend(batches)
+        self._start_pending()
+
+    def end(self):
+        """
+        Abort any jobs still running and free our resources.
+        """
+        self._pending.clear()
+        for job in list(self._running):
+            job.abort()
+        for batch in list(self._batches):
+            self._close_batch(batch)
+        for fd in list(self._watched):
+            self.set_events(fd, 0)
+
+    @property
+    def busy(self):
+        return bool(self._running or self._finished or self._pending)
+
+    def iter_finished(self, batches):
+        """
+        Start `batches` of jobs and supervise them until all are finished.
+        If we're not iterated to the end, any jobs still running are
+        aborted (and those not started yet never will be).
+
+        Yields:
+            Job: each job, as soon as it has finished
+        """
+        try:
+            self.begin(batches)
+            while self.busy:
+                while self._finished:
+                    yield self._finished.popleft()
+                # (not from `on_finished`, so that jobs which fail as soon
+                # as they start don't make for unbounded recursion)
+                self._start_pending()
+                if self._running:
+                    self._step()
+        finally:
+            self.end()
+
+
+def run_job(job):
+    """
+    Run a single job to completion in the current thread.
+
+    Returns:
+        SubprocessRun
+    """
+    for _ in Supervisor().iter_finished([Batch([job])]):
+        pass
+    return job.get_run()
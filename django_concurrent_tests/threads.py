@@ -0,0 +1,245 @@
+"""
+'threads' execution mode: each call is made directly in a thread of the
+test process.
+
+There's no process to start, nothing to (un)pickle and no Django to set
+up, so a call costs little more than starting its thread... but the calls
+only run concurrently as far as the GIL lets them, i.e. while they are
+waiting on the db or other I/O. Good enough for most races between db
+transactions.
+
+Django's db connections are per thread, so each call gets connections of
+its own, to the same (test) dbs as the thread which made the calls. The
+calls share everything else with the test: e.g. their kwargs aren't
+copied, and what they print goes to the test's own stdout.
+"""
+import logging
+import os
+import threading
+import time
+
+import six
+from django.db import connections
+
+from . import errors
+from .management.commands.concurrent_call_wrapper import (
+    close_db_connections,
+    counting_db_connects,
+    open_db_connections,
+)
+from .metrics import call_timing, get_thread_rusage, monotonic, rusage_metrics
+from .supervisor import Job, READ, read_available, set_cloexec, set_nonblocking
+from .utils import (
+    get_function_path,
+    get_test_databases,
+    import_function,
+    SUBPROCESS_TIMEOUT,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# what our threads tell the supervisor via their pipe
+_READY = b'r'
+_DONE = b'.'
+
+
+def get_database_names():
+    """
+    Returns:
+        Dict[str, str]: alias -> name of the test db which the connections
+            of the current thread are using, or will once the test runner
+            has set them up (see `utils.get_test_databases`)
+    """
+    return dict(
+        (alias, database['NAME']) for alias, database in get_test_databases().items()
+    )
+
+
+def use_databases(names):
+    """
+    Point the connections of the current thread at the dbs `names`.
+
+    Normally a new thread's connections share their settings with those of
+    the thread which set up the test dbs, so there's nothing to do. If not,
+    they get a copy of their own: we don't change settings other threads
+    may be connecting with.
+
+    Args:
+        names (Dict[str, str]): from `get_database_names`
+    """
+    for alias, name in names.items():
+        connection = connections[alias]
+        if connection.settings_dict['NAME'] != name:
+            connection.close()
+            connection.settings_dict = dict(connection.settings_dict, NAME=name)
+
+
+class ThreadCall(Job):
+    """
+    A call made in a thread of the current process.
+
+    NOTE:
+        there's no way to interrupt a thread: past its deadline the call
+        fails with `TerminatedProcessError`, but its thread carries on
+        until the function returns
+    """
+
+    def __init__(self, f, kwargs, timeout=SUBPROCESS_TIMEOUT):
+        """
+        Kwargs:
+            f (Union[function, str]): the function to call (unlike the
+                other modes, any callable will do)
+            kwargs (dict): kwargs to pass to `function`
+            timeout (Float): how long to wait for the call to complete
+        """
+        super(ThreadCall, self).__init__(timeout)
+        if isinstance(f, six.string_types):
+            self.function_path = f
+            self.function = None
+        else:
+            self.function_path = get_function_path(f)
+            self.function = f
+        self.kwargs = kwargs
+        # (as used by the thread making the calls)
+        self._databases = get_database_names()
+        self._result = None
+        self._metrics = {}
+        self._go = threading.Event()
+        self._lock = threading.Lock()
+        self._thread_done = False
+        self._abandoned = False
+        self._pipe_r = self._pipe_w = None
+
+    @property
+    def manager(self):
+        return None
+
+    @property
+    def name(self):
+        return 'thread for call {index}'.format(index=self.call_index)
+
+    def start(self, supervisor):
+        super(ThreadCall, self).start(supervisor)
+        # our thread tells the supervisor it's ready or done via this pipe
+        self._pipe_r, self._pipe_w = os.pipe()
+        set_nonblocking(self._pipe_r)
+        for fd in (self._pipe_r, self._pipe_w):
+            set_cloexec(fd)
+        self.watch(self._pipe_r, READ, self._on_pipe)
+        thread = threading.Thread(target=self._run, name=self.name)
+        thread.daemon = True
+        thread.start()
+
+    def _setup(self, metrics):
+        """
+        Returns:
+            function: to call
+        """
+        f = self.function or import_function(self.function_path)
+        start = time.time()
+        use_databases(self._databases)
+        if self.barrier is not None:
+            # connect now, so that we all start on an equal footing
+            open_db_connections()
+        metrics['db_setup'] = time.time() - start
+        return f
+
+    def _call(self, metrics):
+        """
+        Returns:
+            Any: the result of the call, or a `WrappedError`
+        """
+        logger.debug('Calling {f} in a thread'.format(f=self.function_path))
+        try:
+            f = self._setup(metrics)
+        except Exception as e:
+            return errors.WrappedError(e)
+        if self.barrier is not None:
+            self._notify(_READY)
+            self._go.wait()
+            if self._abandoned:
+                return None
+        start = monotonic()
+        try:
+            try:
+                return f(**self.kwargs)
+            finally:
+                metrics.update(call_timing(start, monotonic()))
+        except Exception as e:
+            return errors.WrappedError(e)
+
+    def _run(self):
+        metrics = {}
+        usage_before = get_thread_rusage()
+        with counting_db_connects(metrics):
+            result = self._call(metrics)
+            try:
+                close_db_connections()
+            except Exception as e:
+                result = errors.WrappedError(e)
+        if usage_before is not None:
+            metrics.update(rusage_metrics(get_thread_rusage(), since=usage_before))
+        self._result = result
+        self._metrics = metrics
+        with self._lock:
+            self._thread_done = True
+            if self._abandoned:
+                self._close_pipe()
+            else:
+                os.write(self._pipe_w, _DONE)
+
+    def _notify(self, message):
+        with self._lock:
+            if not self._abandoned:
+                os.write(self._pipe_w, message)
+
+    def _on_pipe(self, events):
+        messages = read_available(self._pipe_r)
+        for message in six.iterbytes(messages or b''):
+            if six.int2byte(message) == _READY:
+                self.arrive()
+            else:
+                self.metrics.update(self._metrics)
+                self.finish()
+
+    def on_released(self):
+        self._go.set()
+
+    def on_timeout(self):
+        raise errors.TerminatedProcessError(
+            'call timed out after {timeout}s, its thread is still '
+            'running'.format(timeout=self.timeout)
+        )
+
+    def on_kill(self):
+        pass
+
+    def _close_pipe(self):
+        os.close(self._pipe_r)
+        os.close(self._pipe_w)
+
+    def cleanup(self):
+        if self._pipe_r is None:
+            return
+        self.unwatch(self._pipe_r)
+        with self._lock:
+            if self._thread_done:
+                self._close_pipe()
+            else:
+                # the thread will close the pipe when done
+                self._abandoned = True
+                # (in case it's waiting at the barrier)
+                self._go.set()
+
+    def get_result(self):
+        return self._result
+
+
+def thread_job(f, kwargs, timeout=SUBPROCESS_TIMEOUT):
+    """
+    Returns:
+        supervisor.Job: to call `f` in a thread of the current process
+    """
+    return ThreadCall(f, kwargs, timeout=timeout)
@@ -0,0 +1,108 @@
+"""
+Length-prefixed framing for the pipes and sockets between the parent test
+process and its workers.
+
+Each frame is an 8-byte big-endian length followed by that many bytes of
+payload, so payloads can be arbitrarily large and contain any bytes, and
+nothing has to go through argv (bounded by ARG_MAX, visible in `ps`).
+"""
+import struct
+
+
+HEADER = struct.Struct('!Q')
+
+
+def write_frame(stream, data):
+    """
+    Args:
+        stream: binary file-like
+        data (bytes): frame payload
+    """
+    stream.write(HEADER.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+def encode_frame(data):
+    """
+    Returns:
+        bytes: `data` with its length prefix, e.g. for `Popen.communicate`
+    """
+    return HEADER.pack(len(data)) + data
+
+
+def _read_exactly(stream, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frame(stream):
+    """
+    Blocking read of the next frame.
+
+    Args:
+        stream: binary file-like
+
+    Returns:
+        Optional[bytes]: frame payload, or None if the stream was closed
+            cleanly between frames
+
+    Raises:
+        EOFError: if the stream was closed part way through a frame
+    """
+    header = _read_exactly(stream, HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise EOFError('Stream closed inside frame header')
+    size, = HEADER.unpack(header)
+    data = _read_exactly(stream, size)
+    if len(data) < size:
+        raise EOFError(
+            'Stream closed after {read} of {size} bytes of frame'.format(
+                read=len(data), size=size,
+            )
+        )
+    return data
+
+
+class FrameReader(object):
+    """
+    Incremental decoder for frames arriving in arbitrary chunks, e.g. from
+    `os.read` on a pipe we are `select`ing on.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer.extend(data)
+
+    def next_frame(self):
+        """
+        Returns:
+            Optional[bytes]: the next complete frame payload, if we have one
+        """
+        if len(self._buffer) < HEADER.size:
+            return None
+        size, = HEADER.unpack_from(bytes(self._buffer[:HEADER.size]))
+        end = HEADER.size + size
+        if len(self._buffer) < end:
+            return None
+        data = bytes(self._buffer[HEADER.size:end])
+        del self._buffer[:end]
+        return data
+
+    def pending(self):
+        """
+        Returns:
+            bytes: anything buffered but not yet returned as a frame
+        """
+        return bytes(self._buffer)
@@ -1,17 +1,44 @@
 from __future__ import print_function
+import errno
+import io
+import json
 import os
 import logging
+import signal
 import subprocess
 import sys
-import threading
-from collections import namedtuple
+import time
+import warnings
 from contextlib import contextmanager
+from functools import partial
+from importlib import import_module
 
 import six
 from django.conf import settings
-from django.core.management import call_command
+from django.db import connections
+try:
+    # Django 1.8+
+    from django.db.backends.base.creation import TEST_DATABASE_PREFIX
+except ImportError:
+    from django.db.backends.creation import TEST_DATABASE_PREFIX
 
-from . import b64pickle, errors
+from . import binpickle, errors, payload, transport
+from .metrics import rusage_metrics
+from .output import OutputLogger
+from .supervisor import (
+    Job,
+    kill_process,
+    NEW_PROCESS_GROUP,
+    read_available,
+    READ,
+    reap_process,
+    run_job,
+    set_cloexec,
+    set_nonblocking,
+    signal_group,
+    SubprocessRun,
+    WRITE,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -19,64 +46,449 @@ logger = logging.getLogger(__name__)
 
 SUBPROCESS_TIMEOUT = int(os.environ.get('DJANGO_CONCURRENT_TESTS_TIMEOUT', '30'))
 
+MODES = ('subprocess', 'pool', 'forkserver', 'threads')
 
-SubprocessRun = namedtuple('SubprocessRun', ['manager', 'result'])
+# env var passing the test dbs of the parent to the processes making calls
+TEST_DATABASES_ENV = 'DJANGO_CONCURRENT_TESTS_DATABASES'
 
 
-class ProcessManager(object):
+class ProcessManager(Job):
+    """
+    Runs `cmd` in a subprocess, supervised by a `supervisor.Supervisor`
+    (or on its own by `run`), collecting its stdout and logging its stderr
+    as it comes (see `output.OutputLogger`).
+    """
 
-    def __init__(self, cmd):
+    def __init__(self, cmd, pass_fds=(), timeout=SUBPROCESS_TIMEOUT, input=None, env=None):
         """
         Kwargs:
             cmd (Union[str, List[str]]): `args` arg to `Popen` call 
+            pass_fds (Sequence[int]): fds to be inherited by the subprocess
+            env (Optional[Dict[str, str]]): to add to the subprocess'
+                environment (a copy of `os.environ` at start time)
+            timeout (Float): how long to wait for the subprocess to
+                complete task
+            input (Optional[bytes]): to write to the subprocess' stdin
         """
+        super(ProcessManager, self).__init__(timeout)
         self.cmd = cmd
+        self.pass_fds = pass_fds
+        self.input = input
+        self.env = env or {}
         self.process = None
         self.stdout = None
         self.stderr = None
         self.terminated = False  # whether subprocess was terminated by timeout
+        self.spawned_at = None
+        self._input = None
+        self._stdout = []
+        self._stderr = None  # `output.OutputLogger`
 
-    def run(self, timeout):
+    def run(self, timeout, input=None):
         """
         Kwargs:
             timeout (Float): how long to wait for the subprocess to complete task
+            input (Optional[bytes]): to write to the subprocess' stdin
 
         Returns:
             str: stdout output from subprocess
         """
-        def target():
-            env = os.environ.copy()
-            env['DJANGO_CONCURRENT_TESTS_PARENT_PID'] = str(os.getpid())
-            self.process = subprocess.Popen(
-                self.cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=env,
-            )
-            logger.debug('[{pid}] {cmd}'.format(pid=self.process.pid, cmd=' '.join(self.cmd)))
-            self.stdout, self.stderr = self.process.communicate()
-
-        thread = threading.Thread(target=target)
-        thread.start()
-
-        thread.join(timeout)
-        if thread.is_alive():
-            # we reached the timeout deadline with process still running
-            if self.process:
-                logger.debug('[{pid}] reached timeout: terminating...'.format(pid=self.process.pid))
-                self.process.terminate()
-                logger.debug('[{pid}] reached timeout: terminated.'.format(pid=self.process.pid))
+        self.timeout = timeout
+        self.input = input
+        run_job(self)
+        if self.error is not None:
+            self.error.reraise()
+        return self.stdout
+
+    def start(self, supervisor):
+        super(ProcessManager, self).start(supervisor)
+        env = os.environ.copy()
+        env.update(self.env)
+        env['DJANGO_CONCURRENT_TESTS_PARENT_PID'] = str(os.getpid())
+        # its own process group, so that a timeout can stop anything it
+        # started too, and nothing it started outlives the call
+        popen_kwargs = dict(NEW_PROCESS_GROUP)
+        if six.PY3:
+            # (on Python 2 all fds are inherited, except those we marked
+            # with `set_cloexec`)
+            popen_kwargs['pass_fds'] = self.pass_fds
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdin=subprocess.PIPE if self.input is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            **popen_kwargs
+        )
+        self.spawned_at = time.time()
+        self.metrics.spawn = self.spawned_at - self.started_at
+        logger.debug('[{pid}] {cmd}'.format(pid=self.process.pid, cmd=' '.join(self.cmd)))
+
+        self._stderr = OutputLogger(self.process.pid, self.call_index)
+        for pipe in (self.process.stdout, self.process.stderr):
+            set_nonblocking(pipe.fileno())
+            set_cloexec(pipe.fileno())
+            self.watch(pipe.fileno(), READ, partial(self._on_output, pipe))
+        if self.input is not None:
+            self._input = bytearray(self.input)
+            set_nonblocking(self.process.stdin.fileno())
+            set_cloexec(self.process.stdin.fileno())
+            self.watch(self.process.stdin.fileno(), WRITE, self._on_input)
+
+    def _close_stdin(self):
+        self.unwatch(self.process.stdin.fileno())
+        self.process.stdin.close()
+
+    def _on_input(self, events):
+        try:
+            written = os.write(self.process.stdin.fileno(), self._input)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            if e.errno != errno.EPIPE:
+                raise
+            # (the subprocess exited without reading all its input, same as
+            # `communicate` we leave it to the caller to make sense of that)
+            written = len(self._input)
+        del self._input[:written]
+        if not self._input:
+            self._close_stdin()
+
+    def _on_output(self, pipe, events):
+        fd = pipe.fileno()
+        chunk = read_available(fd)
+        if chunk is None:
+            return
+        if chunk:
+            if pipe is self.process.stderr:
+                self._stderr.feed(chunk)
             else:
-                logger.debug('reached timeout: process did not start.')
-            self.terminated = True
-            thread.join()
+                self._stdout.append(chunk)
+            return
+        self.unwatch(fd)
+        pipe.close()
+        if all(pipe.closed for pipe in (self.process.stdout, self.process.stderr)):
+            # both closed by the subprocess, so it's exiting
+            rusage = reap_process(self.process)
+            if rusage is not None:
+                self.metrics.update(rusage_metrics(rusage))
+            self.finish()
+
+    def on_timeout(self):
+        # we reached the timeout deadline with process still running
+        logger.debug('[{pid}] reached timeout: terminating...'.format(pid=self.process.pid))
+        self.terminated = True
+        signal_group(self.process.pid, signal.SIGTERM)
+
+    def on_kill(self):
+        logger.debug('[{pid}] still running after SIGTERM: killing...'.format(pid=self.process.pid))
+        kill_process(self.process)
+        self.finish()
+
+    def cleanup(self):
+        if self.process is None:
+            return
+        for pipe in (self.process.stdin, self.process.stdout, self.process.stderr):
+            if pipe is not None and not pipe.closed:
+                self.unwatch(pipe.fileno())
+                pipe.close()
+        # (also gets rid of anything left behind in the process group)
+        kill_process(self.process)
+        self.stdout = b''.join(self._stdout)
+        self._stderr.close()
+        self.stderr = self._stderr.tail
 
-        if self.stderr:
-            logger.error(self.stderr)
+    def abort(self):
+        if self.process is not None:
+            self.terminated = True
+        super(ProcessManager, self).abort()
 
+    def get_result(self):
         return self.stdout
 
 
+def get_mode(mode=None):
+    """
+    Validate the execution `mode` for the helpers, or if not given, get
+    the default from the `DJANGO_CONCURRENT_TESTS_MODE` env var or else
+    the `CONCURRENT_TESTS_MODE` Django setting.
+
+    Returns:
+        str: one of `MODES`
+    """
+    mode = (
+        mode or
+        os.environ.get('DJANGO_CONCURRENT_TESTS_MODE') or
+        getattr(settings, 'CONCURRENT_TESTS_MODE', 'subprocess')
+    )
+    if mode not in MODES:
+        raise ValueError(
+            'Invalid mode {mode!r}, expected one of: {modes}'.format(
+                mode=mode, modes=', '.join(MODES),
+            )
+        )
+    return mode
+
+
+# env vars which change all the time, but mean nothing to the processes
+# making calls (e.g. pytest's, set to each test in turn)
+VOLATILE_ENV_VARS = frozenset(['PYTEST_CURRENT_TEST'])
+
+
+def get_session_key():
+    """
+    Long-lived worker processes are only reusable by a parent with the
+    same settings module, (test) db names and environment.
+
+    Returns:
+        tuple: hashable key identifying the current test session
+    """
+    return (
+        getattr(settings, 'SETTINGS_MODULE', None),
+        tuple(sorted(
+            (alias, database['NAME'])
+            for alias, database in get_test_databases().items()
+        )),
+        tuple(sorted(
+            (name, value) for name, value in os.environ.items()
+            if name not in VOLATILE_ENV_VARS
+        )),
+    )
+
+
+def _get_test_mirror(settings_dict):
+    # Django 1.7+ | Django < 1.7
+    return (
+        settings_dict.get('TEST', {}).get('MIRROR') or
+        settings_dict.get('TEST_MIRROR')
+    )
+
+
+def _is_test_database(connection):
+    """
+    Returns:
+        bool: whether `connection` has been switched to its test db (as far
+            as we can tell from its name)
+    """
+    name = connection.settings_dict['NAME'] or ''
+    return (
+        name == connection.creation._get_test_db_name() or
+        # (e.g. the clones of a parallel test run)
+        os.path.basename(name).startswith(TEST_DATABASE_PREFIX)
+    )
+
+
+def get_test_databases():
+    """
+    The dbs which our connections are using, i.e. once the test runner has
+    set up the test dbs, those. The processes making calls switch to the
+    same dbs (see `concurrent_call_wrapper.use_test_databases`), without
+    having to work them out for themselves.
+
+    Any connection not switched to a test db yet (e.g. in the first test
+    of a run which doesn't use the db itself) gets the test db worked out
+    from our settings instead: the calls never get the real db.
+
+    Returns:
+        Dict[str, Dict[str, str]]: alias -> `{'NAME': db name}`, plus the
+            `'MIRROR'` alias for test mirrors (so that they can share its
+            features)
+    """
+    resolved = None
+    databases = {}
+    for alias in connections:
+        connection = connections[alias]
+        name = connection.settings_dict['NAME']
+        if not _is_test_database(connection):
+            if resolved is None:
+                # (it imports from here)
+                from .management.commands.concurrent_call_wrapper import (
+                    resolve_test_databases,
+                )
+                resolved = resolve_test_databases()
+            databases[alias] = resolved[alias]
+            continue
+        if connection.vendor == 'sqlite' and (
+                name == ':memory:' or 'mode=memory' in name):
+            # NOTE: if using sqlite for tests, be sure to specify a
+            # TEST_NAME / TEST:NAME with a real filename to avoid using
+            # in-memory db
+            warnings.warn(
+                "In-memory databases can't be shared between concurrent "
+                "test processes. {alias} -> {name}".format(alias=alias, name=name)
+            )
+        databases[alias] = {'NAME': name}
+        mirror = _get_test_mirror(connection.settings_dict)
+        if mirror:
+            databases[alias]['MIRROR'] = mirror
+    return databases
+
+
+def get_test_databases_env():
+    """
+    Returns:
+        Dict[str, str]: env var passing `get_test_databases()` on to a
+            process making calls
+    """
+    return {TEST_DATABASES_ENV: json.dumps(get_test_databases(), sort_keys=True)}
+
+
+def get_function_path(f):
+    """
+    Args:
+        f (Union[function, str]): the function to call, or
+            the 'dotted module.path.to:function' as a string
+
+    Returns:
+        str: 'dotted module.path.to:function' path for `f`
+    """
+    if isinstance(f, six.string_types):
+        return f
+    return '{module}:{name}'.format(
+        module=f.__module__,
+        name=f.__name__,
+    )
+
+
+def import_function(func_path):
+    """
+    Args:
+        func_path (str): 'dotted module.path.to:function' (NOTE colon
+            separates the name to import)
+
+    Returns:
+        function
+    """
+    module_name, function_name = func_path.split(':')
+    module = import_module(module_name)
+    try:
+        return getattr(module, function_name)
+    except AttributeError:
+        print(
+            "Could not import '{module}.{func}', you may need to use "
+            "https://github.com/depop/django-concurrent-test-helper/#string-import-paths"
+            .format(module=module_name, func=function_name)
+        )
+        raise
+
+
+def get_call_cmd(function_path):
+    """
+    Returns:
+        Tuple[List[str], Dict[str, str]]: command to make a call to
+            `function_path` in a fresh subprocess, with the pickled kwargs
+            in a frame on its stdin, and any env vars it needs
+    """
+    # (not `settings.SETTINGS_MODULE`, hidden by `override_settings`)
+    settings_module = os.environ.get('DJANGO_SETTINGS_MODULE')
+    if not settings_module or getattr(settings, 'CONCURRENT_TESTS_USE_MANAGE_PY', False):
+        cmd = [
+            getattr(settings, 'MANAGE_PY_PATH', './manage.py'),
+            'concurrent_call_wrapper',
+            function_path,
+            # read from stdin, big kwargs don't fit in argv
+            '--kwargs=-',
+            '--serializer=pickle',
+        ]
+        return cmd, get_test_databases_env()
+    # much quicker to start up (see `worker.main`), but needs to find the
+    # settings, and anything they import, without the help of manage.py
+    cmd = [
+        sys.executable,
+        '-m', 'django_concurrent_tests.worker',
+        '--settings', settings_module,
+        function_path,
+    ]
+    env = get_test_databases_env()
+    env['PYTHONPATH'] = os.pathsep.join(os.path.abspath(path) for path in sys.path)
+    return cmd, env
+
+
+class SubprocessCall(ProcessManager):
+    """
+    A call made in a fresh subprocess, `python -m django_concurrent_tests.worker`
+    or `manage.py concurrent_call_wrapper` (see `get_call_cmd`).
+    """
+
+    def __init__(self, f, kwargs, timeout=SUBPROCESS_TIMEOUT):
+        """
+        Kwargs:
+            f (Union[function, str]): the function to call
+            kwargs (dict): kwargs to pass to `function`
+            timeout (Float): how long to wait for the call to complete
+        """
+        super(SubprocessCall, self).__init__(cmd=None, timeout=timeout)
+        self.function_path = get_function_path(f)
+        self.kwargs = kwargs
+        self._result = None  # see `payload.claim`
+
+    def start(self, supervisor):
+        self.cmd, self.env = get_call_cmd(self.function_path)
+        barrier = self.barrier
+        if barrier is not None:
+            self.cmd.append('--barrier=%d,%d' % barrier.child_fds)
+            self.pass_fds = barrier.child_fds
+        self.input = transport.encode_frame(payload.dumps(
+            binpickle.dumps(self.kwargs), in_file=False,
+            metrics=self.metrics, name='kwargs',
+        ))
+        super(SubprocessCall, self).start(supervisor)
+
+    def _read_frames(self):
+        """
+        Returns:
+            Tuple[Optional[bytes], Optional[bytes]]: the metrics frame (see
+                `worker.write_result`), if any, and the result frame from
+                the subprocess' stdout
+        """
+        stdout = io.BytesIO(self.stdout or b'')
+        result = transport.read_frame(stdout)
+        if result:
+            following = transport.read_frame(stdout)
+            if following is not None:
+                return result, following
+        return None, result
+
+    def cleanup(self):
+        super(SubprocessCall, self).cleanup()
+        if self.process is None:
+            return
+        # (whatever goes wrong, `get_result` will tell)
+        try:
+            _, result = self._read_frames()
+            if result:
+                self._result = payload.claim(result)
+        except Exception:
+            pass
+
+    def get_result(self):
+        if self.terminated:
+            raise errors.TerminatedProcessError(self.stdout)
+        # deserialize the result from subprocess run
+        # (any error raised when running the concurrent func will be stored in `result`)
+        metrics, result = self._read_frames()
+        if metrics is not None:
+            metrics = binpickle.loads(metrics)
+            self.metrics.boot = metrics.pop('started_at') - self.spawned_at
+            self.metrics.update(metrics)
+        if not result:
+            return None
+        return payload.loads(self._result if self._result is not None else result)
+
+
+def subprocess_job(f, kwargs, timeout=SUBPROCESS_TIMEOUT):
+    """
+    Returns:
+        supervisor.Job: to call `f` in a fresh subprocess (or in a thread,
+            as in 'threads' mode, if the `CONCURRENT_TESTS_NO_SUBPROCESS`
+            env var is set)
+    """
+    if os.environ.get('CONCURRENT_TESTS_NO_SUBPROCESS'):
+        from .threads import thread_job
+        return thread_job(f, kwargs, timeout=timeout)
+    return SubprocessCall(f, kwargs, timeout=timeout)
+
+
 def run_in_subprocess(f, **kwargs):
     """
     Args:
@@ -94,50 +506,7 @@ def run_in_subprocess(f, **kwargs):
         `kwargs` must be pickleable
         <return value> of `function` must be pickleable
     """
-    # wrap everything in a catch-all except to avoid hanging the subprocess
-    try:
-        serialized_kwargs = b64pickle.dumps(kwargs)
-
-        if isinstance(f, six.string_types):
-            function_path = f
-        else:
-            function_path = '{module}:{name}'.format(
-                module=f.__module__,
-                name=f.__name__,
-            )
-
-        if not os.environ.get('CONCURRENT_TESTS_NO_SUBPROCESS'):
-            cmd = [
-                getattr(settings, 'MANAGE_PY_PATH', './manage.py'),
-                'concurrent_call_wrapper',
-                function_path,
-                '--kwargs=%s' % serialized_kwargs,
-            ]
-            manager = ProcessManager(cmd)
-            result = manager.run(timeout=SUBPROCESS_TIMEOUT)
-            if manager.terminated:
-                raise errors.TerminatedProcessError(result)
-        else:
-            logger.debug('Calling {f} in current process'.format(f=function_path))
-            manager = None
-            # TODO: collect stdout and maybe log it from here
-            result = call_command(
-                'concurrent_call_wrapper',
-                function_path,
-                kwargs=serialized_kwargs,
-            )
-        # deserialize the result from subprocess run
-        # (any error raised when running the concurrent func will be stored in `result`)
-        return SubprocessRun(
-            manager=manager,
-            result=b64pickle.loads(result) if result else None,
-        )
-    except Exception as e:
-        # handle any errors which occurred during setup of subprocess
-        return SubprocessRun(
-            manager=manager,
-            result=errors.WrappedError(e),
-        )
+    return run_job(subprocess_job(f, kwargs))
 
 
 @contextmanager
@@ -148,6 +517,32 @@ def redirect_stdout(to):
     sys.stdout = original
 
 
+@contextmanager
+def override_switch_interval(interval):
+    """
+    Have the threads of the current process take turns at holding the GIL
+    every `interval` seconds meanwhile (see `sys.setswitchinterval`), e.g.
+    0.000001 to interleave them as often as possible.
+
+    Args:
+        interval (Optional[Float]): if None, leave it as it is
+    """
+    if interval is None:
+        yield
+        return
+    if not hasattr(sys, 'setswitchinterval'):
+        # Python 2 switches every N bytecodes instead
+        warnings.warn('switch_interval needs Python 3.2+, ignored')
+        yield
+        return
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(interval)
+    try:
+        yield
+    finally:
+        sys.setswitchinterval(old_interval)
+
+
 @contextmanager
 def override_environment(**kwargs):
     """
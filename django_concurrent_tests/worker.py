@@ -0,0 +1,251 @@
+from __future__ import print_function
+import argparse
+import os
+import random
+import select
+import sys
+import time
+import traceback
+from multiprocessing import reduction
+
+import django
+
+from . import binpickle, errors, payload
+from .management.commands.concurrent_call_wrapper import (
+    close_db_connections,
+    count_open_db_connections,
+    counting_db_connects,
+    dump_result,
+    make_call,
+    open_db_connections,
+    reset_db_connections,
+    wrap_error,
+    write_result,
+)
+from .metrics import call_timing, get_rusage, monotonic, rusage_metrics
+from .transport import read_frame, write_frame
+from .utils import import_function, redirect_stdout
+
+
+def execute_job(job, wait_for_start, reuse_db_connections=False):
+    """
+    Args:
+        job (bytes): pickled `(func_path, kwargs)` tuple (see `payload`)
+        wait_for_start (Callable[[], None]): called once the function is
+            imported and db connections are open, blocks until the parent
+            tells us to go (see `barrier.StartBarrier`)... we always call
+            it, even after a failed setup, so that the parent can count on
+            hearing from us
+        reuse_db_connections (bool): keep our db connections open for the
+            next job (see `reset_db_connections`), else they are closed...
+            as they are after a failed call anyway, as we can't tell what
+            state it left them in
+
+    Returns:
+        Tuple[dict, bytes]: metrics of the call (see
+            `metrics.CallMetrics`) and the pickled result of the call
+    """
+    usage_before = get_rusage()
+    metrics = {'db_reuses': count_open_db_connections()}
+    f = None
+    with counting_db_connects(metrics):
+        try:
+            func_path, f_kwargs = payload.loads(job)
+            f = import_function(func_path)
+            start = time.time()
+            open_db_connections()
+            metrics['db_setup'] = time.time() - start
+        except Exception as e:
+            result = wrap_error(e)
+
+        wait_for_start()
+
+        if f is not None:
+            start = monotonic()
+            try:
+                try:
+                    result = f(**f_kwargs)
+                finally:
+                    metrics.update(call_timing(start, monotonic()))
+            except Exception as e:
+                result = wrap_error(e)
+    try:
+        if reuse_db_connections and not isinstance(result, errors.WrappedError):
+            reset_db_connections()
+        else:
+            close_db_connections()
+    except Exception as e:
+        result = wrap_error(e)
+    metrics.update(rusage_metrics(get_rusage(), since=usage_before))
+    return metrics, dump_result(binpickle.dumps, result)
+
+
+def _handshake(stream_in, stream_out):
+    """
+    Worker side of the start barrier for workers talking to the parent over
+    a stream: say we're 'ready', then wait for the 'go' frame.
+    """
+    write_frame(stream_out, b'ready')
+    read_frame(stream_in)
+
+
+def serve(infile, outfile, reuse_db_connections=False):
+    """
+    Worker loop for a long-lived worker process (see `pool.WorkerPool`).
+
+    Reads one job per frame from `infile`, a pickled
+    `(func_path, kwargs)` tuple, and writes the pickled metrics and
+    result of the call back to `outfile` (see `write_result`). In
+    between, once set up for the call, we write a 'ready' frame and wait
+    for a 'go' frame before making the call. Returns when `infile` is
+    closed by the parent.
+
+    Args:
+        infile: binary file-like, our stdin
+        outfile: binary file-like, our stdout
+        reuse_db_connections (bool): keep db connections open from one
+            call to the next
+    """
+    # redirect any printing that may occur from stdout->stderr
+    # so as not to pollute our output (see `concurrent_call_wrapper`)
+    with redirect_stdout(sys.stderr):
+        while True:
+            job = read_frame(infile)
+            if job is None:
+                break
+            metrics, result = execute_job(
+                job,
+                lambda: _handshake(infile, outfile),
+                reuse_db_connections=reuse_db_connections,
+            )
+            write_result(outfile, metrics, result)
+
+
+def _handle_forked_call(conn):
+    # our own stderr, from the parent (see `forkserver.ForkedProcess`)
+    stderr_fd = reduction.recv_handle(conn)
+    sys.stderr.flush()
+    os.dup2(stderr_fd, 2)
+    os.close(stderr_fd)
+    stream = conn.makefile('rwb')
+    # let the parent know who to terminate in case of timeout
+    write_frame(stream, str(os.getpid()).encode('ascii'))
+    job = read_frame(stream)
+    if job is not None:
+        metrics, result = execute_job(job, lambda: _handshake(stream, stream))
+        # (so that the parent has all our output once it has the result)
+        sys.stderr.flush()
+        write_result(stream, metrics, result)
+    stream.close()
+    conn.close()
+
+
+def _reap(children):
+    for pid in list(children):
+        try:
+            reaped, _ = os.waitpid(pid, os.WNOHANG)
+        except OSError:
+            # not our child any more
+            reaped = pid
+        if reaped:
+            children.discard(pid)
+
+
+def serve_forks(listener, control):
+    """
+    Fork server loop (see `forkserver.ForkServer`).
+
+    Accepts a connection on `listener` for every call and forks a child
+    process to handle it. The child inherits our already initialised
+    Django (any db connections must have been closed before we get here),
+    receives its stderr over the connection, writes its pid to it, then handles a single job with the
+    same protocol as `serve`. Each child leads its own process group.
+    Returns when `control` is closed by the parent.
+
+    Args:
+        listener (socket.socket): bound and listening socket
+        control: file-like, our stdin
+    """
+    children = set()
+    with redirect_stdout(sys.stderr):
+        while True:
+            readable, _, _ = select.select([listener, control], [], [], 1)
+            _reap(children)
+            if control in readable and not os.read(control.fileno(), 1024):
+                break
+            if listener not in readable:
+                continue
+            conn, _ = listener.accept()
+            pid = os.fork()
+            if pid == 0:
+                # in the child
+                try:
+                    listener.close()
+                    # our own process group, so that the parent can kill
+                    # us along with anything we start, but not the server
+                    os.setpgid(0, 0)
+                    # don't share the random sequence with our siblings
+                    random.seed()
+                    _handle_forked_call(conn)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    sys.stderr.flush()
+                    # skip atexit handlers etc inherited from the server
+                    os._exit(0)
+            conn.close()
+            children.add(pid)
+
+
+def main(argv=None):
+    """
+    Entry point of a process making a single call (see
+    `utils.get_call_cmd`):
+
+        python -m django_concurrent_tests.worker --settings=SETTINGS \\
+            [--barrier=READY_FD,GO_FD] [--no-test-db] path.to.module:function
+
+    Same as `manage.py concurrent_call_wrapper --kwargs=- --serializer=pickle`
+    (see `make_call`) but does only `django.setup()` first. So we don't pay for `manage.py` finding and loading the
+    management command, nor for the system checks it runs first.
+
+    Reads the pickled kwargs from a frame on stdin, writes the metrics and
+    the result to stdout (see `write_result`).
+    """
+    parser = argparse.ArgumentParser(prog='python -m django_concurrent_tests.worker')
+    parser.add_argument(
+        '--settings', required=True,
+        help='Python path of the settings module, e.g. "myproject.settings"',
+    )
+    parser.add_argument(
+        '-t', '--no-test-db',
+        help="Don't patch connection to use test db",
+        action='store_true',
+    )
+    parser.add_argument(
+        '-b', '--barrier',
+        help='READY_FD,GO_FD inherited from parent, wait on these '
+             'start barrier pipes before calling the function',
+    )
+    parser.add_argument('funcpath', help='path.to.module:function_name')
+    args = parser.parse_args(argv)
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = args.settings
+    if hasattr(django, 'setup'):
+        # Django 1.7+
+        django.setup()
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    def load_call():
+        f = import_function(args.funcpath)
+        return f, payload.loads(read_frame(stdin))
+
+    metrics, result = make_call(
+        load_call, no_test_db=args.no_test_db, barrier=args.barrier,
+    )
+    write_result(stdout, metrics, dump_result(binpickle.dumps, result))
+
+
+if __name__ == '__main__':
+    main()
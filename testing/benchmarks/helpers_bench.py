@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+Benchmark: what the concurrency helpers cost per call, for each execution
+mode, number of concurrent calls and size of the kwargs payload.
+
+For each combination we report the latency of a call (as seen by the
+parent, from starting the call until we had its result), calls/sec for
+the whole batch and the peak memory allocated by the parent while making
+the calls (Python 3.4+, via `tracemalloc`).
+
+Needs the settings of one of the test projects, as for the tests (see
+tox.ini), e.g. from the repo root:
+
+    PYTHONPATH=.:testing:testing/tests:testing/tests/py3-dj111_testproject \\
+    DJANGO_SETTINGS_MODULE=py3-dj111_testproject.settings \\
+    python testing/benchmarks/helpers_bench.py --json > helpers_bench.json
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python < 3.4
+    tracemalloc = None
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner
+
+from django_concurrent_tests.helpers import make_concurrent_calls
+
+
+MODES = ('subprocess', 'pool', 'forkserver', 'threads')
+
+CONCURRENCY = (1, 8, 64, 256)
+
+PAYLOADS = {
+    'none': None,
+    '1KB': 'x' * 1024,
+    '64KB': 'x' * (64 * 1024),
+    '1MB': 'x' * (1024 * 1024),
+}
+
+# payloads are compared at this concurrency (all of them at every
+# concurrency would take forever)
+PAYLOAD_CONCURRENCY = 8
+
+
+def _calls(concurrency, payload):
+    """
+    Returns:
+        Tuple[List[Tuple[str, dict]], Any]: the calls, and the result
+            we expect from each
+    """
+    if payload is None:
+        call = ('tests.funcs_to_test:simple', {})
+        expected = True
+    else:
+        call = ('tests.funcs_to_test:echo', {'value': payload})
+        expected = payload
+    return [call] * concurrency, expected
+
+
+def make_calls(mode, calls):
+    """
+    Returns:
+        List[SubprocessRun]
+    """
+    return make_concurrent_calls(*calls, mode=mode, return_runs=True)
+
+
+def measure(mode, concurrency, payload_name, repeat):
+    """
+    Returns:
+        dict: result row, timings from the fastest of `repeat` batches
+    """
+    calls, expected = _calls(concurrency, PAYLOADS[payload_name])
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        runs = make_calls(mode, calls)
+        elapsed = time.time() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, runs)
+    elapsed, runs = best
+    latencies = sorted(run.metrics.wall for run in runs)
+
+    parent_peak = None
+    if tracemalloc is not None:
+        # separately, as tracing slows us down
+        tracemalloc.start()
+        try:
+            make_calls(mode, calls)
+            _, parent_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'mode': mode,
+        'concurrency': concurrency,
+        'payload': payload_name,
+        'seconds': elapsed,
+        'calls_per_sec': concurrency / elapsed,
+        'latency_mean': sum(latencies) / len(latencies),
+        'latency_max': latencies[-1],
+        'parent_peak_bytes': parent_peak,
+        # e.g. a WrappedError
+        'failed': sum(run.result != expected for run in runs),
+    }
+
+
+def run(modes=MODES, concurrency=CONCURRENCY, repeat=3):
+    """
+    Returns:
+        List[dict]: one result row per mode, concurrency & payload
+    """
+    combinations = [
+        (c, 'none') for c in concurrency
+    ] + [
+        (PAYLOAD_CONCURRENCY, name) for name in sorted(PAYLOADS) if name != 'none'
+    ]
+    rows = []
+    for mode in modes:
+        if mode in ('pool', 'forkserver'):
+            # boot the workers / fork server before we start timing
+            calls, _ = _calls(max(c for c, _ in combinations), None)
+            make_calls(mode, calls)
+        for c, payload_name in combinations:
+            rows.append(measure(mode, c, payload_name, repeat))
+    return rows
+
+
+def setup_django():
+    """
+    Set up Django and the test dbs, as a test runner would.
+
+    Returns:
+        Callable[[], None]: to tear them down again
+    """
+    if hasattr(django, 'setup'):
+        # Django 1.7+
+        django.setup()
+    runner = get_runner(settings)(verbosity=0)
+    runner.setup_test_environment()
+    old_config = runner.setup_databases()
+
+    def teardown():
+        runner.teardown_databases(old_config)
+        runner.teardown_test_environment()
+
+    return teardown
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--modes', default=','.join(MODES),
+        help='comma-separated, any of: %s' % ', '.join(MODES),
+    )
+    parser.add_argument(
+        '--concurrency', default=','.join(map(str, CONCURRENCY)),
+        help='comma-separated numbers of concurrent calls',
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--json', action='store_true', help='output the result rows as JSON',
+    )
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        rows = run(
+            modes=args.modes.split(','),
+            concurrency=[int(c) for c in args.concurrency.split(',')],
+            repeat=args.repeat,
+        )
+    finally:
+        teardown()
+
+    if args.json:
+        print(json.dumps(rows, indent=2, sort_keys=True))
+        return
+    print('{:<11} {:>5} {:<7} {:>9} {:>10} {:>10} {:>12} {:>6}'.format(
+        'mode', 'calls', 'payload', 'calls/s', 'latency', 'max', 'parent peak',
+        'failed',
+    ))
+    for row in rows:
+        print('{mode:<11} {concurrency:>5} {payload:<7} {calls_per_sec:>9.1f} '
+              '{latency_mean:>9.3f}s {latency_max:>9.3f}s {peak:>12} '
+              '{failed:>6}'.format(
+                  peak='-' if row['parent_peak_bytes'] is None
+                  else row['parent_peak_bytes'],
+                  **row
+              ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark: encode/decode throughput of `b64pickle` vs `binpickle`
+for some typical kwargs/results payloads.
+
+Usage (from the repo root):
+
+    PYTHONPATH=. python testing/benchmarks/serializers_bench.py [--json]
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import timeit
+
+from django_concurrent_tests import b64pickle, binpickle
+from django_concurrent_tests.errors import WrappedError
+
+
+def _wrapped_error():
+    def inner(depth):
+        if depth:
+            return inner(depth - 1)
+        raise ValueError('WTF')
+    try:
+        inner(20)
+    except ValueError as e:
+        return WrappedError(e)
+
+
+PAYLOADS = {
+    'small dict': {'id_': 1, 'name': 'whatever'},
+    '1k dicts': [
+        {'id': i, 'name': 'item %d' % i, 'price': i * 1.5, 'tags': ['a', 'b']}
+        for i in range(1000)
+    ],
+    '1KB str': 'x' * 1024,
+    '64KB str': 'x' * (64 * 1024),
+    '1MB str': 'x' * (1024 * 1024),
+    'WrappedError': _wrapped_error(),
+}
+
+SERIALIZERS = (
+    ('b64pickle', b64pickle),
+    ('binpickle', binpickle),
+)
+
+
+def measure(func, min_time=0.2):
+    """
+    Returns:
+        float: seconds per call
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            return elapsed / number
+        number *= 2
+
+
+def run():
+    """
+    Returns:
+        List[dict]: one result row per payload & serializer
+    """
+    rows = []
+    for payload_name, obj in sorted(PAYLOADS.items()):
+        for serializer_name, serializer in SERIALIZERS:
+            encoded = serializer.dumps(obj)
+            dumps_time = measure(lambda: serializer.dumps(obj))
+            loads_time = measure(lambda: serializer.loads(encoded))
+            rows.append({
+                'payload': payload_name,
+                'serializer': serializer_name,
+                'size': len(encoded),
+                'dumps_per_sec': 1 / dumps_time,
+                'loads_per_sec': 1 / loads_time,
+                'dumps_mb_per_sec': len(encoded) / dumps_time / 1e6,
+                'loads_mb_per_sec': len(encoded) / loads_time / 1e6,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--json', action='store_true', help='output the result rows as JSON',
+    )
+    args = parser.parse_args()
+
+    rows = run()
+    if args.json:
+        print(json.dumps(rows, indent=2, sort_keys=True))
+        return
+    print('{:<14} {:<10} {:>10} {:>12} {:>12}'.format(
+        'payload', 'serializer', 'bytes', 'dumps/s', 'loads/s',
+    ))
+    for row in rows:
+        print('{payload:<14} {serializer:<10} {size:>10} '
+              '{dumps_per_sec:>12.0f} {loads_per_sec:>12.0f}'.format(**row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Benchmark: how long a 'subprocess' mode call takes to start up, via the
+`python -m django_concurrent_tests.worker` entry point vs the
+`manage.py concurrent_call_wrapper` command (`CONCURRENT_TESTS_USE_MANAGE_PY`).
+
+Makes one call at a time, so they don't compete for the CPU, and reports
+the median `spawn`, `boot` (until Django was set up and ready for the
+call) and `wall` metrics of each (see `metrics.CallMetrics`).
+
+Run it as `helpers_bench.py`, e.g. from the repo root:
+
+    PYTHONPATH=.:testing:testing/tests:testing/tests/py3-dj111_testproject \\
+    DJANGO_SETTINGS_MODULE=py3-dj111_testproject.settings \\
+    python testing/benchmarks/startup_bench.py [--json]
+"""
+from __future__ import print_function, division
+import argparse
+import json
+
+from django.test.utils import override_settings
+
+from django_concurrent_tests.helpers import make_concurrent_calls
+
+from helpers_bench import setup_django
+
+
+ENTRY_POINTS = (
+    ('worker module', False),
+    ('manage.py', True),
+)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def run(calls=10):
+    """
+    Returns:
+        List[dict]: one result row per entry point
+    """
+    rows = []
+    for name, use_manage_py in ENTRY_POINTS:
+        metrics = []
+        with override_settings(CONCURRENT_TESTS_USE_MANAGE_PY=use_manage_py):
+            for _ in range(calls):
+                run, = make_concurrent_calls(
+                    ('tests.funcs_to_test:simple', {}),
+                    mode='subprocess',
+                    return_runs=True,
+                )
+                assert run.result is True, run.result
+                metrics.append(run.metrics)
+        rows.append({
+            'entry_point': name,
+            'calls': calls,
+            'spawn': median([m.spawn for m in metrics]),
+            'boot': median([m.boot for m in metrics]),
+            'wall': median([m.wall for m in metrics]),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=10)
+    parser.add_argument(
+        '--json', action='store_true', help='output the result rows as JSON',
+    )
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        rows = run(args.calls)
+    finally:
+        teardown()
+
+    if args.json:
+        print(json.dumps(rows, indent=2, sort_keys=True))
+        return
+    print('{:<14} {:>9} {:>9} {:>9}'.format('entry point', 'spawn', 'boot', 'wall'))
+    for row in rows:
+        print('{entry_point:<14} {spawn:>8.3f}s {boot:>8.3f}s {wall:>8.3f}s'.format(**row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# (Python 3.5+ only, see conftest.py)
+import asyncio
+import threading
+import time
+
+import pytest
+
+from django_concurrent_tests.aio import (
+    acall_concurrently,
+    amake_concurrent_calls,
+)
+
+from .aio_test import run
+from .funcs_to_test import simple, timeout
+
+
+def test_batches_share_the_loop():
+    thread_counts = []
+
+    async def batches():
+        return await asyncio.gather(
+            acall_concurrently(2, simple),
+            amake_concurrent_calls(
+                (timeout, {'sleep_for': 0}),
+                on_result=lambda index, result: thread_counts.append(
+                    threading.active_count()
+                ),
+            ),
+        )
+
+    assert run(batches()) == [[True, True], [0]]
+    assert thread_counts == [threading.active_count()]
+
+
+def test_cancel():
+    async def cancelled():
+        await asyncio.wait_for(
+            amake_concurrent_calls((timeout, {'sleep_for': 5}), mode='pool'),
+            timeout=2,
+        )
+
+    start = time.time()
+    with pytest.raises(asyncio.TimeoutError):
+        run(cancelled())
+    assert time.time() - start < 5
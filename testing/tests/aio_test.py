@@ -0,0 +1,75 @@
+import sys
+
+import django
+import pytest
+
+if sys.version_info < (3, 5):
+    pytest.skip('asyncio helpers need Python 3.5+', allow_module_level=True)
+
+# (tests with coroutines of their own are in `aio_coroutines_test`, which
+# wouldn't even compile before Python 3.5)
+
+import asyncio
+
+from django_concurrent_tests.aio import amake_concurrent_calls
+from django_concurrent_tests.errors import (
+    TerminatedProcessError,
+    WrappedError,
+)
+
+from django_concurrent_tests.metrics import get_overlap
+
+from .funcs_to_test import interval, simple, timeout
+
+
+FORKSERVER = pytest.param(
+    'forkserver', marks=pytest.mark.skipif(
+        django.VERSION < (1, 8), reason='forkserver mode requires Django 1.8+',
+    ),
+)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER])
+def test_simple(mode):
+    results = run(amake_concurrent_calls(*[(simple, {})] * 2, mode=mode))
+    assert results == [True, True]
+
+
+def test_require_overlap():
+    seen = []
+    runs = run(amake_concurrent_calls(
+        *[(interval, {'sleep_for': 0.5})] * 2,
+        require_overlap=2,
+        return_runs=True,
+        on_result=lambda index, result: seen.append(index)
+    ))
+
+    assert get_overlap(runs).max_degree == 2
+    assert sorted(seen) == [0, 1]
+
+
+def test_timeout():
+    results = run(amake_concurrent_calls(
+        (timeout, {'sleep_for': 5}),
+        (simple, {}),
+        timeout=2,
+    ))
+
+    assert isinstance(results[0], WrappedError)
+    assert isinstance(results[0].error, TerminatedProcessError)
+    assert results[1] is True
+
+
+def test_switch_interval_not_supported():
+    with pytest.raises(ValueError):
+        run(amake_concurrent_calls(
+            (simple, {}), mode='threads', switch_interval=0.000001,
+        ))
@@ -0,0 +1,91 @@
+import subprocess
+import sys
+import threading
+import time
+
+import django
+import pytest
+
+from django_concurrent_tests.barrier import StartBarrier, wait_for_start
+from django_concurrent_tests.helpers import make_concurrent_calls
+
+from .funcs_to_test import timestamp
+
+
+FORKSERVER = pytest.param(
+    'forkserver', marks=pytest.mark.skipif(
+        django.VERSION < (1, 8), reason='forkserver mode requires Django 1.8+',
+    ),
+)
+
+
+def test_barrier_releases_all_together():
+    barrier = StartBarrier(3, timeout=10)
+    released_at = []
+
+    def party():
+        wait_for_start(*barrier.child_fds)
+        released_at.append(time.time())
+
+    threads = [threading.Thread(target=party) for _ in range(3)]
+    for thread in threads[:2]:
+        thread.start()
+    time.sleep(0.2)
+    # the early arrivals are still waiting for the last one
+    assert released_at == []
+    threads[2].start()
+
+    assert barrier.wait() is True
+    for thread in threads:
+        thread.join(5)
+    barrier.close()
+
+    assert len(released_at) == 3
+    assert max(released_at) - min(released_at) < 0.1
+
+
+def test_barrier_not_held_by_other_processes():
+    barrier = StartBarrier(1, timeout=10)
+    # e.g. a call of another batch, started while we're waiting (on
+    # Python 2 it would inherit all our fds)
+    other = subprocess.Popen(
+        [sys.executable, '-c', 'import time; time.sleep(10)'], close_fds=False,
+    )
+    try:
+        party = threading.Thread(target=wait_for_start, args=barrier.child_fds)
+        party.start()
+
+        assert barrier.wait() is True
+        party.join(5)
+        assert not party.is_alive()
+    finally:
+        other.kill()
+        other.wait()
+        barrier.close()
+
+
+def test_barrier_leave():
+    barrier = StartBarrier(2, timeout=10)
+    barrier.arrive()
+    barrier.leave()
+
+    start = time.time()
+    assert barrier.wait() is True
+    assert time.time() - start < 1
+    assert barrier.released
+    barrier.close()
+
+
+def test_barrier_timeout():
+    barrier = StartBarrier(2, timeout=0.2)
+    barrier.arrive()
+
+    assert barrier.wait() is False
+    assert barrier.released
+    barrier.close()
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER])
+def test_calls_start_together(mode):
+    results = make_concurrent_calls(*[(timestamp, {})] * 4, mode=mode)
+    assert max(results) - min(results) < 0.1
@@ -0,0 +1,61 @@
+# -*- coding: UTF-8 -*-
+from __future__ import unicode_literals
+from datetime import datetime
+from decimal import Decimal
+
+import mock
+import pytest
+import pytz
+
+from django_concurrent_tests import b64pickle, binpickle
+from django_concurrent_tests.errors import WrappedError
+
+from testapp.models import Semaphore
+
+
+@pytest.mark.parametrize('obj', [
+    'whatever 🚀',
+    {'val': 'whatever 🚀'},
+    ['whatever 🚀'],
+    Decimal('3.25'),
+    datetime.now().replace(tzinfo=pytz.UTC),
+])
+def test_roundtrip(obj):
+    encoded = binpickle.dumps(obj)
+    assert binpickle.loads(encoded) == obj
+
+
+@pytest.mark.django_db
+def test_model_queryset():
+    Semaphore.objects.create()
+    obj = list(Semaphore.objects.all())
+    encoded = binpickle.dumps(obj)
+    assert binpickle.loads(encoded) == obj
+
+
+def test_wrapped_error():
+    try:
+        raise ValueError('WTF')
+    except ValueError as e:
+        obj = WrappedError(e)
+    result = binpickle.loads(binpickle.dumps(obj))
+    assert isinstance(result.error, ValueError)
+    assert result.error.args == ('WTF',)
+
+
+def test_smaller_than_b64pickle():
+    obj = [{'id': i, 'name': 'item %d' % i} for i in range(1000)]
+    assert len(binpickle.dumps(obj)) < len(b64pickle.dumps(obj)) / 2
+
+
+def test_error_unpickling():
+    unpickle_error = RuntimeError("Could not unpickle")
+    with mock.patch(
+        'pickle.loads',
+        side_effect=unpickle_error,
+    ):
+        with pytest.raises(b64pickle.PickleLoadsError) as exc_info:
+            binpickle.loads(b'pickled value')
+
+    assert exc_info.value.args[0] == unpickle_error
+    assert exc_info.value.pickled_value == b'pickled value'
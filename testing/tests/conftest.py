@@ -0,0 +1,7 @@
+import sys
+
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # (`async def` is a SyntaxError)
+    collect_ignore.append('aio_coroutines_test.py')
@@ -0,0 +1,135 @@
+import os
+import sys
+import types
+from pprint import pprint
+
+import django
+import pytest
+
+from django_concurrent_tests import forkserver
+from django_concurrent_tests.errors import (
+    TerminatedProcessError,
+    WorkerDiedError,
+    WrappedError,
+)
+from django_concurrent_tests.forkserver import (
+    ForkedProcess,
+    ForkServer,
+    get_fork_server,
+)
+from django_concurrent_tests.helpers import make_concurrent_calls
+from django_concurrent_tests.utils import (
+    override_environment,
+    SUBPROCESS_TIMEOUT,
+)
+
+from testapp.models import Semaphore
+
+from .funcs_to_test import (
+    CustomError,
+    environment,
+    raise_exception,
+    simple,
+    timeout,
+    update_count_transactional,
+)
+
+
+pytestmark = pytest.mark.skipif(
+    django.VERSION < (1, 8), reason='forkserver mode requires Django 1.8+',
+)
+
+
+def test_simple():
+    results = make_concurrent_calls(*[(simple, {})] * 2, mode='forkserver')
+    assert results == [True, True]
+
+
+def test_process_per_call():
+    server = get_fork_server()
+    first = server.run(simple)
+    second = server.run(simple)
+
+    assert isinstance(first.manager, ForkedProcess)
+    assert first.result is True
+    assert second.result is True
+    assert first.manager.pid not in (os.getpid(), server.pid)
+    assert second.manager.pid != first.manager.pid
+    # the server is reused
+    assert get_fork_server() is server
+
+
+@pytest.mark.django_db(transaction=True)
+def test_transactional():
+    obj = Semaphore.objects.create()
+
+    calls = [(update_count_transactional, {'id_': obj.pk})] * 3
+    results = make_concurrent_calls(*calls, mode='forkserver')
+    pprint([str(r) for r in results])
+
+    obj = Semaphore.objects.get(pk=obj.pk)
+    assert results == [True, True, True]
+    assert obj.count == 3
+
+
+def test_exception():
+    results = make_concurrent_calls((raise_exception, {}), mode='forkserver')
+    pprint([str(r) for r in results])
+
+    result = results[0]
+    assert isinstance(result, WrappedError)
+    assert isinstance(result.traceback, types.TracebackType)
+    assert isinstance(result.error, CustomError)
+
+
+def test_timeout():
+    run = get_fork_server().run(timeout, sleep_for=SUBPROCESS_TIMEOUT + 5)
+
+    assert isinstance(run.result, WrappedError)
+    assert isinstance(run.result.error, TerminatedProcessError)
+    assert run.manager.terminated
+
+
+@pytest.mark.parametrize('script', [
+    # exits without a word
+    'import sys; sys.argv.pop()',
+    # says something else, and carries on
+    'import os, struct, time;'
+    ' os.write(1, struct.pack("!Q", 4) + b"nope"); time.sleep(60)',
+])
+def test_failed_start(monkeypatch, tmp_path, script):
+    monkeypatch.setattr(forkserver.tempfile, 'tempdir', str(tmp_path))
+    started = []
+    init = forkserver.WorkerProcess.__init__
+
+    def spy(self, cmd, env):
+        init(self, cmd, env)
+        started.append(self)
+
+    monkeypatch.setattr(forkserver.WorkerProcess, '__init__', spy)
+
+    with pytest.raises(WorkerDiedError):
+        ForkServer(cmd=[sys.executable, '-c', script])
+
+    assert started[0].process.poll() is not None
+    # the socket dir is gone with it
+    assert not os.listdir(str(tmp_path))
+
+
+def test_server_per_session():
+    server = get_fork_server()
+
+    # (pytest sets it to each test in turn)
+    with override_environment(PYTEST_CURRENT_TEST='some other test'):
+        assert get_fork_server() is server
+
+    with override_environment(WTF='superseded'):
+        assert get_fork_server() is not server
+        # the old server is shut down
+        assert not server.is_alive()
+
+
+def test_environment():
+    with override_environment(WTF='forked'):
+        results = make_concurrent_calls((environment, {}), mode='forkserver')
+    assert results == ['forked']
@@ -52,3 +52,82 @@ def timeout(sleep_for):
 def environment():
     import os
     return os.getenv('WTF')
+
+
+def timestamp():
+    import time
+    return time.time()
+
+
+def echo(value):
+    return value
+
+
+def interval(sleep_for):
+    import time
+    start = time.time()
+    sleep(sleep_for)
+    return start, time.time()
+
+
+def stubborn(pid_file):
+    """
+    Ignore SIGTERM and leave a grandchild process running.
+    """
+    import signal
+    import subprocess
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    grandchild = subprocess.Popen(['sleep', '60'])
+    with open(pid_file, 'w') as f:
+        f.write(str(grandchild.pid))
+    sleep(60)
+
+
+def db_connections():
+    """
+    Returns:
+        Dict[str, Tuple[str, bool]]: alias -> db name, whether connected
+    """
+    from django.db import connections
+    return dict(
+        (alias, (connections[alias].settings_dict['NAME'],
+                 connections[alias].connection is not None))
+        for alias in connections
+    )
+
+
+def leave_uncommitted(id_):
+    from django.db import transaction
+    transaction.set_autocommit(False)
+    Semaphore.objects.filter(pk=id_).update(count=F('count') + 1)
+    return True
+
+
+def leave_raw_transaction(id_):
+    from django.db import connection
+    # (a transaction Django doesn't know about)
+    with connection.cursor() as cursor:
+        cursor.execute('BEGIN')
+    Semaphore.objects.filter(pk=id_).update(count=F('count') + 1)
+    return True
+
+
+def get_count(id_):
+    return Semaphore.objects.get(pk=id_).count
+
+
+def fail_in_transaction(id_):
+    from django.db import connection
+    # (a transaction Django doesn't know about)
+    with connection.cursor() as cursor:
+        cursor.execute('BEGIN')
+    Semaphore.objects.filter(pk=id_).update(count=F('count') + 1)
+    raise CustomError('WTF')
+
+
+def chatty():
+    import logging
+    print('just saying')
+    logging.getLogger('tests.chatty').error('oh no')
+    logging.getLogger('tests.chatty').debug('not logged')
+    return True
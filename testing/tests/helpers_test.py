@@ -1,15 +1,26 @@
 import os
+import threading
+import time
 import types
 from pprint import pprint
 
+import django
 import pytest
 from flaky import flaky
 
 from django_concurrent_tests.errors import (
+    DeadlineExceededError,
     TerminatedProcessError,
     WrappedError,
 )
-from django_concurrent_tests.helpers import call_concurrently
+from django_concurrent_tests.helpers import (
+    call_concurrently,
+    hunt_race,
+    iter_concurrent_calls,
+    make_concurrent_calls,
+)
+from django_concurrent_tests.metrics import get_overlap
+from django_concurrent_tests.supervisor import TERMINATE_GRACE
 from django_concurrent_tests.utils import (
     override_environment,
     SUBPROCESS_TIMEOUT,
@@ -19,9 +30,12 @@ from testapp.models import Semaphore
 
 from .funcs_to_test import (
     CustomError,
+    echo,
     environment,
+    interval,
     raise_exception,
     simple,
+    stubborn,
     timeout,
     update_count_naive,
     update_count_transactional,
@@ -29,6 +43,16 @@ from .funcs_to_test import (
 )
 
 
+# (the calls connect to the test db, in threads of the test process)
+THREADS = pytest.param('threads', marks=pytest.mark.django_db(transaction=True))
+
+FORKSERVER = pytest.param(
+    'forkserver', marks=pytest.mark.skipif(
+        django.VERSION < (1, 8), reason='forkserver mode requires Django 1.8+',
+    ),
+)
+
+
 def is_success(result):
     return result is True and not isinstance(result, Exception)
 
@@ -39,23 +63,33 @@ def test_simple():
     assert results == [True, True]
 
 
-@flaky(max_runs=3, min_passes=1)
 @pytest.mark.django_db(transaction=True)
 def test_naive():
-    # call_concurrently should reveal the race condition here
+    # hunt_race should reveal the race condition here
     obj = Semaphore.objects.create()
 
-    concurrency = 5
-    results = call_concurrently(concurrency, update_count_naive, id_=obj.pk)
-    pprint([str(r) for r in results])
-    successes = list(filter(is_success, results))
+    def reset():
+        Semaphore.objects.filter(pk=obj.pk).update(count=0, locked=False)
 
-    obj = Semaphore.objects.get(pk=obj.pk)
+    def check(results):
+        pprint([str(r) for r in results])
+        successes = list(filter(is_success, results))
+        # at least one succeeded
+        assert len(successes) > 0
+        # all successes correctly incremented... until they overwrite
+        # each other
+        return len(successes) == Semaphore.objects.get(pk=obj.pk).count
 
-    # at least one succeeded
-    assert len(successes) > 0
-    # later successes overwrote each other
-    assert len(successes) > obj.count
+    concurrency = 5
+    hunt = hunt_race(
+        [(update_count_naive, {'id_': obj.pk})] * concurrency,
+        check,
+        max_iterations=10,
+        reset=reset,
+    )
+
+    assert hunt.found
+    assert hunt.upper_bound is None
 
 
 @flaky(max_runs=3, min_passes=3)
@@ -131,3 +165,223 @@ def test_environment():
 
     assert os.getenv('WTF') is None
     assert results[0] == 'dude'
+
+
+def test_large_kwargs():
+    # bigger than the kernel allows for a single command line argument
+    value = 'x' * (1024 * 1024)
+    results = call_concurrently(2, echo, value=value)
+    assert results == [value, value]
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER])
+def test_unpicklable_kwargs(mode):
+    results = make_concurrent_calls(
+        (echo, {'value': lambda: None}), (simple, {}), mode=mode,
+    )
+    assert isinstance(results[0], WrappedError)
+    assert results[1] is True
+
+
+def test_iter_concurrent_calls():
+    calls = [
+        (timeout, {'sleep_for': 1}),
+        (timeout, {'sleep_for': 0}),
+    ]
+    seen = []
+    results = list(iter_concurrent_calls(
+        *calls, on_result=lambda index, result: seen.append(index)
+    ))
+
+    # the quicker call completes first
+    assert results == [(1, 0), (0, 1)]
+    assert seen == [1, 0]
+
+
+def test_iter_concurrent_calls_stop_early():
+    calls = [
+        (timeout, {'sleep_for': 5}),
+        (simple, {}),
+    ]
+    start = time.time()
+    for index, result in iter_concurrent_calls(*calls):
+        assert (index, result) == (1, True)
+        break
+    # we didn't wait for the straggler
+    assert time.time() - start < 5
+
+
+def test_supervised_from_calling_thread():
+    thread_counts = []
+    results = make_concurrent_calls(
+        *[(simple, {})] * 4,
+        on_result=lambda index, result: thread_counts.append(
+            threading.active_count()
+        )
+    )
+
+    assert results == [True] * 4
+    # no extra threads per call (or per batch)
+    assert set(thread_counts) == {threading.active_count()}
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', THREADS])
+def test_max_workers(mode):
+    calls = [(interval, {'sleep_for': 0.5})] * 6
+    results = make_concurrent_calls(*calls, mode=mode, max_workers=2)
+
+    assert len(results) == 6
+    for start, end in results:
+        running = [
+            other for other in results if other[0] < end and other[1] > start
+        ]
+        assert len(running) <= 2  # (including this one)
+    # submission order, and each batch of two starts after the one before
+    assert [start for start, _ in results[::2]] == sorted(
+        start for start, _ in results[::2]
+    )
+
+
+def test_max_workers_without_barrier():
+    calls = [(interval, {'sleep_for': 0.2})] * 4
+    calls[1] = (interval, {'sleep_for': 2})
+    results = make_concurrent_calls(*calls, max_workers=2, barrier=False)
+
+    assert len(results) == 4
+    # each started as soon as there was room, not once the call which
+    # happened to be in the same batch finished
+    assert results[2][0] < results[1][1]
+    assert results[3][0] < results[1][1]
+
+
+def test_batch_size():
+    calls = [(interval, {'sleep_for': 0.2})] * 4
+    results = make_concurrent_calls(*calls, max_workers=4, batch_size=2)
+    assert len(results) == 4
+    # each batch starts together
+    for first, second in (results[:2], results[2:]):
+        assert abs(first[0] - second[0]) < 0.1
+
+
+def test_invalid_batch_size():
+    with pytest.raises(ValueError):
+        make_concurrent_calls((simple, {}), max_workers=2, batch_size=4)
+
+
+def test_total_timeout():
+    calls = [(timeout, {'sleep_for': 5})] * 2 + [(simple, {})]
+    start = time.time()
+    results = make_concurrent_calls(*calls, max_workers=1, total_timeout=2)
+    assert time.time() - start < 5
+
+    assert isinstance(results[0], WrappedError)
+    assert isinstance(results[0].error, TerminatedProcessError)
+    # never started
+    for result in results[1:]:
+        assert isinstance(result, WrappedError)
+        assert isinstance(result.error, DeadlineExceededError)
+
+
+def is_running(pid):
+    # (a zombie has been killed, it's just waiting to be reaped)
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER])
+def test_timeout_kills_process_group(mode, tmpdir):
+    pid_file = str(tmpdir.join('grandchild.pid'))
+    start = time.time()
+    results = make_concurrent_calls(
+        (stubborn, {'pid_file': pid_file}), mode=mode, timeout=2,
+    )
+    # SIGTERM was ignored, so it took SIGKILL after the grace period
+    assert time.time() - start < 2 + TERMINATE_GRACE + 5
+
+    assert isinstance(results[0], WrappedError)
+    assert isinstance(results[0].error, TerminatedProcessError)
+    with open(pid_file) as f:
+        grandchild = int(f.read())
+    deadline = time.time() + 2
+    while is_running(grandchild) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not is_running(grandchild)
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER, THREADS])
+def test_return_runs(mode):
+    runs = make_concurrent_calls(
+        (interval, {'sleep_for': 0.2}),
+        (raise_exception, {}),
+        mode=mode,
+        return_runs=True,
+    )
+
+    assert isinstance(runs[0].result, tuple)
+    assert isinstance(runs[1].result, WrappedError)
+    for run in runs:
+        metrics = run.metrics
+        assert metrics.db_setup >= 0
+        assert metrics.call >= 0
+        assert metrics.wall >= metrics.call
+        assert metrics.cpu_user >= 0
+        assert metrics.cpu_sys >= 0
+        assert metrics.max_rss > 0
+    assert runs[0].metrics.call >= 0.2
+    if mode == 'subprocess':
+        assert runs[0].metrics.spawn > 0
+        assert runs[0].metrics.boot > 0
+    elif mode == 'forkserver':
+        assert runs[0].metrics.spawn > 0
+        assert runs[0].metrics.boot is None
+    else:
+        assert runs[0].metrics.spawn is None
+
+
+def test_require_overlap():
+    runs = make_concurrent_calls(
+        *[(interval, {'sleep_for': 0.5})] * 3,
+        require_overlap=3,
+        return_runs=True
+    )
+    assert get_overlap(runs).max_degree == 3
+
+
+def test_invalid_require_overlap():
+    with pytest.raises(ValueError):
+        make_concurrent_calls(
+            *[(simple, {})] * 3, max_workers=2, require_overlap=3
+        )
+    with pytest.raises(ValueError):
+        list(iter_concurrent_calls((simple, {}), require_overlap=1))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_hunt_race_not_found():
+    obj = Semaphore.objects.create()
+    resets = []
+
+    hunt = hunt_race(
+        [(update_count_transactional, {'id_': obj.pk})] * 3,
+        lambda results: Semaphore.objects.get(pk=obj.pk).count == 3,
+        max_iterations=3,
+        reset=lambda: resets.append(
+            Semaphore.objects.filter(pk=obj.pk).update(count=0)
+        ),
+    )
+
+    assert not hunt.found
+    assert hunt.iterations == len(resets) == 3
+    assert hunt.results == [True, True, True]
+    assert hunt.upper_bound == pytest.approx(1 - 0.05 ** (1 / 3.0))
+
+
+def test_hunt_race_invalid():
+    with pytest.raises(ValueError):
+        hunt_race([(simple, {})], bool, max_iterations=0)
+
+    with pytest.raises(ValueError):
+        hunt_race([(simple, {})], bool, confidence=1)
@@ -0,0 +1,77 @@
+import math
+import pickle
+import random
+
+import pytest
+
+from django_concurrent_tests.histogram import Histogram
+
+
+def nearest_rank(values, percent):
+    values = sorted(values)
+    rank = max(int(math.ceil(percent / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def test_percentiles():
+    values = [random.expovariate(100) for _ in range(10000)]
+    histogram = Histogram()
+    for value in values:
+        histogram.record(value)
+
+    assert histogram.count == len(values)
+    assert histogram.max == max(values)
+    percents = [0, 50, 90, 99, 99.9, 100]
+    for percent, value in zip(percents, histogram.percentiles(percents)):
+        expected = nearest_rank(values, percent)
+        # (to within the resolution of the histogram)
+        assert expected <= value <= expected * 1.01 + 1e-6
+    assert histogram.percentile(100) == max(values)
+
+
+def test_empty():
+    histogram = Histogram()
+    assert histogram.count == 0
+    assert histogram.max is None
+    assert histogram.percentiles([50, 99]) == [None, None]
+
+
+def test_merge():
+    values = [random.uniform(0, 2) for _ in range(1000)]
+    merged = Histogram()
+    whole = Histogram()
+    for i in range(4):
+        part = Histogram()
+        for value in values[i::4]:
+            part.record(value)
+            whole.record(value)
+        # (as shipped back by a worker)
+        merged.merge(pickle.loads(pickle.dumps(part)))
+
+    assert merged.counts == whole.counts
+    assert merged.count == whole.count
+    assert merged.max == whole.max
+    assert merged.percentiles([50, 99]) == whole.percentiles([50, 99])
+
+
+def test_merge_different_buckets():
+    with pytest.raises(ValueError):
+        Histogram().merge(Histogram(significant_digits=3))
+
+
+def test_out_of_range():
+    histogram = Histogram(highest=10)
+    histogram.record(-1)
+    histogram.record(100)
+
+    assert histogram.count == 2
+    assert histogram.percentile(50) == histogram.lowest
+    assert histogram.percentile(100) == 100
+
+
+def test_constant_memory():
+    histogram = Histogram()
+    size = len(histogram.counts)
+    for value in (1e-6, 1, 3599):
+        histogram.record(value, count=1000000)
+    assert len(histogram.counts) == size < 5000
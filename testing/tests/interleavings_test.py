@@ -0,0 +1,192 @@
+import pytest
+
+from django_concurrent_tests import interleavings
+from django_concurrent_tests.interleavings import (
+    explore_interleavings,
+    format_schedule,
+    PCTSearch,
+    SystematicSearch,
+)
+
+from testapp.models import Semaphore
+
+from .funcs_to_test import (
+    simple,
+    update_count_naive,
+    update_count_transactional,
+)
+
+
+# the calls are made in threads of this process (see threads_test)
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def run_search(search, steps):
+    """
+    Emulate calls which each take `steps` turns, in the order chosen.
+    """
+    remaining = list(steps)
+    schedule = []
+    last = None
+    while any(remaining):
+        waiting = [index for index, left in enumerate(remaining) if left]
+        last = search.choose(waiting, last)
+        remaining[last] -= 1
+        schedule.append(last)
+    search.finish_schedule()
+    return schedule
+
+
+def test_systematic_search():
+    search = SystematicSearch(max_preemptions=1)
+    schedules = []
+    while search.next_schedule():
+        schedules.append(run_search(search, [2, 2]))
+
+    # fewest preemptions first, and no schedule twice
+    assert schedules[:2] == [[0, 0, 1, 1], [1, 1, 0, 0]]
+    assert sorted(schedules[2:]) == [
+        [0, 1, 1, 0], [1, 0, 0, 1],
+    ]
+    assert search.exhausted
+
+
+def test_systematic_search_unbounded():
+    search = SystematicSearch(max_preemptions=3)
+    schedules = []
+    while search.next_schedule():
+        schedules.append(run_search(search, [2, 2]))
+
+    # every order of 2 + 2 steps
+    assert len(schedules) == len(set(map(tuple, schedules))) == 6
+
+
+def test_pct_search():
+    def sample(seed):
+        search = PCTSearch(2, depth=2, seed=seed)
+        schedules = []
+        for _ in range(20):
+            search.next_schedule()
+            schedules.append(tuple(run_search(search, [2, 2])))
+        return schedules
+
+    assert sample(1) == sample(1)
+    assert len(set(sample(1))) > 2
+
+
+def race_fixture():
+    obj = Semaphore.objects.create()
+
+    def reset():
+        Semaphore.objects.filter(pk=obj.pk).update(count=0, locked=False)
+
+    def check(results):
+        successes = [result for result in results if result is True]
+        return len(successes) == Semaphore.objects.get(pk=obj.pk).count
+
+    return obj, reset, check
+
+
+def test_naive():
+    obj, reset, check = race_fixture()
+    calls = [(update_count_naive, {'id_': obj.pk})] * 2
+
+    found = explore_interleavings(calls, check, reset=reset)
+
+    assert found.found
+    assert found.schedules <= 4
+    print(format_schedule(found.schedule))
+    # both calls read the row before either of them updates it
+    queries = [
+        (step.call_index, step.sql.split()[0])
+        for step in found.schedule if step.sql is not None
+    ]
+    first_update = [sql for _, sql in queries].index('UPDATE')
+    assert sorted(queries[:first_update]) == [(0, 'SELECT'), (1, 'SELECT')]
+    assert found.results == [True, True]
+
+    # ...deterministically
+    again = explore_interleavings(calls, check, reset=reset)
+    assert (again.schedules, again.schedule) == (found.schedules, found.schedule)
+
+
+def test_naive_pct():
+    obj, reset, check = race_fixture()
+
+    found = explore_interleavings(
+        [(update_count_naive, {'id_': obj.pk})] * 2,
+        check,
+        strategy='pct',
+        seed=1,
+        max_schedules=30,
+        reset=reset,
+    )
+
+    assert found.found
+
+
+def test_transactional():
+    obj, reset, check = race_fixture()
+
+    found = explore_interleavings(
+        [(update_count_transactional, {'id_': obj.pk})] * 2,
+        check,
+        reset=reset,
+    )
+
+    assert not found.found
+    assert found.exhausted
+    # (a start and a query each)
+    assert found.schedules == 6
+    assert found.results == [True, True]
+
+
+def test_string_path():
+    found = explore_interleavings(
+        [('testing.tests.funcs_to_test:simple', {})] * 2,
+        lambda results: results == [True, True],
+        max_schedules=3,
+    )
+
+    assert not found.found
+    assert found.schedules == 2
+    assert found.exhausted
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'mode': 'pool'},
+    {'strategy': 'random'},
+    {'max_schedules': 0},
+    {'depth': 0},
+])
+def test_invalid(kwargs):
+    with pytest.raises(ValueError):
+        explore_interleavings([(simple, {})], lambda results: True, **kwargs)
+
+
+def test_old_django(monkeypatch):
+    # (no `execute_wrapper`, the cursors are wrapped instead)
+    monkeypatch.setattr(interleavings.django, 'VERSION', (1, 11, 0, 'final', 0))
+    obj, reset, check = race_fixture()
+
+    found = explore_interleavings(
+        [(update_count_naive, {'id_': obj.pk})] * 2,
+        check,
+        reset=reset,
+    )
+
+    assert found.found
+    assert found.schedules <= 4
+    assert all(
+        step.sql.split()[0] in ('SELECT', 'UPDATE')
+        for step in found.schedule if step.sql is not None
+    )
+
+    found = explore_interleavings(
+        [(update_count_transactional, {'id_': obj.pk})] * 2,
+        check,
+        reset=reset,
+    )
+
+    assert not found.found
+    assert found.schedules == 6
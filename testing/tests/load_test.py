@@ -0,0 +1,35 @@
+import pytest
+
+from django_concurrent_tests.load import run_load
+
+from .funcs_to_test import raise_exception, simple
+
+
+def test_run_load():
+    report = run_load(2, simple, duration=0.5, warmup=0.2)
+
+    assert report.calls > 2
+    assert report.errors == 0
+    assert report.error_rate == 0
+    assert report.throughput == report.calls / 0.5
+    assert 0 < report.p50 <= report.p90 <= report.p99 <= report.max
+
+
+def test_errors():
+    report = run_load(2, raise_exception, duration=0.5)
+
+    assert report.calls > 2
+    assert report.errors == report.calls
+    assert report.error_rate == 1
+    assert report.p50 is None
+    assert report.max is None
+
+
+def test_worker_failed():
+    with pytest.raises(AttributeError):
+        run_load(1, 'tests.funcs_to_test:wtf', duration=0.5)
+
+
+def test_invalid_duration():
+    with pytest.raises(ValueError):
+        run_load(1, simple, duration=0)
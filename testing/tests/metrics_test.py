@@ -0,0 +1,63 @@
+import pytest
+
+from django_concurrent_tests.metrics import (
+    CallMetrics,
+    get_context_switches,
+    get_overlap,
+)
+from django_concurrent_tests.supervisor import SubprocessRun
+
+
+def make_run(start, end):
+    return SubprocessRun(
+        manager=None,
+        result=None,
+        metrics=CallMetrics(call_start=start, call_end=end),
+    )
+
+
+def test_call_metrics():
+    metrics = CallMetrics(call=1.5)
+    metrics.update({'max_rss': 1024, 'something_else': True})
+    assert metrics.as_dict() == dict(
+        dict.fromkeys(CallMetrics.FIELDS), call=1.5, max_rss=1024,
+    )
+
+    with pytest.raises(TypeError):
+        CallMetrics(whatever=1)
+
+
+@pytest.mark.parametrize('intervals,max_degree,average_degree', [
+    ([], 0, 0.0),
+    ([(0, 2)], 1, 1.0),
+    # one after the other
+    ([(0, 1), (2, 3)], 1, 2 / 3.0),
+    # all at once
+    ([(0, 2), (0, 2), (0, 2)], 3, 3.0),
+    # staggered
+    ([(0, 2), (1, 3), (2.5, 4)], 2, 5.5 / 4),
+])
+def test_get_overlap(intervals, max_degree, average_degree):
+    runs = [make_run(start, end) for start, end in intervals]
+    # a call which never got as far as calling the function
+    runs.append(make_run(None, None))
+
+    overlap = get_overlap(runs)
+
+    assert overlap.max_degree == max_degree
+    assert overlap.average_degree == pytest.approx(average_degree)
+
+
+
+def test_get_context_switches():
+    runs = [
+        SubprocessRun(None, None, CallMetrics(
+            voluntary_switches=voluntary, involuntary_switches=involuntary,
+        ))
+        for voluntary, involuntary in [(3, 1), (10, 0), (None, None)]
+    ]
+    # (e.g. it failed to deserialize)
+    runs.append(SubprocessRun(None, None, None))
+
+    assert get_context_switches(runs) == (13, 1)
+    assert get_context_switches([]) == (0, 0)
@@ -0,0 +1,137 @@
+import logging
+import os
+from functools import partial
+
+import django
+import pytest
+
+from django_concurrent_tests import forkserver
+from django_concurrent_tests.helpers import make_concurrent_calls
+from django_concurrent_tests.output import (
+    OUTPUT_LEVEL,
+    OutputLogger,
+    StderrLogHandler,
+)
+
+from .funcs_to_test import chatty
+
+
+FORKSERVER = pytest.param(
+    'forkserver', marks=pytest.mark.skipif(
+        django.VERSION < (1, 8), reason='forkserver mode requires Django 1.8+',
+    ),
+)
+
+
+class Stream(list):
+
+    def write(self, text):
+        self.append(text)
+
+    def flush(self):
+        pass
+
+
+def messages(caplog):
+    return [
+        (record.name, record.levelno, record.getMessage())
+        for record in caplog.records
+    ]
+
+
+def test_lines(caplog):
+    caplog.set_level(logging.DEBUG)
+    output = OutputLogger(123, call_index=4)
+    output.feed(b'one\ntw')
+    assert messages(caplog) == [
+        ('django_concurrent_tests.output', OUTPUT_LEVEL, '[123:4] one'),
+    ]
+
+    output.feed(b'o\n\nthree')
+    output.close()
+    assert [message for _, _, message in messages(caplog)] == [
+        '[123:4] one', '[123:4] two', '[123:4] three',
+    ]
+    assert output.tail == b'one\ntwo\n\nthree'
+
+
+def test_log_records(caplog):
+    caplog.set_level(logging.INFO)
+    stream = Stream()
+    worker_logger = logging.getLogger('tests.worker')
+    worker_logger.propagate = False
+    worker_logger.addHandler(StderrLogHandler(stream))
+    try:
+        worker_logger.info('hello %s', 'there')
+        worker_logger.debug('dropped by the level of the parent')
+    finally:
+        worker_logger.handlers = []
+        worker_logger.propagate = True
+
+    output = OutputLogger(123)
+    output.feed(''.join(stream).encode('ascii'))
+    # (prefixed with the pid of the process which logged it)
+    assert messages(caplog) == [
+        ('tests.worker', logging.INFO,
+         '[{}] tests.worker: hello there'.format(os.getpid())),
+    ]
+
+
+def test_limit(caplog):
+    output = OutputLogger(123, limit=10, tail=8)
+    output.feed(b'12345\n' * 3)
+    output.feed(b'x' * 20)
+    output.close()
+
+    assert [message for _, _, message in messages(caplog)] == [
+        '[123] 12345',
+        # (still fits)
+        '[123] xxxx',
+        '[123] 28 bytes of output not logged, over the limit of 10 '
+        '(see DJANGO_CONCURRENT_TESTS_OUTPUT_LIMIT)',
+    ]
+    # (long lines are split)
+    assert output.tail == b'xxxx'
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER])
+def test_forwarded(mode, caplog):
+    results = make_concurrent_calls((chatty, {}), mode=mode)
+    assert results == [True]
+
+    forwarded = [
+        (name, level, message.split(' ', 1)[1])
+        for name, level, message in messages(caplog)
+        if message.endswith(('just saying', 'oh no'))
+    ]
+    assert forwarded == [
+        ('django_concurrent_tests.output', OUTPUT_LEVEL, 'just saying'),
+        ('tests.chatty', logging.ERROR, 'tests.chatty: oh no'),
+    ]
+
+
+@pytest.mark.skipif(django.VERSION < (1, 8), reason='forkserver mode requires Django 1.8+')
+def test_forked_limit_per_call(monkeypatch, caplog):
+    # room for the print, not for the log record
+    limit = len(b'just saying\n')
+    monkeypatch.setattr(forkserver, 'OutputLogger', partial(OutputLogger, limit=limit))
+
+    runs = make_concurrent_calls(
+        *[(chatty, {})] * 2, mode='forkserver', return_runs=True
+    )
+    assert [run.result for run in runs] == [True, True]
+
+    said = [
+        message.split(' ', 1)[0] for _, _, message in messages(caplog)
+        if message.endswith('just saying')
+    ]
+    dropped = [
+        message.split(' ', 1)[0] for _, _, message in messages(caplog)
+        if 'not logged, over the limit' in message
+    ]
+    # each child's output is counted (and prefixed) as its own
+    expected = [
+        '[{pid}:{index}]'.format(pid=run.manager.pid, index=index)
+        for index, run in enumerate(runs)
+    ]
+    assert sorted(said) == sorted(dropped) == sorted(expected)
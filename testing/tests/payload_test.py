@@ -0,0 +1,195 @@
+import os
+
+import django
+import pytest
+
+from django_concurrent_tests import binpickle, payload
+from django_concurrent_tests.b64pickle import PickleLoadsError
+from django_concurrent_tests.errors import WrappedError
+from django_concurrent_tests.helpers import make_concurrent_calls
+from django_concurrent_tests.utils import override_environment
+
+from .funcs_to_test import echo
+
+
+FORKSERVER = pytest.param(
+    'forkserver', marks=pytest.mark.skipif(
+        django.VERSION < (1, 8), reason='forkserver mode requires Django 1.8+',
+    ),
+)
+
+
+def flags(sent):
+    return bytearray(sent[:1])[0]
+
+
+def fixture(size=10000):
+    # (repetitive, but not a repeat of the same object, which pickle would
+    # only send once anyway)
+    return [{'id': i, 'name': 'whatever'} for i in range(size)]
+
+
+def test_inline():
+    data = binpickle.dumps({'a': 1})
+    sent = payload.dumps(data)
+
+    assert sent == b'\x00' + data
+    assert payload.loads(sent) == {'a': 1}
+
+
+@pytest.mark.parametrize('compression,flag', [
+    ('zlib', payload.ZLIB),
+    pytest.param('lzma', payload.LZMA, marks=pytest.mark.skipif(
+        payload.lzma is None, reason='needs Python 3.3+',
+    )),
+])
+def test_compressed(monkeypatch, compression, flag):
+    monkeypatch.setattr(payload, 'COMPRESSION', compression)
+    data = binpickle.dumps(fixture())
+    metrics = {}
+    sent = payload.dumps(data, metrics=metrics)
+
+    assert flags(sent) == flag
+    assert metrics['result_bytes'] == len(data)
+    assert metrics['result_sent_bytes'] == len(sent) - 1 < len(data) / 4
+    assert payload.loads(sent) == fixture()
+
+
+def test_small_or_incompressible():
+    # (not worth compressing)
+    small = binpickle.dumps('x' * 100)
+    random = binpickle.dumps(os.urandom(payload.COMPRESS_PAYLOAD * 2))
+    metrics = {}
+
+    assert payload.dumps(small) == b'\x00' + small
+    assert payload.dumps(random, metrics=metrics) == b'\x00' + random
+    assert metrics['result_bytes'] == metrics['result_sent_bytes'] == len(random)
+
+
+def test_in_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(payload, 'LARGE_PAYLOAD', 100)
+    monkeypatch.setattr(payload.tempfile, 'tempdir', str(tmp_path))
+    random = binpickle.dumps(os.urandom(1000))
+
+    assert flags(payload.dumps(random, in_file=False)) == 0
+    assert not os.listdir(str(tmp_path))
+
+    sent = payload.dumps(random)
+    assert flags(sent) == payload.IN_FILE
+    assert os.listdir(str(tmp_path))
+    assert payload.loads(sent) == binpickle.loads(random)
+    # the parent deletes it
+    assert not os.listdir(str(tmp_path))
+
+
+def test_claim(monkeypatch, tmp_path):
+    monkeypatch.setattr(payload, 'LARGE_PAYLOAD', 100)
+    monkeypatch.setattr(payload.tempfile, 'tempdir', str(tmp_path))
+    random = binpickle.dumps(os.urandom(1000))
+    inline = payload.dumps(random, in_file=False)
+
+    assert payload.claim(inline) is inline
+
+    claimed = payload.claim(payload.dumps(random))
+    # deleted as soon as it's claimed, whether it's loaded or not
+    assert not os.listdir(str(tmp_path))
+    assert payload.loads(claimed) == binpickle.loads(random)
+
+
+def test_unpickleable_in_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(payload, 'LARGE_PAYLOAD', 100)
+    monkeypatch.setattr(payload.tempfile, 'tempdir', str(tmp_path))
+    garbage = b'wtf' * 100
+
+    with pytest.raises(PickleLoadsError) as excinfo:
+        payload.loads(payload.dumps(garbage))
+
+    # (not the memory map of the file, which is closed by now)
+    assert excinfo.value.pickled_value == garbage
+    assert not os.listdir(str(tmp_path))
+
+
+def test_compressed_in_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(payload, 'LARGE_PAYLOAD', 100)
+    monkeypatch.setattr(payload, 'COMPRESS_PAYLOAD', 100)
+    monkeypatch.setattr(payload.tempfile, 'tempdir', str(tmp_path))
+    data = binpickle.dumps([os.urandom(200)] * 100)
+
+    sent = payload.dumps(data)
+    assert flags(sent) == payload.IN_FILE | payload.ZLIB
+    assert payload.loads(sent) == binpickle.loads(data)
+    assert not os.listdir(str(tmp_path))
+
+
+def test_unknown_flags():
+    with pytest.raises(ValueError):
+        payload.loads(b'\x08' + binpickle.dumps(None))
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER])
+def test_large_result(mode, tmp_path, monkeypatch):
+    loaded = []
+    load = payload._ClaimedFile.load
+    monkeypatch.setattr(
+        payload._ClaimedFile, 'load', lambda self: loaded.append(self) or load(self),
+    )
+    # (incompressible)
+    value = os.urandom(100000)
+    with override_environment(
+        DJANGO_CONCURRENT_TESTS_LARGE_PAYLOAD='1000',
+        TMPDIR=str(tmp_path),
+    ):
+        results = make_concurrent_calls(
+            (echo, {'value': value}),
+            (echo, {'value': 'small'}),
+            mode=mode,
+        )
+
+    assert results == [value, 'small']
+    assert len(loaded) == 1
+    # (a fork server keeps its socket in there too)
+    assert not [
+        name for name in os.listdir(str(tmp_path))
+        if name.startswith('concurrent_tests_result')
+    ]
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER])
+def test_large_result_not_loaded(mode, tmp_path, monkeypatch):
+    def load(self):
+        raise ValueError('not today')
+
+    monkeypatch.setattr(payload._ClaimedFile, 'load', load)
+    with override_environment(
+        DJANGO_CONCURRENT_TESTS_LARGE_PAYLOAD='1000',
+        TMPDIR=str(tmp_path),
+    ):
+        results = make_concurrent_calls((echo, {'value': os.urandom(100000)}), mode=mode)
+
+    assert isinstance(results[0], WrappedError)
+    # deleted all the same
+    assert not [
+        name for name in os.listdir(str(tmp_path))
+        if name.startswith('concurrent_tests_result')
+    ]
+
+
+@pytest.mark.parametrize('mode', ['subprocess', 'pool', FORKSERVER])
+def test_compressed_calls(mode, monkeypatch):
+    value = fixture()
+    # (for the kwargs, in here, and the results)
+    monkeypatch.setattr(payload, 'COMPRESS_PAYLOAD', 1000)
+    with override_environment(DJANGO_CONCURRENT_TESTS_COMPRESS_PAYLOAD='1000'):
+        runs = make_concurrent_calls(
+            (echo, {'value': value}),
+            (echo, {'value': 'small'}),
+            mode=mode,
+            return_runs=True,
+        )
+
+    assert [run.result for run in runs] == [value, 'small']
+    big, small = [run.metrics for run in runs]
+    assert big.kwargs_sent_bytes < big.kwargs_bytes / 4
+    assert big.result_sent_bytes < big.result_bytes / 4
+    assert small.kwargs_sent_bytes == small.kwargs_bytes
+    assert small.result_sent_bytes == small.result_bytes
@@ -0,0 +1,229 @@
+import os
+import types
+from pprint import pprint
+
+import pytest
+from django.db import connection
+from django.test.utils import override_settings
+
+from django_concurrent_tests import binpickle, pool as pool_module
+from django_concurrent_tests.errors import (
+    TerminatedProcessError,
+    WrappedError,
+)
+from django_concurrent_tests.helpers import make_concurrent_calls
+from django_concurrent_tests.management.commands.concurrent_call_wrapper import (
+    reset_db_connections,
+)
+from django_concurrent_tests.pool import get_worker_pool, WorkerProcess
+from django_concurrent_tests.utils import (
+    override_environment,
+    SUBPROCESS_TIMEOUT,
+)
+
+from testapp.models import Semaphore
+
+from .funcs_to_test import (
+    CustomError,
+    environment,
+    fail_in_transaction,
+    get_count,
+    leave_raw_transaction,
+    leave_uncommitted,
+    raise_exception,
+    simple,
+    timeout,
+    update_count_transactional,
+)
+
+
+def test_simple():
+    results = make_concurrent_calls(*[(simple, {})] * 2, mode='pool')
+    assert results == [True, True]
+
+
+def test_workers_are_reused():
+    pool = get_worker_pool()
+    first = pool.run(simple)
+    second = pool.run(simple)
+
+    assert isinstance(first.manager, WorkerProcess)
+    assert first.result is True
+    assert second.result is True
+    assert first.manager.pid != os.getpid()
+    assert second.manager.pid == first.manager.pid
+
+
+@pytest.mark.django_db(transaction=True)
+def test_transactional():
+    obj = Semaphore.objects.create()
+
+    calls = [(update_count_transactional, {'id_': obj.pk})] * 3
+    results = make_concurrent_calls(*calls, mode='pool')
+    pprint([str(r) for r in results])
+
+    obj = Semaphore.objects.get(pk=obj.pk)
+    assert results == [True, True, True]
+    assert obj.count == 3
+
+
+def test_exception():
+    results = make_concurrent_calls(*[(raise_exception, {})] * 2, mode='pool')
+    pprint([str(r) for r in results])
+
+    for result in results:
+        assert isinstance(result, WrappedError)
+        assert isinstance(result.traceback, types.TracebackType)
+        assert isinstance(result.error, CustomError)
+
+
+def test_timeout():
+    pool = get_worker_pool()
+    run = pool.run(timeout, sleep_for=SUBPROCESS_TIMEOUT + 5)
+
+    assert isinstance(run.result, WrappedError)
+    assert isinstance(run.result.error, TerminatedProcessError)
+    assert not run.manager.is_alive()
+
+    # the pool replaces the terminated worker
+    assert pool.run(simple).result is True
+
+
+def test_incomplete_call(monkeypatch):
+    pool = get_worker_pool()
+    worker = pool.run(simple).manager
+
+    class UnreadableMetrics(object):
+        dumps = staticmethod(binpickle.dumps)
+
+        @staticmethod
+        def loads(frame):
+            raise ValueError('unreadable metrics')
+
+    monkeypatch.setattr(pool_module, 'binpickle', UnreadableMetrics)
+    run = pool.run(simple)
+    monkeypatch.undo()
+
+    assert isinstance(run.result, WrappedError)
+    assert run.manager is worker
+    # its result frame was still to come, so it's not back in the pool
+    assert not worker.is_alive()
+    second = pool.run(simple)
+    assert second.result is True
+    assert second.manager is not worker
+
+
+def test_environment():
+    with override_environment(WTF='pooled'):
+        results = make_concurrent_calls((environment, {}), mode='pool')
+    assert results == ['pooled']
+
+    results = make_concurrent_calls((environment, {}), mode='pool')
+    assert results == [None]
+
+
+def test_pool_per_session():
+    pool = get_worker_pool()
+    worker = pool.run(simple).manager
+
+    # (pytest sets it to each test in turn)
+    with override_environment(PYTEST_CURRENT_TEST='some other test'):
+        assert get_worker_pool() is pool
+
+    with override_environment(WTF='superseded'):
+        other = get_worker_pool()
+        assert other is not pool
+        # the old pool's workers are shut down
+        assert len(pool) == 0
+        assert not worker.is_alive()
+
+
+def test_invalid_option():
+    with pytest.raises(TypeError):
+        make_concurrent_calls((simple, {}), wtf=True)
+
+    with pytest.raises(ValueError):
+        make_concurrent_calls((simple, {}), mode='wtf')
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('reuse', [False, True])
+def test_reuse_db_connections(reuse):
+    obj = Semaphore.objects.create()
+
+    with override_settings(CONCURRENT_TESTS_REUSE_DB_CONNECTIONS=reuse):
+        pool = get_worker_pool()
+        try:
+            first = pool.run(leave_uncommitted, id_=obj.pk)
+            second = pool.run(simple)
+        finally:
+            pool.close()
+
+    assert first.result is True
+    assert second.result is True
+    assert second.manager.pid == first.manager.pid
+    assert (first.metrics.db_connects, first.metrics.db_reuses) == (1, 0)
+    if reuse:
+        assert (second.metrics.db_connects, second.metrics.db_reuses) == (0, 1)
+    else:
+        assert (second.metrics.db_connects, second.metrics.db_reuses) == (1, 0)
+    # rolled back, not left hanging (or committed) by the worker
+    assert Semaphore.objects.get(pk=obj.pk).count == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reuse_db_connections_raw_transaction():
+    obj = Semaphore.objects.create()
+
+    with override_settings(CONCURRENT_TESTS_REUSE_DB_CONNECTIONS=True):
+        pool = get_worker_pool()
+        try:
+            first = pool.run(leave_raw_transaction, id_=obj.pk)
+            second = pool.run(get_count, id_=obj.pk)
+        finally:
+            pool.close()
+
+    assert first.result is True
+    assert second.manager.pid == first.manager.pid
+    assert (second.metrics.db_connects, second.metrics.db_reuses) == (0, 1)
+    # rolled back, though Django didn't know about the transaction
+    assert second.result == 0
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('max_age,expired,closed', [
+    (0, True, False),
+    (60, False, False),
+    (60, True, True),
+])
+def test_reset_db_connections_max_age(monkeypatch, max_age, expired, closed):
+    monkeypatch.setitem(connection.settings_dict, 'CONN_MAX_AGE', max_age)
+    connection.close()
+    connection.ensure_connection()
+    if expired:
+        # (whichever clock Django uses)
+        connection.close_at = 0
+
+    reset_db_connections()
+
+    assert (connection.connection is None) == closed
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reuse_db_connections_after_failure():
+    obj = Semaphore.objects.create()
+
+    with override_settings(CONCURRENT_TESTS_REUSE_DB_CONNECTIONS=True):
+        pool = get_worker_pool()
+        try:
+            first = pool.run(fail_in_transaction, id_=obj.pk)
+            second = pool.run(simple)
+        finally:
+            pool.close()
+
+    assert isinstance(first.result, WrappedError)
+    assert second.result is True
+    assert second.manager.pid == first.manager.pid
+    # its connection was closed, not reused with the transaction still open
+    assert (second.metrics.db_connects, second.metrics.db_reuses) == (1, 0)
+    assert Semaphore.objects.get(pk=obj.pk).count == 0
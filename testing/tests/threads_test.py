@@ -0,0 +1,195 @@
+import resource
+import sys
+import threading
+import time
+from pprint import pprint
+
+import pytest
+from django.db import connections
+
+from django_concurrent_tests.errors import (
+    TerminatedProcessError,
+    WrappedError,
+)
+from django_concurrent_tests.helpers import hunt_race, make_concurrent_calls
+from django_concurrent_tests.metrics import get_context_switches
+from django_concurrent_tests.utils import override_environment
+
+from testapp.models import Semaphore
+
+from .funcs_to_test import (
+    chatty,
+    CustomError,
+    db_connections,
+    raise_exception,
+    simple,
+    timeout,
+    update_count_naive,
+    update_count_transactional,
+)
+
+
+# the calls connect to the test db, in threads of this process, so they
+# need db access as much as the test itself
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+def test_simple():
+    results = make_concurrent_calls(*[(simple, {})] * 2, mode='threads')
+    assert results == [True, True]
+
+
+def test_any_callable():
+    main_thread = threading.current_thread()
+    fixture = []
+
+    def call(value):
+        # (no pickling: we get the very same objects)
+        fixture.append(value)
+        return threading.current_thread() is not main_thread
+
+    results = make_concurrent_calls(
+        (call, {'value': 1}), (call, {'value': 2}), mode='threads',
+    )
+
+    assert results == [True, True]
+    assert sorted(fixture) == [1, 2]
+
+
+def test_connection_per_thread():
+    main_connection = connections['default']
+
+    def connection():
+        return connections['default']
+
+    calls = [(db_connections, {})] * 2 + [(connection, {})]
+    runs = make_concurrent_calls(*calls, mode='threads', return_runs=True)
+
+    # the test db, connected before the barrier
+    name = main_connection.settings_dict['NAME']
+    assert [run.result['default'] for run in runs[:2]] == [(name, True)] * 2
+    for run in runs:
+        assert run.metrics.db_connects == 1
+    # ...and closed after the call
+    assert runs[2].result is not main_connection
+    assert runs[2].result.connection is None
+
+
+def test_transactional():
+    obj = Semaphore.objects.create()
+
+    calls = [(update_count_transactional, {'id_': obj.pk})] * 3
+    results = make_concurrent_calls(*calls, mode='threads')
+    pprint([str(r) for r in results])
+
+    obj = Semaphore.objects.get(pk=obj.pk)
+    assert results == [True, True, True]
+    assert obj.count == 3
+
+
+def test_naive():
+    obj = Semaphore.objects.create()
+
+    def reset():
+        Semaphore.objects.filter(pk=obj.pk).update(count=0, locked=False)
+
+    def check(results):
+        successes = [result for result in results if result is True]
+        return len(successes) == Semaphore.objects.get(pk=obj.pk).count
+
+    hunt = hunt_race(
+        [(update_count_naive, {'id_': obj.pk})] * 3,
+        check,
+        max_iterations=10,
+        reset=reset,
+        mode='threads',
+    )
+
+    assert hunt.found
+
+
+def test_exception():
+    results = make_concurrent_calls((raise_exception, {}), mode='threads')
+
+    assert isinstance(results[0], WrappedError)
+    assert isinstance(results[0].error, CustomError)
+
+
+def test_timeout():
+    start = time.time()
+    results = make_concurrent_calls(
+        (timeout, {'sleep_for': 3}),
+        (simple, {}),
+        mode='threads',
+        timeout=1,
+    )
+
+    assert time.time() - start < 3
+    assert isinstance(results[0], WrappedError)
+    assert isinstance(results[0].error, TerminatedProcessError)
+    assert results[1] is True
+
+
+def test_stdout_not_swapped(capsys):
+    results = make_concurrent_calls((chatty, {}), mode='threads')
+
+    assert results == [True]
+    assert capsys.readouterr().out == 'just saying\n'
+
+
+def test_no_subprocess():
+    main_thread = threading.current_thread()
+
+    def call():
+        return threading.current_thread() is not main_thread
+
+    with override_environment(CONCURRENT_TESTS_NO_SUBPROCESS='1'):
+        results = make_concurrent_calls(*[(call, {})] * 2)
+
+    assert results == [True, True]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 2), reason='needs Python 3.2+')
+def test_switch_interval():
+    before = sys.getswitchinterval()
+    counter = [0]
+
+    def add_one(value):
+        return value + 1
+
+    def increment(times):
+        # (a read-modify-write race, in pure Python)
+        for _ in range(times):
+            value = counter[0]
+            counter[0] = add_one(value)
+        return sys.getswitchinterval()
+
+    def reset():
+        counter[0] = 0
+
+    def check(results):
+        return counter[0] == 2 * 20000
+
+    # (with the default 5ms interval, a call this short is rarely switched
+    # out in the middle)
+    hunt = hunt_race(
+        [(increment, {'times': 20000})] * 2,
+        check,
+        max_iterations=50,
+        reset=reset,
+        mode='threads',
+        switch_interval=0.000001,
+        return_runs=True,
+    )
+
+    assert hunt.found
+    assert [run.result for run in hunt.results] == [pytest.approx(0.000001)] * 2
+    assert sys.getswitchinterval() == before
+    switches = get_context_switches(hunt.results)
+    if hasattr(resource, 'RUSAGE_THREAD'):
+        assert switches.voluntary + switches.involuntary > 0
+
+
+def test_invalid_switch_interval():
+    with pytest.raises(ValueError):
+        make_concurrent_calls((simple, {}), mode='threads', switch_interval=0)
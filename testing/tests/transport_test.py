@@ -0,0 +1,46 @@
+import io
+
+import pytest
+
+from django_concurrent_tests.transport import (
+    encode_frame,
+    FrameReader,
+    read_frame,
+    write_frame,
+)
+
+
+def test_roundtrip():
+    stream = io.BytesIO()
+    write_frame(stream, b'first')
+    write_frame(stream, b'')
+    write_frame(stream, b'\x00\n' * 1000)
+    stream.seek(0)
+
+    assert read_frame(stream) == b'first'
+    assert read_frame(stream) == b''
+    assert read_frame(stream) == b'\x00\n' * 1000
+    assert read_frame(stream) is None
+
+
+def test_truncated():
+    stream = io.BytesIO(encode_frame(b'whatever')[:-2])
+    with pytest.raises(EOFError):
+        read_frame(stream)
+
+
+def test_frame_reader():
+    data = encode_frame(b'first') + encode_frame(b'second')
+    reader = FrameReader()
+
+    # feed it one byte at a time
+    frames = []
+    for i in range(len(data)):
+        reader.feed(data[i:i + 1])
+        frame = reader.next_frame()
+        if frame is not None:
+            frames.append(frame)
+
+    assert frames == [b'first', b'second']
+    assert reader.next_frame() is None
+    assert reader.pending() == b''
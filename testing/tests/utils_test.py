@@ -1,16 +1,22 @@
 import os
+import sys
 
 import mock
 import pytest
+from django.db import connections
+from django.test.utils import override_settings
 
 from django_concurrent_tests.errors import WrappedError
 from django_concurrent_tests.utils import (
+    get_call_cmd,
+    get_test_databases,
     override_environment,
+    override_switch_interval,
     run_in_subprocess,
     ProcessManager,
 )
 
-from .funcs_to_test import simple
+from .funcs_to_test import db_connections, simple
 
 
 def test_override_environment():
@@ -32,13 +38,28 @@ def test_override_environment():
     assert os.getenv('TEST_VALUE3') is None
 
 
+@pytest.mark.skipif(sys.version_info < (3, 2), reason='needs Python 3.2+')
+def test_override_switch_interval():
+    before = sys.getswitchinterval()
+
+    with override_switch_interval(None):
+        assert sys.getswitchinterval() == before
+    with pytest.raises(ValueError):
+        with override_switch_interval(0.000001):
+            assert sys.getswitchinterval() == pytest.approx(0.000001)
+            raise ValueError
+
+    # restored
+    assert sys.getswitchinterval() == before
+
+
 def test_deserializer_exception():
     """
     Exceptions raised when deserializing result from subprocess are wrapped
     with WrappedError, providing access to the original error and traceback.
     """
     with mock.patch(
-        'django_concurrent_tests.b64pickle.loads', side_effect=ValueError('WTF')
+        'django_concurrent_tests.binpickle.loads', side_effect=ValueError('WTF')
     ) as mock_loads:
         run = run_in_subprocess(simple)
     
@@ -62,3 +83,42 @@ def test_process_manager_parent_pid():
     assert manager.process.pid != parent_pid  # validate assumption
 
     assert output.decode("utf-8").strip('\n') == str(parent_pid)
+
+
+@pytest.mark.parametrize('use_manage_py', [False, True])
+def test_call_cmd(use_manage_py):
+    with override_settings(CONCURRENT_TESTS_USE_MANAGE_PY=use_manage_py):
+        cmd, _ = get_call_cmd('tests.funcs_to_test:wallpaper')
+        run = run_in_subprocess('tests.funcs_to_test:wallpaper', colour='blue')
+
+    if use_manage_py:
+        assert cmd[1] == 'concurrent_call_wrapper'
+    else:
+        assert cmd[:3] == [sys.executable, '-m', 'django_concurrent_tests.worker']
+    assert run.result == 'blue stripes'
+    assert run.metrics.boot > 0
+
+
+def test_test_databases():
+    run = run_in_subprocess(db_connections)
+
+    # on the parent's test dbs, but only connected once used
+    assert run.result == dict(
+        (alias, (connections[alias].creation._get_test_db_name(), False))
+        for alias in connections
+    )
+
+
+def test_test_databases_before_setup(monkeypatch):
+    connection = connections['default']
+    test_name = connection.creation._get_test_db_name()
+    # as before the test runner switched to the test dbs (for the first
+    # test which needs them)
+    monkeypatch.setitem(
+        connection.settings_dict, 'NAME',
+        os.path.join(os.path.dirname(test_name), 'db.sqlite3'),
+    )
+
+    assert get_test_databases()['default'] == {'NAME': test_name}
+    run = run_in_subprocess(db_connections)
+    assert run.result['default'] == (test_name, False)